@@ -0,0 +1,115 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import async_db
+import metrics
+import webhook_inbox
+
+# Webhook events a process has accepted but not yet committed to the inbox. Once BUFFER_HIGH are
+# waiting, the webhook endpoints answer 503 with Retry-After and Stripe redelivers later. They
+# accept again when the buffer has drained to BUFFER_LOW, rather than letting a burst back in one
+# event at a time right at the limit.
+BUFFER_HIGH = int(os.getenv('WEBHOOK_BUFFER_HIGH', '1000'))
+BUFFER_LOW = int(os.getenv('WEBHOOK_BUFFER_LOW', str(BUFFER_HIGH // 2)))
+RETRY_AFTER = int(os.getenv('WEBHOOK_RETRY_AFTER', '30'))  # Seconds, sent with the 503
+WRITE_BATCH_SIZE = 200  # Events committed per transaction
+
+
+class BufferFullError(Exception):
+    """The webhook buffer is over its high watermark, the event was not stored."""
+
+
+class AdmissionBuffer:
+    """Bounds the webhook events in flight between the HTTP endpoint and the inbox.
+
+    On an event loop, events that arrive while a commit is running are written together in the
+    next transaction, one fsync for the lot. Flask threads hand their event to the database
+    thread one at a time, and count against the same watermarks.
+    """
+
+    def __init__(self, high=BUFFER_HIGH, low=BUFFER_LOW, batch_size=WRITE_BATCH_SIZE):
+        if not 0 <= low < high:
+            raise ValueError(f"The low watermark ({low}) must be below the high watermark ({high})")
+        self.high = high
+        self.low = low
+        self.batch_size = batch_size
+        self._size = 0
+        self._shedding = False
+        self._lock = threading.Lock()  # Admission is shared by the loop and the Flask threads
+        self._pending = []  # (inbox row, future) waiting for the writer, touched on the loop only
+        self._writer = None
+        _buffers.add(self)
+
+    def _admit(self):
+        with self._lock:
+            if self._size >= self.high:
+                self._shedding = True
+            if self._shedding:
+                raise BufferFullError(f"{self._size} webhook events waiting to be stored")
+            self._size += 1
+
+    def _release(self):
+        with self._lock:
+            self._size -= 1
+            if self._size <= self.low:
+                self._shedding = False
+
+    async def store(self, event_id, event_type, stripe_account_id, payload, discord_server_id=None):
+        """Commit an event to the inbox. Returns False if it was a duplicate.
+
+        Raises BufferFullError without storing the event while the buffer is shedding load.
+        """
+        self._admit()
+        try:
+            future = asyncio.get_running_loop().create_future()
+            self._pending.append(((event_id, event_type, stripe_account_id, payload, discord_server_id), future))
+            if self._writer is None or self._writer.done():
+                self._writer = asyncio.get_running_loop().create_task(self._write())
+            return await future
+        finally:
+            self._release()
+
+    def store_blocking(self, event_id, event_type, stripe_account_id, payload, discord_server_id=None):
+        """store() for threads without an event loop, which wait for the database thread to write the event."""
+        self._admit()
+        try:
+            return async_db.run_db_blocking(webhook_inbox.enqueue_event, event_id, event_type, stripe_account_id,
+                                            payload, discord_server_id)
+        finally:
+            self._release()
+
+    async def _write(self):
+        # Runs until nothing is pending, the next store() starts it again
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            try:
+                stored = await async_db.run_db(webhook_inbox.enqueue_received, [row for row, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), new in zip(batch, stored):
+                if not future.done():  # The request went away, the event is stored regardless
+                    future.set_result(new)
+
+    def stats(self):
+        with self._lock:
+            return {'buffered': self._size, 'shedding': self._shedding}
+
+
+def throttled_reply(event, error):
+    """Body, status and headers of the answer to an event the buffer turned away."""
+    print(f"Deferred webhook {event['id']}: {error}")
+    metrics.WEBHOOK_EVENTS.labels(event['type'], 'throttled').inc()
+    return "Busy, retry later", 503, {'Retry-After': str(RETRY_AFTER)}
+
+
+_buffers = weakref.WeakSet()
+
+metrics.Gauge('webhook_buffer_events', 'Accepted webhook events waiting to be committed to the inbox.',
+              collect=lambda: sum(buffer.stats()['buffered'] for buffer in list(_buffers)))
+metrics.Gauge('webhook_buffer_shedding', '1 while the webhook endpoint answers 503 to new events.',
+              collect=lambda: int(any(buffer.stats()['shedding'] for buffer in list(_buffers))))
@@ -0,0 +1,101 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db_utils
+import metrics
+from cache import TTLCache
+
+# Every database call made from the bot goes through this single thread. It owns one pooled
+# connection, keeps writes in submission order, and keeps disk I/O off the asyncio loop.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+_MISSING = object()
+
+
+async def run_db(func, *args, **kwargs):
+    """ Run a blocking db_utils function on the database thread and await its result """
+    loop = asyncio.get_running_loop()
+    histogram = metrics.DB_CALL_SECONDS.labels(_function_name(func, args))
+    return await loop.run_in_executor(_executor, _timed, histogram, functools.partial(func, *args, **kwargs))
+
+
+def run_db_blocking(func, *args, **kwargs):
+    """ run_db() for threads without an event loop, e.g. Flask's request threads, which would
+    otherwise each open (and on exit close) a connection of their own. Never call it on the
+    database thread itself. """
+    histogram = metrics.DB_CALL_SECONDS.labels(_function_name(func, args))
+    return _executor.submit(_timed, histogram, functools.partial(func, *args, **kwargs)).result()
+
+
+def _timed(histogram, call):
+    # Timed on the database thread, so the wait for the thread isn't counted as query time
+    started = time.perf_counter()
+    try:
+        return call()
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+def _function_name(func, args):
+    """ Name a database call for metrics, reporting a cache fill under its loader's name """
+    if isinstance(getattr(func, '__self__', None), TTLCache):
+        func = args[-1]
+    while isinstance(func, functools.partial):
+        func = func.func
+    return getattr(func, '__name__', 'unknown')
+
+
+async def create_tables():
+    """ Create the necessary tables if they don't exist """
+    return await run_db(db_utils.create_tables)
+
+
+async def save_stripe_account(discord_server_id, stripe_account_id):
+    """ Insert or update the Stripe account ID for a Discord server """
+    return await run_db(db_utils.save_stripe_account, discord_server_id, stripe_account_id)
+
+
+async def get_stripe_account(discord_server_id):
+    """Retrieve the Stripe account ID for a given Discord server ID."""
+    # Cache hits are answered right here on the loop, only misses go to the database thread.
+    # The result is cached on that thread too, so it can't land after a later write's invalidation.
+    cache = db_utils.stripe_account_cache
+    stripe_account_id = cache.get(discord_server_id, _MISSING)
+    if stripe_account_id is _MISSING:
+        loader = functools.partial(db_utils.load_stripe_account, discord_server_id)
+        stripe_account_id = await run_db(cache.load, discord_server_id, loader)
+    return stripe_account_id
+
+
+async def remove_stripe_account(discord_server_id):
+    """Remove the Stripe account connected to a Discord server."""
+    return await run_db(db_utils.remove_stripe_account, discord_server_id)
+
+
+async def save_plan(discord_server_id, plan_name, price_id, role_id=None):
+    """Save the plan name, its price_id and the role it grants to the database."""
+    return await run_db(db_utils.save_plan, discord_server_id, plan_name, price_id, role_id)
+
+
+async def get_price_id(discord_server_id, plan_name):
+    """Retrieve the price_id for a given plan name and server."""
+    cache = db_utils.price_id_cache
+    key = (discord_server_id, plan_name)
+    price_id = cache.get(key, _MISSING)
+    if price_id is _MISSING:
+        loader = functools.partial(db_utils.load_price_id, discord_server_id, plan_name)
+        price_id = await run_db(cache.load, key, loader)
+    return price_id
+
+
+async def load_routing_index():
+    """ Build the routing index from the servers and plans tables """
+    return await run_db(db_utils.load_routing_index)
+
+
+def shutdown():
+    """ Close the database thread's connection and stop the executor """
+    _executor.submit(db_utils.close_connections)
+    _executor.shutdown(wait=True)
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import async_db
+import db_utils
+
+SLOW_WRITE = 0.5  # Seconds the patched write blocks its thread
+TICK = 0.01
+
+
+def test_loop_keeps_ticking_during_slow_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_utils, 'DB_PATH', str(tmp_path / 'test.db'))
+    db_utils.close_connections()  # Connections opened on the old path are reopened on the new one
+    save_plan = db_utils.save_plan
+
+    def slow_save_plan(*args):
+        time.sleep(SLOW_WRITE)  # Stands in for a write stuck behind a busy disk
+        return save_plan(*args)
+
+    monkeypatch.setattr(db_utils, 'save_plan', slow_save_plan)
+
+    async def main():
+        await async_db.create_tables()
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(TICK)
+
+        task = asyncio.get_running_loop().create_task(ticker())
+        started = time.perf_counter()
+        await async_db.save_plan('1', 'gold', 'price_gold', '100')
+        elapsed = time.perf_counter() - started
+        task.cancel()
+        return ticks, elapsed
+
+    try:
+        ticks, elapsed = asyncio.run(main())
+        assert elapsed >= SLOW_WRITE
+        assert db_utils.load_price_id('1', 'gold') == 'price_gold'
+    finally:
+        db_utils.close_connections()
+
+    gaps = [later - earlier for earlier, later in zip(ticks, ticks[1:])]
+    # A write on the loop would leave one gap as long as the write and a handful of ticks
+    assert len(ticks) >= SLOW_WRITE / TICK / 2
+    assert max(gaps) < 0.1
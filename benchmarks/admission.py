@@ -0,0 +1,159 @@
+"""Benchmark of webhook admission control and per-account fairness in the inbox worker.
+
+Runs fully offline against a temporary database:
+- burst: `--burst` signed webhooks with `--concurrency` in flight against the ingress app, whose
+  database writes are slowed by `--write-delay` seconds per commit to stand in for a busy disk.
+  Reports accepted and 503 answers, the peak of the admission buffer and the commits used.
+- fairness: `--backlog` events of one connected account are stored ahead of a few events of
+  others. Reports how long the quiet accounts' events wait in the fair queue order with the
+  per-account limits, and in plain arrival order without them, while the handler takes
+  `--handler-delay` seconds per event.
+
+    python -m benchmarks.admission --burst 5000 --concurrency 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import aiohttp
+
+SECRET = 'whsec_benchmark'
+os.environ['STRIPE_WEBHOOK_SECRET'] = SECRET
+
+import async_db  # noqa: E402
+import db_utils  # noqa: E402
+import ingress  # noqa: E402
+import webhook_inbox  # noqa: E402
+from admission import AdmissionBuffer  # noqa: E402
+from webhook_verifier import WebhookVerifier, generate_signature_header  # noqa: E402
+
+
+def event_body(event_id, account, subscription_id):
+    return json.dumps({
+        'id': event_id,
+        'type': 'invoice.payment_succeeded',
+        'account': account,
+        'data': {'object': {'object': 'invoice', 'subscription': subscription_id}},
+    })
+
+
+async def run_burst(args):
+    buffer = AdmissionBuffer(args.high, args.low)
+    commits = []
+    peak = 0
+    run_db = async_db.run_db
+
+    async def slow_run_db(func, *func_args):
+        nonlocal peak
+        if func is webhook_inbox.enqueue_received:
+            peak = max(peak, buffer.stats()['buffered'])
+            commits.append(len(func_args[0]))
+            await asyncio.sleep(args.write_delay)
+        return await run_db(func, *func_args)
+
+    async_db.run_db = slow_run_db
+    runner = await ingress.start('127.0.0.1', args.port, WebhookVerifier([SECRET]), buffer=buffer)
+    statuses = {}
+    next_index = iter(range(args.burst))
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def client():
+                for index in next_index:
+                    body = event_body(f'evt_burst_{index}', f'acct_{index % 20}', f'sub_{index}').encode()
+                    headers = {'Stripe-Signature': generate_signature_header(body, SECRET)}
+                    async with session.post(f'http://127.0.0.1:{args.port}/stripe/webhook', data=body,
+                                            headers=headers) as response:
+                        await response.read()
+                        statuses[response.status] = statuses.get(response.status, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(client() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+        async_db.run_db = run_db
+    return statuses, peak, commits, elapsed
+
+
+async def run_fairness(args, fair):
+    backlog = [(f'evt_noisy_{index}', 'invoice.payment_succeeded', 'acct_noisy',
+                event_body(f'evt_noisy_{index}', 'acct_noisy', f'sub_noisy_{index}'), None)
+               for index in range(args.backlog)]
+    quiet = [(f'evt_quiet_{index}', 'invoice.payment_succeeded', f'acct_quiet_{index % 3}',
+              event_body(f'evt_quiet_{index}', f'acct_quiet_{index % 3}', f'sub_quiet_{index}'), None)
+             for index in range(args.quiet)]
+    await async_db.run_db(webhook_inbox.enqueue_received, backlog)
+    await async_db.run_db(webhook_inbox.enqueue_received, quiet)
+    if not fair:
+        await async_db.run_db(fifo_order)
+
+    finished = {}
+    all_done = asyncio.Event()
+
+    async def handler(event):
+        await asyncio.sleep(args.handler_delay)
+        finished[event['id']] = time.perf_counter()
+        if len(finished) == args.backlog + args.quiet:
+            all_done.set()
+
+    share = webhook_inbox.ACCOUNT_BATCH_SHARE
+    if not fair:
+        webhook_inbox.ACCOUNT_BATCH_SHARE = 1.0
+    worker = webhook_inbox.InboxWorker(handler, poll_interval=0.05,
+                                       account_concurrency=webhook_inbox.ACCOUNT_CONCURRENCY if fair else 4)
+    started = time.perf_counter()
+    worker.start()
+    try:
+        await asyncio.wait_for(all_done.wait(), 300)
+    finally:
+        await worker.stop()
+        webhook_inbox.ACCOUNT_BATCH_SHARE = share
+    quiet_done = max(finished[event_id] for event_id in finished if event_id.startswith('evt_quiet'))
+    return quiet_done - started, max(finished.values()) - started
+
+
+def fifo_order():
+    """Queue the stored events in arrival order, as before queue positions."""
+    connection = db_utils.get_db_connection()
+    connection.execute('UPDATE webhook_events SET queue_position = rowid')
+    connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--burst', type=int, default=5000, help="Webhooks posted at once")
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--high', type=int, default=200, help="High watermark of the admission buffer")
+    parser.add_argument('--low', type=int, default=100, help="Low watermark of the admission buffer")
+    parser.add_argument('--write-delay', type=float, default=0.05, help="Added seconds per inbox commit")
+    parser.add_argument('--backlog', type=int, default=2000, help="Events of the noisy account")
+    parser.add_argument('--quiet', type=int, default=9, help="Events of three quiet accounts, stored after the backlog")
+    parser.add_argument('--handler-delay', type=float, default=0.01, help="Seconds the handler takes per event")
+    parser.add_argument('--port', type=int, default=8791)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_utils.DB_PATH = os.path.join(directory, 'admission.db')
+        db_utils.create_tables()
+
+        statuses, peak, commits, elapsed = asyncio.run(run_burst(args))
+        print(f"burst     {args.burst} webhooks, {args.concurrency} in flight, watermarks {args.high}/{args.low}")
+        print(f"          200: {statuses.get(200, 0)}  503: {statuses.get(503, 0)}  peak buffered {peak}  "
+              f"{len(commits)} commits ({sum(commits) / max(1, len(commits)):.0f} events per commit)  {elapsed:.2f} s")
+
+        for fair in (False, True):
+            db_utils.get_db_connection().execute('DELETE FROM webhook_events')
+            db_utils.get_db_connection().commit()
+            quiet_done, all_done = asyncio.run(run_fairness(args, fair))
+            name = 'fair' if fair else 'fifo'
+            print(f"fairness  {name:<5} {args.quiet} quiet events done after {quiet_done:.2f} s, "
+                  f"the {args.backlog} event backlog after {all_done:.2f} s")
+        db_utils.close_connections()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Run the split deployment on one machine: ingress processes plus sharded gateway workers.
+
+Starts `--ingress` webhook ingress processes sharing one port and `--workers` gateway worker
+processes, each with an equal range of `--shards` shards, all on one temporary database. The
+workers run the real inbox worker and role scheduler against the fake Discord from
+benchmarks/pipeline.py holding only the guilds on their shards, so an event claimed by the
+wrong worker fails instead of applying. Reports throughput, end-to-end latency and how the
+events spread over the workers.
+
+    python -m benchmarks.cluster --events 2000 --ingress 2 --workers 4 --shards 8
+"""
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import statistics
+import tempfile
+import time
+
+import aiohttp
+
+import cluster
+import db_utils
+
+SECRET = 'whsec_benchmark'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_ingress(db_path, port):
+    import ingress  # Only here, so the workers' imports don't count against the ingress
+    db_utils.DB_PATH = db_path
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        ingress.serve('127.0.0.1', port, reuse_port=True)
+
+
+def run_gateway(db_path, shards, args, applied, stop):
+    # The bot reads its shards and poll interval when it is imported
+    os.environ['SHARD_IDS'] = ','.join(str(shard) for shard in shards.ids)
+    os.environ['SHARD_COUNT'] = str(shards.count)
+    os.environ['INBOX_POLL_INTERVAL'] = str(args.poll_interval)
+    import bot
+    from benchmarks import pipeline
+    from notifications import DMSender
+
+    db_utils.DB_PATH = db_path
+    db_utils.load_routing_index()
+
+    async def work():
+        discord_api = pipeline.FakeDiscord(args.guilds, args.discord_latency, 0, 0, random.Random(shards.ids[0]))
+        discord_api.guilds = {guild_id: guild for guild_id, guild in discord_api.guilds.items() if shards.owns(guild_id)}
+        record_applied = discord_api.record_applied
+
+        def report(user_id):
+            record_applied(user_id)
+            applied.put((user_id, shards.ids[0], time.time()))
+        discord_api.record_applied = report
+
+        bot.bot.loop = asyncio.get_running_loop()
+        bot.bot.get_guild = discord_api.get_guild
+        bot.bot.inbox_worker.concurrency = args.inbox_concurrency
+        bot.bot.inbox_worker.start()
+        if shards.primary:
+            bot.bot.dm_sender = DMSender(discord_api)
+            bot.bot.dm_sender.start()
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, stop.wait)
+        await bot.bot.inbox_worker.stop()
+        if shards.primary:
+            await bot.bot.dm_sender.stop()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(work())
+
+
+def worker_shards(workers, shard_count):
+    """Split shard ids 0..shard_count-1 into `workers` contiguous ranges."""
+    per_worker, extra = divmod(shard_count, workers)
+    ranges, first = [], 0
+    for index in range(workers):
+        size = per_worker + (1 if index < extra else 0)
+        ranges.append(cluster.Shards(list(range(first, first + size)), shard_count))
+        first += size
+    return ranges
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port), 0.5):
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+async def post_events(url, stripe_stand_in, total, rate, concurrency):
+    """POST `total` signed events, `rate` per second (0 for as fast as possible). Returns {user id: sent time}."""
+    sent_at = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    # A fresh connection per request, so the kernel spreads them over the ingress processes
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def post(index):
+            user_id, body, headers = stripe_stand_in.event(index)
+            async with semaphore:
+                sent_at[user_id] = time.time()
+                async with session.post(url, data=body, headers=headers) as response:
+                    await response.read()
+                    assert response.status == 200, response.status
+
+        tasks = []
+        started = time.perf_counter()
+        for index in range(total):
+            if rate:
+                delay = started + index / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(index)))
+        await asyncio.gather(*tasks)
+    return sent_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=0, help="Webhooks per second, 0 for as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=50, help="Webhook requests in flight at most")
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--ingress', type=int, default=2, help="Ingress processes")
+    parser.add_argument('--workers', type=int, default=2, help="Gateway worker processes")
+    parser.add_argument('--shards', type=int, default=4, help="Total shard count, split over the workers")
+    parser.add_argument('--discord-latency', type=float, default=0.02, help="Mean seconds per Discord call")
+    parser.add_argument('--inbox-concurrency', type=int, default=4, help="Events each worker handles at once")
+    parser.add_argument('--poll-interval', type=float, default=0.2, help="Seconds between the workers' inbox polls")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds to wait for roles after the last webhook")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.workers > args.shards:
+        parser.error("--workers can't exceed --shards")
+
+    os.environ['STRIPE_WEBHOOK_SECRET'] = SECRET
+    from benchmarks import pipeline
+    context = multiprocessing.get_context('spawn')
+    applied = context.Queue()
+    stop = context.Event()
+    shard_ranges = worker_shards(args.workers, args.shards)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'cluster.db')
+        db_utils.DB_PATH = db_path
+        db_utils.create_tables()
+        pipeline.setup_routes(args.guilds)
+        db_utils.close_connections()
+
+        processes = [context.Process(target=run_ingress, args=(db_path, args.port), daemon=True)
+                     for _ in range(args.ingress)]
+        processes += [context.Process(target=run_gateway, args=(db_path, shards, args, applied, stop))
+                      for shards in shard_ranges]
+        for process in processes:
+            process.start()
+        wait_for_port(args.port)
+
+        stripe_stand_in = pipeline.StripeStandIn(SECRET, args.guilds, 0.2, random.Random(args.seed))
+        started = time.time()
+        sent_at = asyncio.run(post_events(f'http://127.0.0.1:{args.port}/stripe/webhook', stripe_stand_in,
+                                          args.events, args.rate, args.concurrency))
+        acked = time.time()
+
+        results = {}  # user id -> (first shard of the worker that applied it, time)
+        duplicates = 0
+        deadline = time.monotonic() + args.timeout
+        while len(results) < args.events and time.monotonic() < deadline:
+            with contextlib.suppress(queue.Empty):
+                user_id, worker, applied_at = applied.get(timeout=1.0)
+                duplicates += user_id in results
+                results[user_id] = (worker, applied_at)
+        finished = time.time()
+
+        stop.set()
+        for process in processes:
+            if process.daemon:
+                process.terminate()
+            process.join()
+
+    end_to_end = [applied_at - sent_at[user_id] for user_id, (_, applied_at) in results.items()]
+    by_worker = {}
+    for worker, _ in results.values():
+        by_worker[worker] = by_worker.get(worker, 0) + 1
+
+    print(f"{args.events} events over {args.guilds} guilds, {args.ingress} ingress processes, "
+          f"{args.workers} workers on {args.shards} shards, Discord latency {args.discord_latency * 1000:.0f} ms")
+    print(f"ingress        {args.events} acknowledged in {acked - started:.2f} s "
+          f"({args.events / (acked - started):.0f} webhooks/s)")
+    print(f"completed      {len(results)}/{args.events} in {finished - started:.2f} s "
+          f"({len(results) / (finished - started):.0f} events/s), {duplicates} applied twice")
+    if end_to_end:
+        print(f"end to end     p50 {statistics.median(end_to_end) * 1000:8.1f} ms   "
+              f"p95 {percentile(end_to_end, 0.95) * 1000:8.1f} ms   "
+              f"p99 {percentile(end_to_end, 0.99) * 1000:8.1f} ms")
+    for shards in shard_ranges:
+        print(f"shards {shards.ids[0]}-{shards.ids[-1]:<7} {by_worker.get(shards.ids[0], 0)} events")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Load test comparing webhook throughput of the Flask thread and the aiohttp server.
+
+Runs fully offline against a temporary database:
+
+    python -m benchmarks.http_load --requests 5000 --concurrency 100
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import aiohttp
+from werkzeug.serving import make_server
+
+import bot
+import db_utils
+from webhook_verifier import WebhookVerifier, generate_signature_header
+
+SECRET = 'whsec_benchmark'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def webhook_body(server_name, index):
+    return json.dumps({
+        'id': f'evt_{server_name}_{index}',
+        'type': 'invoice.payment_succeeded',
+        'account': 'acct_bench',
+        'data': {'object': {'client_reference_id': str(index)}},
+    })
+
+
+async def drive(url, server_name, total, concurrency):
+    """POST `total` webhooks with `concurrency` in flight, return (elapsed seconds, latencies)."""
+    latencies = []
+    next_index = iter(range(total))
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def client():
+            for index in next_index:
+                body = webhook_body(server_name, index).encode()
+                headers = {'Stripe-Signature': generate_signature_header(body, SECRET)}
+                started = time.perf_counter()
+                async with session.post(url, data=body, headers=headers) as response:
+                    await response.read()
+                    assert response.status == 200, response.status
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies
+
+
+def run_flask_server(port):
+    server = make_server('127.0.0.1', port, bot.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+def run_aiohttp_server(port):
+    """Run the aiohttp server on its own loop in a thread, standing in for the bot's loop."""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    runner = None
+
+    def serve():
+        nonlocal runner
+        asyncio.set_event_loop(loop)
+        runner = loop.run_until_complete(bot.start_web_server('127.0.0.1', port))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    bot.webhook_verifier = WebhookVerifier([SECRET])
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_utils.DB_PATH = os.path.join(directory, 'bench.db')
+        db_utils.create_tables()
+
+        for server_name, start in (('flask', run_flask_server), ('aiohttp', run_aiohttp_server)):
+            # The route handlers print on every request, keep that out of the report
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                stop = start(args.port)
+                url = f'http://127.0.0.1:{args.port}/stripe/webhook'
+                results[server_name] = asyncio.run(drive(url, server_name, args.requests, args.concurrency))
+                stop()
+
+        db_utils.close_connections()
+
+    print(f"{args.requests} webhooks, {args.concurrency} concurrent clients")
+    print(f"{'server':<8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for server_name, (elapsed, latencies) in results.items():
+        print(f"{server_name:<8} {len(latencies) / elapsed:>9.0f} "
+              f"{statistics.median(latencies) * 1000:>8.2f} "
+              f"{percentile(latencies, 0.95) * 1000:>8.2f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Startup time and memory of full member chunking versus on-demand MemberResolver lookups.
+
+Builds real discord.py Member objects from gateway-shaped payloads, offline:
+
+    python -m benchmarks.member_cache --guilds 5 --members 50000 --subscribers 5000
+"""
+import argparse
+import asyncio
+import gc
+import random
+import time
+import tracemalloc
+
+import discord
+
+import member_resolver
+from member_resolver import MemberResolver
+
+EVERYONE_ROLE = {'id': '1', 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                 'hoist': False, 'managed': False, 'mentionable': False}
+
+
+def member_payload(user_id):
+    return {
+        'user': {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0',
+                 'avatar': None, 'global_name': None},
+        'roles': ['1'], 'joined_at': '2024-01-01T00:00:00+00:00',
+        'deaf': False, 'mute': False, 'flags': 0,
+    }
+
+
+def make_guilds(state, count):
+    return [discord.Guild(data={'id': str(guild_id), 'name': f'guild{guild_id}', 'roles': [EVERYONE_ROLE],
+                                'member_count': 0}, state=state)
+            for guild_id in range(1, count + 1)]
+
+
+class LazyGuild:
+    """Answers member lookups like the API would, building the Member only when asked."""
+
+    def __init__(self, guild, state):
+        self.guild = guild
+        self.id = guild.id
+        self.state = state
+        self.requests = 0
+
+    def get_member(self, user_id):
+        return None
+
+    async def fetch_member(self, user_id):
+        self.requests += 1
+        return discord.Member(data=member_payload(user_id), guild=self.guild, state=self.state)
+
+    async def query_members(self, user_ids, limit, cache):
+        self.requests += 1
+        return [discord.Member(data=member_payload(user_id), guild=self.guild, state=self.state) for user_id in user_ids]
+
+
+def measure(func):
+    gc.collect()
+    tracemalloc.start()
+    started = time.process_time()  # CPU time, so the resolver's batching window isn't counted
+    result = func()
+    elapsed = time.process_time() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, current, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--members', type=int, default=50000, help="Members per guild")
+    parser.add_argument('--subscribers', type=int, default=5000, help="Distinct members looked up by events")
+    parser.add_argument('--events', type=int, default=20000)
+    args = parser.parse_args()
+
+    state = discord.Client(intents=discord.Intents.default())._connection
+    rng = random.Random(0)
+
+    def chunk_everything():
+        # What login does with chunk_guilds_at_startup: every member of every guild, 1000 per chunk
+        guilds = make_guilds(state, args.guilds)
+        for guild in guilds:
+            for user_id in range(10**17, 10**17 + args.members):
+                guild._add_member(discord.Member(data=member_payload(user_id), guild=guild, state=state))
+        return guilds
+
+    chunk_time, chunk_memory, guilds = measure(chunk_everything)
+    del guilds
+
+    def resolve_on_demand():
+        lazy_guilds = [LazyGuild(guild, state) for guild in make_guilds(state, args.guilds)]
+        resolver = MemberResolver()
+        subscribers = [(rng.choice(lazy_guilds), 10**17 + rng.randrange(args.members))
+                       for _ in range(args.subscribers)]
+
+        async def handle_events():
+            # Events arrive in bursts, so lookups for one guild share a query
+            for start in range(0, args.events, 50):
+                await asyncio.gather(*(resolver.resolve(*rng.choice(subscribers)) for _ in range(50)))
+        asyncio.run(handle_events())
+        return resolver, lazy_guilds
+
+    lazy_time, lazy_memory, (resolver, lazy_guilds) = measure(resolve_on_demand)
+
+    total = args.guilds * args.members
+    print(f"{args.guilds} guilds x {args.members} members, {args.events} events from {args.subscribers} subscribers")
+    print(f"chunking at startup: {chunk_time:6.2f} s CPU before ready "
+          f"(plus {total // 1000} gateway chunk round-trips), {chunk_memory / 2**20:7.1f} MiB held")
+    print(f"lazy resolution:     {0:6.2f} s CPU before ready, {lazy_time:6.2f} s CPU of lookups spread over events, "
+          f"{lazy_memory / 2**20:7.1f} MiB held")
+    print(f"  {sum(guild.requests for guild in lazy_guilds)} lookup requests, "
+          f"member cache bounded at {member_resolver.MEMBER_CACHE_SIZE}, "
+          f"hit rate {resolver.members.stats()['hit_rate']:.0%}")
+
+
+if __name__ == '__main__':
+    main()
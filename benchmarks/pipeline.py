@@ -0,0 +1,393 @@
+"""End-to-end benchmark of the webhook pipeline, from webhook receipt to role applied.
+
+Runs fully offline: a Stripe stand-in signs invoice.payment_succeeded and
+customer.subscription.deleted events, they are posted to the bot's own webhook route, and the
+inbox worker, role scheduler and DM sender run against a fake Discord client that adds latency
+and injects 429s. Everything is seeded, so runs with the same arguments are comparable.
+
+    python -m benchmarks.pipeline --events 2000 --rate 200 --guilds 100
+    python -m benchmarks.pipeline --server flask --discord-latency 0.1 --rate-limit-ratio 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+import aiohttp
+import discord
+from werkzeug.serving import make_server
+
+import async_db
+import bot
+import db_utils
+import role_scheduler
+import webhook_inbox
+from notifications import DMSender
+from webhook_verifier import WebhookVerifier, generate_signature_header
+
+SECRET = 'whsec_benchmark'
+FIRST_GUILD_ID = 10_000
+FIRST_ROLE_ID = 20_000
+FIRST_USER_ID = 1_000_000
+
+
+def guild_id(index):
+    # Spaced like real snowflakes, whose low 22 bits don't decide the shard
+    return FIRST_GUILD_ID + (index << 22)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# -- Stripe stand-in --
+
+class StripeStandIn:
+    """Emits signed webhook bodies shaped like Stripe's for a set of connected accounts."""
+
+    def __init__(self, secret, guild_count, cancel_ratio, rng):
+        self.secret = secret
+        self.guild_count = guild_count
+        self.cancel_ratio = cancel_ratio
+        self.rng = rng
+
+    @staticmethod
+    def account(guild_index):
+        return f'acct_bench_{guild_index}'
+
+    @staticmethod
+    def price(guild_index):
+        return f'price_bench_{guild_index}'
+
+    def event(self, index):
+        """Return (user id, signed body, headers) for the index-th event, one subscriber per event."""
+        guild_index = self.rng.randrange(self.guild_count)
+        user_id = FIRST_USER_ID + index
+        metadata = {'discord_user_id': str(user_id)}
+        item = {'price': {'id': self.price(guild_index)}}
+
+        if self.rng.random() < self.cancel_ratio:
+            event_type = 'customer.subscription.deleted'
+            obj = {'object': 'subscription', 'id': f'sub_{index}', 'status': 'canceled',
+                   'items': {'data': [item]}, 'metadata': metadata}
+        else:
+            event_type = 'invoice.payment_succeeded'
+            obj = {'object': 'invoice', 'id': f'in_{index}', 'subscription': f'sub_{index}',
+                   'lines': {'data': [item]}, 'subscription_details': {'metadata': metadata}}
+
+        body = json.dumps({
+            'id': f'evt_bench_{index}',
+            'object': 'event',
+            'type': event_type,
+            'account': self.account(guild_index),
+            'created': int(time.time()),
+            'data': {'object': obj},
+        }).encode()
+        return user_id, body, {'Stripe-Signature': generate_signature_header(body, self.secret)}
+
+
+# -- Fake Discord --
+
+class FakeResponse:
+    status = 429
+    reason = 'Too Many Requests'
+
+    def __init__(self, retry_after):
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+class FakeDiscord:
+    """Stands in for the Discord API: adds latency to every call, injects 429s and records results."""
+
+    def __init__(self, guild_count, latency, rate_limit_ratio, retry_after, rng):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rng = rng
+        self.guilds = {guild_id(index): FakeGuild(self, index) for index in range(guild_count)}
+        self.applied = {}  # user id -> monotonic time the role change went through
+        self.applied_event = asyncio.Event()
+        self.dms = 0
+        self.calls = 0
+        self.rate_limited = 0
+
+    async def request(self, rate_limited=True):
+        self.calls += 1
+        # Jitter of +-50% keeps requests from finishing in lockstep
+        await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if rate_limited and self.rng.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            raise discord.HTTPException(FakeResponse(self.retry_after), 'You are being rate limited.')
+
+    def record_applied(self, user_id):
+        self.applied[user_id] = time.perf_counter()
+        self.applied_event.set()
+
+    # The parts of discord.Client the pipeline uses
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def get_user(self, user_id):
+        return FakeUser(self, user_id)
+
+    async def fetch_user(self, user_id):
+        await self.request(rate_limited=False)
+        return FakeUser(self, user_id)
+
+
+class FakeRole:
+    def __init__(self, role_id):
+        self.id = role_id
+        self.name = f'role{role_id}'
+
+    def is_default(self):
+        return False
+
+
+class FakeGuild:
+    def __init__(self, discord_api, index):
+        self.api = discord_api
+        self.id = guild_id(index)
+        self.name = f'guild{self.id}'
+        self.role = FakeRole(FIRST_ROLE_ID + index)
+
+    def get_role(self, role_id):
+        return self.role if role_id == self.role.id else None
+
+    def get_member(self, user_id):
+        return None  # Members are not chunked, as in production
+
+    async def fetch_member(self, user_id):
+        await self.api.request(rate_limited=False)
+        return FakeMember(self, user_id)
+
+    async def query_members(self, user_ids, limit, cache):
+        await self.api.request(rate_limited=False)
+        return [FakeMember(self, user_id) for user_id in user_ids]
+
+
+class FakeUser:
+    def __init__(self, discord_api, user_id):
+        self.api = discord_api
+        self.id = user_id
+        self.name = f'user{user_id}'
+
+    async def send(self, message):
+        await self.api.request()
+        self.api.dms += 1
+
+
+class FakeMember(FakeUser):
+    def __init__(self, guild, user_id):
+        super().__init__(guild.api, user_id)
+        self.guild = guild
+        self.roles = []
+
+    async def add_roles(self, *roles):
+        await self.api.request()
+        self.api.record_applied(self.id)
+
+    async def remove_roles(self, *roles):
+        await self.api.request()
+        self.api.record_applied(self.id)
+
+    async def edit(self, roles):
+        await self.api.request()
+        self.roles = roles
+        self.api.record_applied(self.id)
+        return self
+
+
+# -- DB timing --
+
+class DBTimer:
+    """Adds up the time spent inside database functions, wherever they run."""
+
+    def __init__(self):
+        self.durations = []
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.durations.append(time.perf_counter() - started)  # list.append is thread-safe
+        return timed
+
+    def install(self, flask_thread):
+        run_db = async_db.run_db
+
+        async def timed_run_db(func, *args, **kwargs):
+            return await run_db(self.wrap(func), *args, **kwargs)
+
+        async_db.run_db = timed_run_db
+        if flask_thread:
+            # The Flask route stores the event on its own thread instead of going through run_db
+            webhook_inbox.enqueue_event = self.wrap(webhook_inbox.enqueue_event)
+
+
+# -- Driver --
+
+def setup_routes(guild_count):
+    for index in range(guild_count):
+        discord_server_id = str(guild_id(index))
+        db_utils.save_stripe_account(discord_server_id, StripeStandIn.account(index))
+        db_utils.save_plan(discord_server_id, f'plan{index}', StripeStandIn.price(index), str(FIRST_ROLE_ID + index))
+
+
+def start_flask_server(port):
+    server = make_server('127.0.0.1', port, bot.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    async def stop():
+        await asyncio.get_running_loop().run_in_executor(None, server.shutdown)
+    return stop
+
+
+async def start_aiohttp_server(port):
+    runner = await bot.start_web_server('127.0.0.1', port)
+    return runner.cleanup
+
+
+async def post_events(url, stripe_stand_in, total, rate, concurrency):
+    """POST `total` events, `rate` per second (0 for as fast as possible). Returns (sent times, ack latencies)."""
+    sent_at = {}
+    acks = []
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def post(index):
+            user_id, body, headers = stripe_stand_in.event(index)
+            async with semaphore:
+                started = time.perf_counter()
+                sent_at[user_id] = started
+                async with session.post(url, data=body, headers=headers) as response:
+                    await response.read()
+                    assert response.status == 200, response.status
+                acks.append(time.perf_counter() - started)
+
+        tasks = []
+        started = time.perf_counter()
+        for index in range(total):
+            if rate:
+                # Open loop: keep to the schedule whether or not earlier requests have finished
+                delay = started + index / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(index)))
+        await asyncio.gather(*tasks)
+
+    return sent_at, acks
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    discord_api = FakeDiscord(args.guilds, args.discord_latency, args.rate_limit_ratio, args.retry_after, rng)
+    stripe_stand_in = StripeStandIn(SECRET, args.guilds, args.cancel_ratio, rng)
+
+    # Point the bot's pipeline at the fakes, the workers are the real ones
+    bot.bot.loop = asyncio.get_running_loop()
+    bot.bot.get_guild = discord_api.get_guild
+    bot.bot.dm_sender = DMSender(discord_api)
+    bot.bot.inbox_worker.start()
+    bot.bot.dm_sender.start()
+
+    if args.server == 'flask':
+        stop_server = start_flask_server(args.port)
+    else:
+        stop_server = await start_aiohttp_server(args.port)
+    url = f'http://127.0.0.1:{args.port}/stripe/webhook'
+
+    started = time.perf_counter()
+    sent_at, acks = await post_events(url, stripe_stand_in, args.events, args.rate, args.concurrency)
+
+    deadline = time.perf_counter() + args.timeout
+    while len(discord_api.applied) < args.events and time.perf_counter() < deadline:
+        discord_api.applied_event.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(discord_api.applied_event.wait(), 1.0)
+    finished = time.perf_counter()
+
+    await stop_server()
+    await bot.bot.inbox_worker.stop()
+    await bot.bot.dm_sender.stop()
+
+    end_to_end = [applied - sent_at[user_id] for user_id, applied in discord_api.applied.items()]
+    return {
+        'elapsed': finished - started,
+        'acks': acks,
+        'end_to_end': end_to_end,
+        'discord': discord_api,
+        'scheduler': bot.bot.role_scheduler.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=200, help="Webhooks per second, 0 for as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=50, help="Webhook requests in flight at most")
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--cancel-ratio', type=float, default=0.2, help="Share of events that are cancellations")
+    parser.add_argument('--discord-latency', type=float, default=0.05, help="Mean seconds per Discord call")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.01, help="Share of role/DM calls answered with a 429")
+    parser.add_argument('--retry-after', type=float, default=0.5, help="Retry-After sent with injected 429s")
+    parser.add_argument('--role-edit-rate', type=float, default=role_scheduler.ROLE_EDIT_RATE,
+                        help="Role edits per second per guild (the scheduler's pacing)")
+    parser.add_argument('--inbox-concurrency', type=int, default=bot.bot.inbox_worker.concurrency,
+                        help="Events the inbox worker handles at once")
+    parser.add_argument('--server', choices=('aiohttp', 'flask'), default='aiohttp')
+    parser.add_argument('--port', type=int, default=5098)
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds to wait for roles after the last webhook")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    bot.webhook_verifier = WebhookVerifier([SECRET])
+    role_scheduler.ROLE_EDIT_RATE = args.role_edit_rate
+    bot.bot.inbox_worker.concurrency = args.inbox_concurrency
+    db_timer = DBTimer()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_utils.DB_PATH = os.path.join(directory, 'bench.db')
+        db_utils.create_tables()
+        setup_routes(args.guilds)
+        db_timer.install(flask_thread=args.server == 'flask')
+
+        # The pipeline prints on every event, keep that out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(run(args))
+        db_utils.close_connections()
+
+    acks, end_to_end = results['acks'], results['end_to_end']
+    discord_api, scheduler = results['discord'], results['scheduler']
+    db_time = sum(db_timer.durations)
+
+    print(f"{args.events} events at {args.rate or 'max'}/s over {args.guilds} guilds via {args.server}, "
+          f"Discord latency {args.discord_latency * 1000:.0f} ms, {args.rate_limit_ratio:.1%} 429s")
+    print(f"completed      {len(end_to_end)}/{args.events} in {results['elapsed']:.2f} s "
+          f"({len(end_to_end) / results['elapsed']:.0f} events/s)")
+    for name, values in (('webhook ack', acks), ('end to end', end_to_end)):
+        if values:
+            print(f"{name:<14} p50 {statistics.median(values) * 1000:8.1f} ms   "
+                  f"p95 {percentile(values, 0.95) * 1000:8.1f} ms   "
+                  f"p99 {percentile(values, 0.99) * 1000:8.1f} ms")
+    print(f"db time        {db_time * 1000:.0f} ms in {len(db_timer.durations)} calls "
+          f"({db_time / max(1, args.events) * 1000:.3f} ms per event, "
+          f"p99 call {percentile(db_timer.durations, 0.99) * 1000 if db_timer.durations else 0:.2f} ms)")
+    print(f"discord        {discord_api.calls} calls, {discord_api.rate_limited} 429s injected, "
+          f"{scheduler['coalesced']} changes coalesced, {discord_api.dms} DMs delivered")
+
+
+if __name__ == '__main__':
+    main()
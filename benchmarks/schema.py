@@ -0,0 +1,101 @@
+"""Lookup cost on a large database before and after the schema migrations.
+
+Builds a database at the unversioned baseline schema, fills it, times the hot lookups, migrates
+it to the latest version and times them again:
+
+    python -m benchmarks.schema --plans 100000 --users 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import db_utils
+import migrations
+
+
+def populate_baseline(connection, servers, plans):
+    connection.executemany('INSERT INTO servers (discord_server_id, stripe_account_id) VALUES (?, ?)',
+                           [(str(server), f'acct_{server}') for server in range(servers)])
+    connection.executemany('INSERT INTO plans (discord_server_id, plan_name, price_id, role_id) VALUES (?, ?, ?, ?)',
+                           [(str(index % servers), f'plan{index}', f'price_{index}', str(index)) for index in range(plans)])
+    connection.commit()
+
+
+def populate_subscriptions(connection, servers, users):
+    now = time.time()
+    connection.executemany('''
+        INSERT INTO subscriptions (stripe_subscription_id, stripe_customer_id, discord_server_id,
+                                   discord_user_id, price_id, status, updated_at)
+        VALUES (?, ?, ?, ?, ?, 'active', ?)
+    ''', [(f'sub_{user}', f'cus_{user}', str(user % servers), str(user), f'price_{user}', now) for user in range(users)])
+    connection.commit()
+
+
+def timed(lookups, func):
+    """Median and p99 microseconds of `lookups` calls."""
+    durations = []
+    for _ in range(lookups):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    return statistics.median(durations) * 1e6, durations[int(len(durations) * 0.99)] * 1e6
+
+
+def time_lookups(args, rng):
+    def price_lookup():
+        index = rng.randrange(args.plans)
+        db_utils.load_price_id(str(index % args.servers), f'plan{index}')
+
+    return {
+        'get_price_id': timed(args.lookups, price_lookup),
+        'get_stripe_account': timed(args.lookups, lambda: db_utils.load_stripe_account(str(rng.randrange(args.servers)))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--servers', type=int, default=10000)
+    parser.add_argument('--plans', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=100000, help="Subscribers in the subscriptions table")
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_utils.DB_PATH = os.path.join(directory, 'bench.db')
+        connection = db_utils.get_db_connection()
+        migrations.migrate(connection, target=1)
+        populate_baseline(connection, args.servers, args.plans)
+        before = time_lookups(args, rng)
+
+        started = time.perf_counter()
+        migrations.migrate(connection)
+        migration_time = time.perf_counter() - started
+        after = time_lookups(args, rng)
+
+        populate_subscriptions(connection, args.servers, args.users)
+
+        def member_lookup():
+            # A subscriber, as the reconciler looks them up before revoking a role
+            user = rng.randrange(args.users)
+            db_utils.get_member_subscriptions(str(user % args.servers), str(user))
+
+        member = timed(args.lookups, member_lookup)
+        db_utils.close_connections()
+
+    print(f"{args.plans} plans over {args.servers} servers, "
+          f"migrated to version {migrations.LATEST_VERSION} in {migration_time:.2f} s")
+    print(f"{'query':<24} {'before p50 us':>14} {'p99':>10} {'after p50 us':>14} {'p99':>10}")
+    for name in before:
+        print(f"{name:<24} {before[name][0]:>14.1f} {before[name][1]:>10.1f} {after[name][0]:>14.1f} {after[name][1]:>10.1f}")
+    print(f"{'get_member_subscriptions':<24} {'-':>14} {'-':>10} {member[0]:>14.1f} {member[1]:>10.1f}"
+          f"   ({args.users} subscriptions)")
+
+
+if __name__ == '__main__':
+    main()
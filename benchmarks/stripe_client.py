@@ -0,0 +1,176 @@
+"""Connection reuse and retry behaviour of the Stripe client, against a local Stripe stand-in.
+
+The stand-in speaks enough of the Stripe API for Price.create. It counts the TCP connections
+it accepts and creates one object per Idempotency-Key, replaying the stored response for a
+repeated key as Stripe does. `--failure-ratio` of first attempts lose their response with a 500
+after the object was created. The same workload runs with the SDK's stock client (a session per
+thread, no retries) and with stripe_gateway's pooled client:
+- `--calls` creates on the Stripe pool threads
+- as many again from short-lived threads, one per call, the way Flask's threaded server calls
+  Stripe from its request threads
+
+    python -m benchmarks.stripe_client --calls 500 --failure-ratio 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+import metrics
+import stripe_gateway
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like api.stripe.com
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        key = self.headers.get('Idempotency-Key')
+        body, replayed = self.server.create(key)
+        if not replayed and self.server.should_fail():
+            # The object exists, but the client never hears about it
+            self.respond(500, {'error': {'type': 'api_error', 'message': 'Injected failure'}})
+        else:
+            self.respond(200, body)
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Request-Id', f'req_{time.monotonic_ns()}')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StripeStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, failure_ratio, seed):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.failure_ratio = failure_ratio
+        self.rng = random.Random(seed)
+        self.counts = {'connections': 0, 'requests': 0, 'created': 0, 'replayed': 0}
+        self.by_key = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def should_fail(self):
+        with self.lock:
+            return self.rng.random() < self.failure_ratio
+
+    def create(self, key):
+        with self.lock:
+            self.counts['requests'] += 1
+            if key is not None and key in self.by_key:
+                self.counts['replayed'] += 1
+                return self.by_key[key], True
+            self.counts['created'] += 1
+            body = {'id': f"price_{self.counts['created']}", 'object': 'price', 'unit_amount': 500, 'currency': 'usd'}
+            if key is not None:
+                self.by_key[key] = body
+            return body, False
+
+
+def create_price(index):
+    return stripe.Price.create(unit_amount=500, currency='usd', recurring={'interval': 'month'},
+                               product_data={'name': f'plan{index}'}, stripe_account=f'acct_bench_{index % 10}')
+
+
+async def run_pool_calls(calls):
+    failures = 0
+    results = await asyncio.gather(*(stripe_gateway.call(create_price, index) for index in range(calls)),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            failures += 1
+    return failures
+
+
+def run_thread_calls(calls, concurrency):
+    """One short-lived thread per call, at most `concurrency` at a time."""
+    failures = []
+    slots = threading.Semaphore(concurrency)
+
+    def one(index):
+        try:
+            create_price(index)
+        except stripe.error.StripeError:
+            failures.append(index)
+        finally:
+            slots.release()
+
+    threads = []
+    for index in range(calls):
+        slots.acquire()
+        thread = threading.Thread(target=one, args=(index,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return len(failures)
+
+
+def run_mode(name, args):
+    stand_in = StripeStandIn(args.failure_ratio, args.seed)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    stripe.api_base = stand_in.url
+    stripe.api_key = 'sk_test_benchmark'
+
+    if name == 'pooled':
+        stripe_gateway.configure()
+    else:
+        stripe.default_http_client = stripe.RequestsClient()
+        stripe.max_network_retries = 0
+
+    started = time.perf_counter()
+    failures = asyncio.run(run_pool_calls(args.calls))
+    failures += run_thread_calls(args.calls, args.thread_concurrency)
+    elapsed = time.perf_counter() - started
+
+    stand_in.shutdown()
+    stand_in.server_close()
+    return dict(stand_in.counts, failures=failures, elapsed=elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=500, help="Creates per workload (pool threads, short-lived threads)")
+    parser.add_argument('--thread-concurrency', type=int, default=8, help="Short-lived threads running at once")
+    parser.add_argument('--failure-ratio', type=float, default=0.02, help="Share of first attempts that lose their response")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    total = args.calls * 2
+    print(f"{total} Price.create calls, {args.failure_ratio:.0%} of first attempts answered with a 500 after creating")
+    print(f"{'client':<8} {'connections':>11} {'requests':>9} {'created':>8} {'replayed':>9} {'failed':>7} {'seconds':>8}")
+    for name in ('stock', 'pooled'):
+        result = run_mode(name, args)
+        print(f"{name:<8} {result['connections']:>11} {result['requests']:>9} {result['created']:>8} "
+              f"{result['replayed']:>9} {result['failures']:>7} {result['elapsed']:>8.2f}")
+
+    accounts = {values[0] for values in metrics.STRIPE_ACCOUNT_REQUESTS._children}
+    print(f"accounting     {len(accounts)} connected accounts in stripe_account_requests_total")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark of the grace period timers with a large number of pending timers.
+
+Fills a temporary database with `--pending` timers spread over the next `--days` days plus
+`--due` that are already due, as after downtime. Then it measures:
+- the startup load
+- schedule and cancel latency with the scheduler running
+- how long the overdue timers take to fire
+
+    python -m benchmarks.timers --pending 300000 --due 5000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import db_utils
+import grace_timers
+from grace_timers import GraceTimers
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def fill(pending, due, days, rng):
+    now = time.time()
+    rows = [(f'sub_{index}', str(rng.randrange(1, 1000) << 22), str(index), '1,2',
+             now + rng.uniform(60, days * 86400), now) for index in range(pending)]
+    rows += [(f'sub_due_{index}', str(rng.randrange(1, 1000) << 22), str(index), '1',
+              now - rng.uniform(0, 3600), now) for index in range(due)]
+    with db_utils.batch() as connection:
+        connection.executemany('''
+            INSERT INTO grace_timers
+                (stripe_subscription_id, discord_server_id, discord_user_id, role_ids, due_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+
+async def run(args, rng):
+    fired = []
+    all_fired = asyncio.Event()
+
+    async def on_due(timer):
+        fired.append(timer['stripe_subscription_id'])
+        if len(fired) >= args.due:
+            all_fired.set()
+
+    timers = GraceTimers(on_due)
+    started = time.perf_counter()
+    timers.start()
+    await asyncio.wait_for(all_fired.wait(), args.timeout)
+    fire_time = time.perf_counter() - started
+    while timers.stats()['loaded_until'] < time.time():
+        await asyncio.sleep(0.01)  # Let the last batch finish
+    await asyncio.sleep(0.1)
+
+    schedule_latencies, cancel_latencies = [], []
+    for index in range(args.operations):
+        subscription_id = f'sub_new_{index}'
+        t = time.perf_counter()
+        await timers.schedule(subscription_id, 1 << 22, index, [1], rng.uniform(1, 86400))
+        schedule_latencies.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        await timers.cancel(subscription_id)
+        cancel_latencies.append(time.perf_counter() - t)
+
+    stats = timers.stats()
+    await timers.stop()
+    return fire_time, len(fired), schedule_latencies, cancel_latencies, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pending', type=int, default=300000, help="Timers due over the next --days days")
+    parser.add_argument('--due', type=int, default=5000, help="Timers already due at startup")
+    parser.add_argument('--days', type=float, default=grace_timers.GRACE_PERIOD_DAYS)
+    parser.add_argument('--operations', type=int, default=2000, help="Schedule/cancel pairs to time")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_utils.DB_PATH = os.path.join(directory, 'timers.db')
+        db_utils.create_tables()
+        fill(args.pending, args.due, args.days, rng)
+
+        t = time.perf_counter()
+        rows = db_utils.get_db_connection().execute('SELECT * FROM grace_timers WHERE due_at <= ? LIMIT ?',
+                                                    (time.time() + grace_timers.LOOKAHEAD, grace_timers.MAX_LOADED)).fetchall()
+        window_query = time.perf_counter() - t
+
+        fire_time, fired, schedules, cancels, stats = asyncio.run(run(args, rng))
+        remaining = grace_timers.count_timers()
+        db_utils.close_connections()
+
+    print(f"{args.pending} pending timers over {args.days:g} days, {args.due} overdue at startup")
+    print(f"lookahead load {window_query * 1000:.1f} ms for {len(rows)} timers due within {grace_timers.LOOKAHEAD:.0f} s")
+    print(f"overdue fired  {fired} in {fire_time:.2f} s ({fired / fire_time:.0f}/s)")
+    for name, values in (('schedule', schedules), ('cancel', cancels)):
+        print(f"{name:<14} p50 {statistics.median(values) * 1e6:7.0f} us   p99 {percentile(values, 0.99) * 1e6:7.0f} us")
+    print(f"in memory      {stats['loaded']} heap entries, {remaining} timers left in the table")
+
+
+if __name__ == '__main__':
+    main()
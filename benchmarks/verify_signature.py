@@ -0,0 +1,72 @@
+"""Microbenchmark of webhook signature verification cost per request.
+
+    python -m benchmarks.verify_signature --iterations 20000
+"""
+import argparse
+import json
+import time
+
+import stripe
+
+from webhook_verifier import WebhookVerifier, SignatureVerificationError, generate_signature_header
+
+
+def payload_of_size(size):
+    """An invoice.payment_succeeded event padded to roughly `size` bytes."""
+    event = {
+        'id': 'evt_bench',
+        'type': 'invoice.payment_succeeded',
+        'account': 'acct_bench',
+        'data': {'object': {'client_reference_id': '1234', 'lines': {'data': []}, 'padding': ''}},
+    }
+    event['data']['object']['padding'] = 'x' * max(0, size - len(json.dumps(event)))
+    return json.dumps(event).encode()
+
+
+def time_per_call(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def expect_rejection(verifier, payload, header):
+    def call():
+        try:
+            verifier.verify(payload, header)
+        except SignatureVerificationError:
+            return
+        raise AssertionError("forged request was accepted")
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=4096, help="Payload size in bytes")
+    args = parser.parse_args()
+
+    secrets = ['whsec_primary', 'whsec_rotating', 'whsec_connect']
+    payload = payload_of_size(args.size)
+    valid = generate_signature_header(payload, secrets[0])
+    forged = generate_signature_header(payload, 'whsec_attacker')
+    replayed = generate_signature_header(payload, secrets[0], timestamp=int(time.time()) - 3600)
+
+    single = WebhookVerifier(secrets[:1])
+    rotating = WebhookVerifier(secrets)
+    # A forged signature is checked against every secret, so it is also the worst case for a valid one
+    cases = [
+        ("valid, 1 secret", lambda: single.verify(payload, valid)),
+        ("valid, 3 secrets", lambda: rotating.verify(payload, valid)),
+        ("forged, 3 secrets", expect_rejection(rotating, payload, forged)),
+        ("replayed, 3 secrets", expect_rejection(WebhookVerifier(secrets), payload, replayed)),
+        ("stripe.Webhook.construct_event", lambda: stripe.Webhook.construct_event(payload.decode(), valid, secrets[0])),
+    ]
+
+    print(f"{len(payload)} byte payload, {args.iterations} iterations")
+    for name, func in cases:
+        print(f"{name:<32} {time_per_call(func, args.iterations):>8.2f} us/request")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-import json
+import io
 import os
 import discord
 from discord.ext import commands
@@ -7,9 +7,32 @@ from flask import Flask, session, redirect, request
 import threading
 from dotenv import load_dotenv
 import stripe
-from db_utils import create_tables, save_stripe_account, get_stripe_account, get_price_id, save_plan, \
-    get_db_connection  # Import database functions
+import db_utils
+from db_utils import create_tables, save_stripe_account, load_routing_index, routing_index, plan_name_index  # Import database functions
+import routing  # Maps Stripe events to the guilds and roles they apply to
+import async_db  # Awaitable database functions for use on the bot's event loop
+import stripe_gateway  # Stripe calls that run off the bot's event loop
+import webhook_inbox  # Durable store for incoming Stripe webhook events
+from admission import AdmissionBuffer, BufferFullError, throttled_reply  # Bounds webhooks waiting to be stored
+import ingress  # Webhook verification shared with the standalone ingress processes
+from ingress import HANDLED_EVENT_TYPES, CHECKOUT_SESSION_EVENT_TYPES
+import cluster  # Shard ranges when running as one of several gateway workers
+from webhook_verifier import WebhookVerifier
+from oauth_state import OAuthStateSigner, InvalidStateError  # Signed state for the Stripe Connect flow
+from role_scheduler import RoleScheduler  # Paced, coalescing queue for role changes
+from reconcile import Reconciler  # Brings guild roles back in line with Stripe subscriptions
+from catchup import CatchUp  # Fetches events missed during downtime from the Stripe Events API
+from retention import RetentionSweeper  # Trims processed webhook events and sent DMs
+from member_resolver import MemberResolver  # On-demand member lookups instead of startup chunking
+import notifications  # Outbox-backed, rate-paced DM delivery
+import grace_timers  # Durable role revocation after failed payments
+from grace_timers import GraceTimers, GRACE_PERIOD_DAYS
+from command_sync import CommandSync  # Syncs slash commands only when they changed
+import plan_import  # Bulk plan creation from CSV/JSON
+import metrics  # Prometheus metrics served on /metrics
 import asyncio
+import time
+from aiohttp import web
 
 
 # Load environment variables from .env
@@ -17,46 +40,171 @@ load_dotenv()
 
 # Stripe API key and client ID
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+stripe_gateway.configure()  # Pooled keep-alive connections and retries for every Stripe call
 CLIENT_ID = os.getenv('STRIPE_CLIENT_ID')
-webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
+webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')  # Comma-separated to accept several secrets during rotation
+
+# Checks Stripe-Signature on every webhook before its body is parsed
+webhook_verifier = WebhookVerifier.from_env_value(webhook_secret, int(os.getenv('STRIPE_WEBHOOK_TOLERANCE', '300')))
+if not webhook_verifier.configured:
+    print("Warning: STRIPE_WEBHOOK_SECRET is not set, all webhooks will be rejected.")
+
+# Which HTTP server serves the OAuth and webhook routes: 'flask' runs Flask's server on its own
+# thread, 'aiohttp' serves the same routes from the bot's event loop, 'none' serves nothing (a
+# gateway worker behind separate ingress processes, see cluster.py)
+HTTP_SERVER = os.getenv('HTTP_SERVER', 'flask')
+HTTP_HOST = os.getenv('HTTP_HOST', '127.0.0.1')
+HTTP_PORT = int(os.getenv('HTTP_PORT', '5000'))
+
+# Run a full Stripe/Discord reconciliation at startup. Otherwise only interrupted runs are resumed.
+RECONCILE_ON_STARTUP = os.getenv('RECONCILE_ON_STARTUP', '0') == '1'
+
+# How often to page the Stripe Events API for events whose webhooks never reached us (seconds)
+CATCHUP_INTERVAL = float(os.getenv('CATCHUP_INTERVAL', '600'))
+
+# Shards this process runs (SHARD_IDS/SHARD_COUNT), None to run all of them in this process
+SHARDS = cluster.shards_from_env()
+
+# How often the inbox worker checks for new events when nothing woke it (seconds). Events stored
+# by separate ingress processes are only found this way.
+INBOX_POLL_INTERVAL = float(os.getenv('INBOX_POLL_INTERVAL', '1.0'))
+
+# Other processes write servers and plans too (the OAuth callback on another worker,
+# plan_import.py), so an event that routes nowhere reloads the routing index at most this often
+ROUTING_RELOAD_INTERVAL = float(os.getenv('ROUTING_RELOAD_INTERVAL', '5'))
 
 # Intents allow your bot to listen to events like member updates
 intents = discord.Intents.default()
 intents.members = True
 
+# Members are looked up on demand by MemberResolver. Set MEMBER_CHUNKING=1 to go back to
+# downloading and caching every guild's full member list at login.
+MEMBER_CHUNKING = os.getenv('MEMBER_CHUNKING', '0') == '1'
+
+# Webhook events accepted by this process's HTTP routes but not yet in the inbox
+webhook_buffer = AdmissionBuffer()
+
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'supersecretkey')
 
-# Shared in-memory storage for simplicity (use a database for production)
-discord_server_ids = {}
+# Where users reach the /connect route, for the links /connect_stripe hands out
+PUBLIC_URL = os.getenv('PUBLIC_URL', 'http://localhost:5000').rstrip('/')
+
+# Signs the OAuth state that carries the guild and user through Stripe Connect. Every process
+# serving /connect or /oauth/callback needs the same secret.
+oauth_state_secret = os.getenv('OAUTH_STATE_SECRET') or os.getenv('FLASK_SECRET_KEY')
+if not oauth_state_secret:
+    print("Warning: OAUTH_STATE_SECRET is not set, /connect_stripe links only work on this process.")
+oauth_states = OAuthStateSigner(oauth_state_secret or os.urandom(32).hex())
 
 
 # Initialize the Discord bot class
-class MyBot(commands.Bot):
+class MyBot(commands.AutoShardedBot):
     def __init__(self):
         super().__init__(command_prefix="!",
-                         intents=intents)  # command_prefix is required but unused for slash commands
+                         intents=intents,  # command_prefix is required but unused for slash commands
+                         chunk_guilds_at_startup=MEMBER_CHUNKING,
+                         member_cache_flags=discord.MemberCacheFlags.from_intents(intents) if MEMBER_CHUNKING
+                         else discord.MemberCacheFlags.none(),
+                         # Without SHARDS discord.py picks Discord's recommended shard count
+                         shard_ids=SHARDS.ids if SHARDS else None,
+                         shard_count=SHARDS.count if SHARDS else None)
+        self.member_resolver = MemberResolver()
+        self.inbox_worker = webhook_inbox.InboxWorker(lambda event: process_event(event),  # Defined below
+                                                      poll_interval=INBOX_POLL_INTERVAL, shards=SHARDS)
+        self.role_scheduler = RoleScheduler(self.member_resolver)
+        self.reconciler = Reconciler(self, self.role_scheduler, SHARDS)
+        self.catch_up = CatchUp(HANDLED_EVENT_TYPES, self.inbox_worker.notify, CATCHUP_INTERVAL)
+        self.dm_sender = notifications.DMSender(self)
+        self.grace_timers = GraceTimers(lambda timer: revoke_after_grace_period(timer), SHARDS)  # Defined below
+        self.command_sync = CommandSync(self)
+        self.retention = RetentionSweeper()
+
+        self.web_runner = None
 
     async def setup_hook(self):
-        # Sync commands to the Discord API
-        guild = discord.Object(id=1239876742064246926)  # Replace with your server's guild ID for quicker syncing
-        await bot.tree.sync(guild=guild)
-        print(f"Slash commands synced for guild: {1239876742064246926}")
+        # Start draining the webhook inbox and reconciling roles once the guild cache is ready
+        self.loop.create_task(self.start_inbox_worker())
+        self.loop.create_task(self.run_startup_reconciliation())
+        self.loop.create_task(self.sync_commands())
+
+        # Serve the HTTP routes from this loop instead of the Flask thread
+        if HTTP_SERVER == 'aiohttp':
+            self.web_runner = await start_web_server(HTTP_HOST, HTTP_PORT)
+            print(f"aiohttp server listening on {HTTP_HOST}:{HTTP_PORT}")
 
     async def on_ready(self):
+        # Fires again on every reconnect, so nothing expensive belongs here
         print(f'Logged in as {bot.user}')
+
+    async def on_guild_join(self, guild):
+        await self.command_sync.sync([guild])
+
+    async def sync_commands(self):
+        # Once per process, and only where the command tree's hash differs from the last sync
+        await self.wait_until_ready()
         try:
-            guild = discord.Object(id=1239876742064246926)
-            await bot.tree.sync(guild=guild)  # Sync the commands for the specific guild
-            print(f"Slash commands synced successfully for guild: {1239876742064246926}")
+            await self.command_sync.sync()
         except Exception as e:
             print(f"Error syncing commands: {e}")
 
+    async def on_raw_member_remove(self, payload):
+        self.member_resolver.forget(payload.guild_id, payload.user.id)
+
+    async def on_member_join(self, member):
+        # They may have been looked up and found missing just before joining, e.g. paid first
+        self.member_resolver.remember(member)
+
+    async def start_inbox_worker(self):
+        await self.wait_until_ready()
+        self.inbox_worker.start()
+        self.grace_timers.start()
+        if SHARDS is not None and not SHARDS.primary:
+            return  # DMs and the catch-up aren't tied to a guild, the shard 0 worker runs them
+
+        self.dm_sender.start()
+
+        # Pull in anything missed while we were down, then keep checking periodically
+        self.catch_up.start()
+        self.retention.start()
+
+    async def run_startup_reconciliation(self):
+        await self.wait_until_ready()
+        await self.reconciler.reconcile_all(resume_only=not RECONCILE_ON_STARTUP)
+
+    async def close(self):
+        if self.web_runner is not None:
+            await self.web_runner.cleanup()
+        await super().close()
+
 
 # Initialize the bot object
 bot = MyBot()
 
+# Gauges are read when /metrics is scraped, so they cost nothing between scrapes
+metrics.Gauge('webhook_inbox_events', 'Stored webhook events by status.', ['status'],
+              collect=lambda: {(status,): total for status, total in webhook_inbox.count_by_status().items()})
+metrics.Gauge('dm_outbox_messages', 'Queued DMs by status.', ['status'],
+              collect=lambda: {(status,): total for status, total in notifications.count_by_status().items()})
+metrics.Gauge('role_queue_members', 'Members with role changes waiting in the scheduler.',
+              collect=lambda: bot.role_scheduler.stats()['queued'])
+metrics.Gauge('role_queue_guilds', 'Guilds with role changes waiting in the scheduler.',
+              collect=lambda: bot.role_scheduler.stats()['guilds'])
+metrics.Gauge('grace_period_timers', 'Pending role revocations after failed payments.',
+              collect=grace_timers.count_timers)
+
+
+def cache_stats():
+    return db_utils.cache_stats() + [bot.member_resolver.members.stats(), bot.member_resolver.absent.stats(),
+                                     stripe_gateway.checkout_session_cache.stats()]
+
+
+metrics.Gauge('cache_hit_ratio', 'Hit rate of the in-process caches since startup.', ['cache'],
+              collect=lambda: {(stats['name'],): stats['hit_rate'] for stats in cache_stats()})
+metrics.Gauge('cache_entries', 'Entries currently held by the in-process caches.', ['cache'],
+              collect=lambda: {(stats['name'],): stats['size'] for stats in cache_stats()})
+
 
 # Flask route for testing
 @app.route('/')
@@ -67,20 +215,41 @@ def home():
 # Flask route for starting OAuth
 @app.route('/connect')
 def connect():
-    # Retrieve the discord_server_id from in-memory storage
-    discord_server_id = discord_server_ids.get('discord_server_id')
+    state = request.args.get('state')
+    try:
+        oauth_states.verify(state)
+    except InvalidStateError as e:
+        return f"Error: {e}", 400
 
-    if discord_server_id is None:
-        return "Error: Discord server ID is missing", 400
+    # Redirect to Stripe OAuth authorization, Stripe hands the state back to the callback
+    return redirect(oauth_authorize_url(state))
 
-    # Redirect to Stripe OAuth authorization
-    return redirect(
-        f'https://connect.stripe.com/oauth/authorize?response_type=code&client_id={CLIENT_ID}&scope=read_write')
+
+def oauth_authorize_url(state):
+    """Stripe Connect authorization URL for this platform."""
+    return (f'https://connect.stripe.com/oauth/authorize?response_type=code&client_id={CLIENT_ID}'
+            f'&scope=read_write&state={state}')
+
+
+def redeem_oauth_state(args):
+    """The guild id a callback's signed state was issued for. Returns (discord_server_id, None) or (None, error)."""
+    if args.get('error'):
+        return None, f"Error: {args.get('error_description') or args.get('error')}"
+    try:
+        discord_server_id, _ = oauth_states.consume(args.get('state'))
+    except InvalidStateError as e:
+        return None, f"Error: {e}"
+    return discord_server_id, None
 
 
 # **OAuth Callback Route**
 @app.route('/oauth/callback')
 def oauth_callback():
+    # The signed state says which guild this is, checked before the code is spent
+    discord_server_id, error = redeem_oauth_state(request.args)
+    if discord_server_id is None:
+        return error, 400
+
     # Get the authorization code from the query parameters
     code = request.args.get('code')
 
@@ -97,14 +266,8 @@ def oauth_callback():
         # Retrieve the connected Stripe account ID
         stripe_account_id = token_response['stripe_user_id']
 
-        # Retrieve the Discord server ID from in-memory storage (or session/database)
-        discord_server_id = discord_server_ids.get('discord_server_id')
-
-        if discord_server_id is None:
-            return "Error: Discord server ID is missing", 400
-
-        # Save the stripe_account_id and discord_server_id to the database
-        save_stripe_account(discord_server_id, stripe_account_id)
+        # Save the stripe_account_id and discord_server_id to the database, on the pooled database thread
+        async_db.run_db_blocking(save_stripe_account, discord_server_id, stripe_account_id)
 
         return f"Success! Connected Stripe Account ID: {stripe_account_id} for Discord Server ID: {discord_server_id}"
 
@@ -119,59 +282,63 @@ async def connect_stripe(interaction: discord.Interaction):
     discord_server_id = str(interaction.guild.id)  # Fetch the server's unique ID
 
     # Retrieve the Stripe account ID from the database
-    stripe_account_id = get_stripe_account(discord_server_id)
+    stripe_account_id = await async_db.get_stripe_account(discord_server_id)
 
     if stripe_account_id:
         await interaction.response.send_message(f"Error: A Stripe account is already connected for this server. Use `/remove_stripe_account` to remove it.", ephemeral=True)
         return
 
-    # Store the discord_server_id in memory (replace with database for production)
-    discord_server_ids['discord_server_id'] = discord_server_id
+    # The link carries the guild in a signed, expiring state, so any number of guilds can onboard at once
+    state = oauth_states.issue(discord_server_id, interaction.user.id)
 
     # Provide a link for the user to initiate the OAuth flow
-    await interaction.response.send_message(f"Click the link to connect Stripe: http://localhost:5000/connect")
+    await interaction.response.send_message(f"Click the link to connect Stripe: {PUBLIC_URL}/connect?state={state}", ephemeral=True)
 
 
 
 # **New slash command to create a subscription plan**
 # **Modified create_plan command**
 @bot.tree.command(name="create_plan")
-@app_commands.describe(plan_name="Name of the subscription plan", price="Price of the subscription in USD")
-async def create_plan(interaction: discord.Interaction, plan_name: str, price: float):
+@app_commands.describe(plan_name="Name of the subscription plan", price="Price of the subscription in USD",
+                       role="Role granted to subscribers of this plan")
+async def create_plan(interaction: discord.Interaction, plan_name: str, price: float, role: discord.Role):
     """Slash command to create a subscription plan for the server."""
     discord_server_id = str(interaction.guild.id)  # Fetch the server's unique ID
 
-    # Retrieve the Stripe account ID from the database
-    stripe_account_id = get_stripe_account(discord_server_id)
+    # Retrieve the Stripe account ID and any plan already using this name
+    stripe_account_id, existing_price_id = await asyncio.gather(
+        async_db.get_stripe_account(discord_server_id),
+        async_db.get_price_id(discord_server_id, plan_name),
+    )
 
     if stripe_account_id is None:
         await interaction.response.send_message("Error: No Stripe account connected for this server.", ephemeral=True)
         return
 
-    try:
-        # Create a Stripe product (representing the plan)
-        product = stripe.Product.create(
-            name=plan_name,
-            stripe_account=stripe_account_id
-        )
+    # Plan names are unique per server, check before creating a price that couldn't be saved
+    if existing_price_id is not None:
+        await interaction.response.send_message(f"Error: A plan named '{plan_name}' already exists.", ephemeral=True)
+        return
 
-        # Create a Stripe price (representing the recurring subscription)
-        price_object = stripe.Price.create(
-            unit_amount=int(price * 100),  # Stripe expects the amount in cents
-            currency='usd',
-            recurring={"interval": "month"},  # Set to monthly subscription
-            product=product.id,
-            stripe_account=stripe_account_id
+    # Stripe can take longer than Discord's 3-second deadline, so acknowledge the command first
+    await interaction.response.defer(thinking=True)
+
+    try:
+        # Create the Stripe product and its recurring monthly price (representing the plan)
+        price_object = await stripe_gateway.create_recurring_price(
+            plan_name,
+            int(price * 100),  # Stripe expects the amount in cents
+            stripe_account_id
         )
 
         # Save the plan and price ID to the database
-        save_plan(discord_server_id, plan_name, price_object.id)
+        await async_db.save_plan(discord_server_id, plan_name, price_object.id, str(role.id))
 
         # Respond to the user with the success message
-        await interaction.response.send_message(f"Plan '{plan_name}' created with a price of ${price:.2f}/month.\nPrice ID: {price_object.id}")
+        await interaction.followup.send(f"Plan '{plan_name}' created with a price of ${price:.2f}/month, granting the {role.name} role.\nPrice ID: {price_object.id}")
 
     except stripe.error.StripeError as e:
-        await interaction.response.send_message(f"Error creating the plan: {str(e)}", ephemeral=True)
+        await interaction.followup.send(f"Error creating the plan: {str(e)}")
 
 
 # **New slash command to subscribe to a plan**
@@ -181,40 +348,48 @@ async def subscribe(interaction: discord.Interaction, plan_name: str):
     """Slash command to subscribe to a specific plan."""
     discord_server_id = str(interaction.guild.id)  # Fetch the server's unique ID
 
-    # Retrieve the Stripe account ID from the database
-    stripe_account_id = get_stripe_account(discord_server_id)
+    # Acknowledge the command while the Stripe account and Price ID are looked up together
+    _, stripe_account_id, price_id = await asyncio.gather(
+        interaction.response.defer(ephemeral=True, thinking=True),
+        async_db.get_stripe_account(discord_server_id),
+        async_db.get_price_id(discord_server_id, plan_name)
+    )
 
     if stripe_account_id is None:
-        await interaction.response.send_message("Error: No Stripe account connected for this server.", ephemeral=True)
+        await interaction.followup.send("Error: No Stripe account connected for this server.", ephemeral=True)
         return
 
-    # Retrieve the Price ID based on the plan name
-    price_id = get_price_id(discord_server_id, plan_name)
-
     if price_id is None:
-        await interaction.response.send_message(f"Error: No plan named '{plan_name}' was found.", ephemeral=True)
+        await interaction.followup.send(f"Error: No plan named '{plan_name}' was found.", ephemeral=True)
         return
 
     try:
-        # Create a checkout session for the user to subscribe to the plan
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price': price_id,
-                'quantity': 1,
-            }],
-            mode='subscription',
-            success_url='https://yourdomain.com/success',
-            cancel_url='https://yourdomain.com/cancel',
-            client_reference_id=str(interaction.user.id),  # Save the Discord user ID as a reference
-            stripe_account=stripe_account_id
-        )
+        # Reuse the user's still-open checkout session for this plan, or create one
+        session = await stripe_gateway.get_or_create_checkout_session(price_id, interaction.user.id, discord_server_id, stripe_account_id)
 
         # Send the checkout URL to the user
-        await interaction.response.send_message(f"Click the link to subscribe: {session.url}", ephemeral=True)
+        await interaction.followup.send(f"Click the link to subscribe: {session.url}", ephemeral=True)
 
     except stripe.error.StripeError as e:
-        await interaction.response.send_message(f"Error creating checkout session: {str(e)}", ephemeral=True)
+        await interaction.followup.send(f"Error creating checkout session: {str(e)}", ephemeral=True)
+
+
+@subscribe.autocomplete('plan_name')
+async def plan_name_autocomplete(interaction: discord.Interaction, current: str):
+    # Answered from memory on every keystroke, no database query
+    names = plan_name_index.complete(str(interaction.guild_id), current)
+    return [app_commands.Choice(name=name, value=name) for name in names]
+
+
+# **Slash command for members who reopened their DMs**
+@bot.tree.command(name="enable_dms")
+async def enable_dms(interaction: discord.Interaction):
+    """Slash command to receive the bot's DMs again after they failed because DMs were closed."""
+    # Only messages queued from now on are sent, the skipped ones are not retried
+    if await async_db.run_db(notifications.unblock_user, interaction.user.id):
+        await interaction.response.send_message("You will receive subscription messages by DM again.", ephemeral=True)
+    else:
+        await interaction.response.send_message("Your DMs from this bot are already enabled.", ephemeral=True)
 
 
 # **New slash command to remove the connected Stripe account**
@@ -224,114 +399,460 @@ async def remove_stripe_account(interaction: discord.Interaction):
     discord_server_id = str(interaction.guild.id)  # Fetch the server's unique ID
 
     # Retrieve the Stripe account ID from the database
-    stripe_account_id = get_stripe_account(discord_server_id)
+    stripe_account_id = await async_db.get_stripe_account(discord_server_id)
 
     if not stripe_account_id:
         await interaction.response.send_message("Error: No Stripe account is connected for this server.", ephemeral=True)
         return
 
     # Remove the Stripe account for this server
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute('DELETE FROM servers WHERE discord_server_id = ?', (discord_server_id,))
-    connection.commit()
-    connection.close()
+    await async_db.remove_stripe_account(discord_server_id)
 
     await interaction.response.send_message("Stripe account has been removed. You can now connect a new Stripe account.")
 
 
-# Function to run Flask in a separate thread
-def run_flask():
-    # Create the necessary database tables
-    create_tables()
+# **Admin slash command to bring roles back in line with Stripe**
+@bot.tree.command(name="resync")
+@app_commands.default_permissions(administrator=True)
+async def resync(interaction: discord.Interaction):
+    """Slash command to reconcile subscriber roles with the server's Stripe subscriptions."""
+    discord_server_id = str(interaction.guild.id)  # Fetch the server's unique ID
 
-    # Run Flask
-    app.run(port=5000, debug=False)
+    # Retrieve the Stripe account ID from the database
+    stripe_account_id = await async_db.get_stripe_account(discord_server_id)
 
+    if stripe_account_id is None:
+        await interaction.response.send_message("Error: No Stripe account connected for this server.", ephemeral=True)
+        return
 
-def handle_payment_failure(data):
-    """Handle failed payment events."""
-    discord_user_id = data.get('client_reference_id')
+    # A resync streams every subscription and member, so answer through a followup
+    await interaction.response.defer(ephemeral=True, thinking=True)
 
-    if discord_user_id:
-        user = bot.get_user(int(discord_user_id))
-        # Optionally, notify the user about the failed payment
-        print(f"Payment failed for user: {user.name}.")
+    try:
+        stats = await bot.reconciler.reconcile_guild(discord_server_id, stripe_account_id)
+        await interaction.followup.send(
+            f"Resync complete: checked {stats['subscriptions']} subscriptions and {stats['members']} members, "
+            f"granted {stats['granted']} and removed {stats['revoked']} roles.", ephemeral=True)
+    except (RuntimeError, stripe.error.StripeError, discord.HTTPException) as e:
+        await interaction.followup.send(f"Error during resync: {str(e)}", ephemeral=True)
+
+
+# **Slash command to create many plans from a CSV or JSON file**
+@bot.tree.command(name="import_plans")
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(file="CSV or JSON with plan_name, price, role_id and optional currency and interval")
+async def import_plans(interaction: discord.Interaction, file: discord.Attachment):
+    """Slash command to create several subscription plans at once."""
+    discord_server_id = str(interaction.guild.id)  # Fetch the server's unique ID
+
+    stripe_account_id = await async_db.get_stripe_account(discord_server_id)
+
+    if stripe_account_id is None:
+        await interaction.response.send_message("Error: No Stripe account connected for this server.", ephemeral=True)
+        return
+
+    if file.size > 256 * 1024:
+        await interaction.response.send_message("Error: The file is too large.", ephemeral=True)
+        return
+
+    # Creating dozens of prices takes a while, so answer through a followup
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    try:
+        rows, rejected = plan_import.parse_rows(await file.read(), file.filename)
+    except (ValueError, UnicodeDecodeError) as e:
+        await interaction.followup.send(f"Error reading {file.filename}: {str(e)}", ephemeral=True)
+        return
+
+    role_ids = {str(role.id) for role in interaction.guild.roles}
+    results = rejected + await plan_import.import_plans(discord_server_id, stripe_account_id, rows, role_ids)
+
+    # The per-row report goes back as a file, it can be longer than a message allows
+    report = discord.File(io.BytesIO(plan_import.format_results(results).encode()), filename='import_results.csv')
+    await interaction.followup.send(f"Plan import finished: {plan_import.summarize(results)}.", file=report, ephemeral=True)
+
+
+# Function to run Flask in a separate thread
+def run_flask():
+    # Run Flask
+    app.run(host=HTTP_HOST, port=HTTP_PORT, debug=False)
 
 
 # Flask route to handle Stripe webhooks
 @app.route('/stripe/webhook', methods=['POST'])
+@metrics.timed(metrics.WEBHOOK_REQUEST_SECONDS.labels('flask'))
 def stripe_webhook():
     print("Webhook received!")
-    payload = request.get_data(as_text=True)
+    payload = request.get_data()
     sig_header = request.headers.get('Stripe-Signature')
 
+    event, reply = accept_webhook(payload, sig_header)
+    if event is None:
+        return reply
+
+    # Persist the event and acknowledge right away, the bot's inbox worker does the Discord work.
+    # Stripe retries of an event we already stored are acknowledged without queueing it again.
+    try:
+        stored = webhook_buffer.store_blocking(event['id'], event['type'], event.get('account'), payload.decode(),
+                                               routing.discord_server_id(event['data']['object']))
+    except BufferFullError as e:
+        return throttled_reply(event, e)
+    if stored:
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'queued').inc()
+        notify_inbox_worker()
+    else:
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'duplicate').inc()
+
+    return "Success", 200
+
+
+# Flask route for Prometheus
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+def accept_webhook(payload, sig_header):
+    """Decide whether a raw webhook body should be stored. Returns (event, None) or (None, (body, status))."""
+    event, reply = ingress.parse_webhook(webhook_verifier, payload, sig_header)
+    if event is None:
+        return None, reply
+
+    if event['type'] in CHECKOUT_SESSION_EVENT_TYPES:
+        # The session can't be reused any more, a later /subscribe should create a new one
+        stripe_gateway.forget_checkout_session(event['data']['object'])
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'processed').inc()
+        return None, ("Success", 200)
+
+    if event['type'] not in HANDLED_EVENT_TYPES:
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'ignored').inc()
+        return None, ("Success", 200)
+
+    return event, None
+
+
+def notify_inbox_worker():
+    """Wake the inbox worker on the bot's loop from the Flask thread."""
     try:
-        # Directly parse the payload without checking the signature
-        event = json.loads(payload)
-        print(f"Received event: {event['type']}")
-    except ValueError:
-        return "Invalid payload", 400
+        bot.loop.call_soon_threadsafe(bot.inbox_worker.notify)
+    except (AttributeError, RuntimeError):
+        pass  # The bot is not running yet, the worker will find the event when it starts
+
+
+# aiohttp versions of the Flask routes, used when HTTP_SERVER=aiohttp. They run on the bot's
+# loop, so the inbox worker is notified directly and blocking work goes to the db/Stripe pools.
+async def aio_home(request):
+    return web.Response(text='aiohttp is running!')
+
+
+async def aio_connect(request):
+    state = request.query.get('state')
+    try:
+        oauth_states.verify(state)
+    except InvalidStateError as e:
+        return web.Response(text=f"Error: {e}", status=400)
+
+    # Redirect to Stripe OAuth authorization
+    raise web.HTTPFound(oauth_authorize_url(state))
+
+
+async def aio_oauth_callback(request):
+    discord_server_id, error = redeem_oauth_state(request.query)
+    if discord_server_id is None:
+        return web.Response(text=error, status=400)
+
+    code = request.query.get('code')
+
+    if code is None:
+        return web.Response(text="Error: No code provided", status=400)
+
+    try:
+        # Exchange the authorization code for an access token
+        token_response = await stripe_gateway.exchange_oauth_code(code)
+        stripe_account_id = token_response['stripe_user_id']
+
+        await async_db.save_stripe_account(discord_server_id, stripe_account_id)
+
+        return web.Response(text=f"Success! Connected Stripe Account ID: {stripe_account_id} for Discord Server ID: {discord_server_id}")
+
+    except stripe.error.StripeError as e:
+        return web.Response(text=f"Error exchanging code: {str(e)}", status=500)
+
+
+@metrics.timed(metrics.WEBHOOK_REQUEST_SECONDS.labels('aiohttp'))
+async def aio_stripe_webhook(request):
+    print("Webhook received!")
+    payload = await request.read()
+    sig_header = request.headers.get('Stripe-Signature')
+
+    event, reply = accept_webhook(payload, sig_header)
+    if event is None:
+        return web.Response(text=reply[0], status=reply[1])
+
+    try:
+        stored = await webhook_buffer.store(event['id'], event['type'], event.get('account'), payload.decode(),
+                                            routing.discord_server_id(event['data']['object']))
+    except BufferFullError as e:
+        body, status, headers = throttled_reply(event, e)
+        return web.Response(text=body, status=status, headers=headers)
+    if stored:
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'queued').inc()
+        bot.inbox_worker.notify()
+    else:
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'duplicate').inc()
+
+    return web.Response(text="Success")
+
+
+async def aio_metrics(request):
+    # Rendering runs the gauges' database queries, so it happens on the database thread
+    body = await async_db.run_db(metrics.render)
+    return web.Response(body=body.encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def create_web_app():
+    """Build the aiohttp application with the same routes as the Flask app."""
+    web_app = web.Application()
+    web_app.add_routes([
+        web.get('/', aio_home),
+        web.get('/connect', aio_connect),
+        web.get('/oauth/callback', aio_oauth_callback),
+        web.post('/stripe/webhook', aio_stripe_webhook),
+        web.get('/metrics', aio_metrics),
+    ])
+    return web_app
+
+
+async def start_web_server(host, port):
+    """Serve create_web_app() on the running loop and return its runner for cleanup."""
+    # Stripe and browsers reuse connections, so keep idle ones open and allow a deep accept queue
+    runner = web.AppRunner(create_web_app(), access_log=None, keepalive_timeout=75)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, backlog=1024)
+    await site.start()
+    return runner
+
+
+async def process_event(event):
+    """Apply a stored Stripe event, called by the inbox worker."""
+    if event['type'] in CHECKOUT_SESSION_EVENT_TYPES:
+        # Stored by a separate ingress process, this worker holds the cached session
+        stripe_gateway.forget_checkout_session(event['data']['object'])
+        return
+
+    # Find the guilds and roles this event's account and prices map to
+    routes = await route_event(event)
+    if not routes:
+        print(f"No plan found for event {event['id']} from account {event.get('account')}")
+        return
+    if SHARDS is not None:
+        owned = [route for route in routes if SHARDS.owns(route.guild_id)]
+        if not owned:
+            # Hand it to the worker running the guild instead of dropping it here
+            raise webhook_inbox.NotOwnedError(routes[0].guild_id)
+        if len(owned) < len(routes):
+            print(f"Event {event['id']} also applies to guilds of other workers, applying it to ours only")
+        routes = owned
+
+    if not await record_subscription(event, routes):
+        # E.g. a failed payment redelivered after the payment that fixed it
+        print(f"Skipping event {event['id']}, a newer event for its subscription was already applied")
+        return
 
-    # Process Stripe events asynchronously
     if event['type'] == 'invoice.payment_succeeded':
         print("Processing payment success...")
-        bot.loop.create_task(handle_payment_success(event['data']['object']))
+        await handle_payment_success(event['data']['object'], routes)
+    elif event['type'] == 'invoice.payment_failed':
+        print("Processing payment failure...")
+        await handle_payment_failure(event['data']['object'], routes)
     elif event['type'] == 'customer.subscription.deleted':
         print("Processing subscription cancellation...")
-        bot.loop.create_task(handle_subscription_cancellation(event['data']['object']))
+        await handle_subscription_cancellation(event['data']['object'], routes)
+
+
+_routing_reloaded_at = 0.0
+
+
+async def route_event(event):
+    """routing_index.route(), reloading the index first if the event matches nothing in it."""
+    global _routing_reloaded_at
+    routes = routing_index.route(event)
+    if not routes and time.monotonic() - _routing_reloaded_at >= ROUTING_RELOAD_INTERVAL:
+        _routing_reloaded_at = time.monotonic()
+        await async_db.load_routing_index()
+        routes = routing_index.route(event)
+    return routes
+
+
+async def record_subscription(event, routes):
+    """Keep the subscriptions table up to date with the subscription an event is about.
+
+    Returns False if the event is older than one already recorded for the subscription.
+    """
+    obj = event['data']['object']
+    subscription_id = routing.subscription_id(obj)
+    if not subscription_id:
+        return True
+
+    # A paid invoice means the subscription is active again, deletions carry the final status
+    if obj.get('object') == 'subscription':
+        status = obj.get('status')
+    else:
+        status = 'past_due' if event['type'] == 'invoice.payment_failed' else 'active'
+    prices = routing.price_ids(obj)
+    current = True
+    for guild_id in {route.guild_id for route in routes}:
+        current &= await async_db.run_db(
+            db_utils.save_subscription, subscription_id, guild_id, status,
+            stripe_customer_id=obj.get('customer'),
+            stripe_account_id=event.get('account'),
+            discord_user_id=routing.discord_user_id(obj),
+            price_id=prices[0] if prices else None,
+            event_created=event.get('created'),
+        )
+    return current
+
+
+def resolve_routes(routes):
+    """Group routes by guild and look up the guild and role objects, skipping any that are gone."""
+    roles_by_guild = {}
+    for route in routes:
+        roles_by_guild.setdefault(route.guild_id, []).append(route.role_id)
+
+    for guild_id, role_ids in roles_by_guild.items():
+        guild = bot.get_guild(int(guild_id))
+        if guild is None:
+            print(f"Guild {guild_id} not found")
+            continue
+        roles = [role for role in (guild.get_role(int(role_id)) for role_id in role_ids) if role]
+        yield guild, roles
 
-    return "Success", 200
 
 # Function to handle successful payments and assign roles
-async def handle_payment_success(data):
+async def handle_payment_success(data, routes):
     print("Handling payment success...")
-    discord_user_id = data.get('client_reference_id')
+    discord_user_id = routing.discord_user_id(data)
+
+    # Paid within the grace period of an earlier failure, the roles stay
+    subscription_id = routing.subscription_id(data)
+    if subscription_id and await bot.grace_timers.cancel(subscription_id):
+        print(f"Payment recovered for subscription {subscription_id}, grace period cancelled.")
 
     if discord_user_id:
         print(f"User ID: {discord_user_id}")
-        user = bot.get_user(int(discord_user_id))
-        guild = bot.get_guild(1239876742064246926)  # Replace with your guild ID
-        role = guild.get_role(1281580865935114292)  # Replace with your subscriber role ID
-        if user and role:
-            member = guild.get_member(user.id)
-            if member:
-                await member.add_roles(role)
-                print(f"Assigned role {role.name} to {user.name}.")
-                await user.send(f"Thank you for subscribing! You've been assigned the {role.name} role in {guild.name}.")
+        missing = []
+        for guild, roles in resolve_routes(routes):
+            if roles:
+                # Fetched on demand, members are not chunked into the cache at startup
+                member = await bot.member_resolver.resolve(guild, int(discord_user_id))
+                if member:
+                    # Always granted, adding a role the member holds changes nothing. Only the DM
+                    # is skipped for roles they had, e.g. on a retry for another guild's missing member.
+                    new_roles = [role for role in roles if role not in member.roles]
+                    await bot.role_scheduler.submit(guild, member.id, add=roles)
+                    role_names = ', '.join(role.name for role in roles)
+                    print(f"Assigned role {role_names} to {member.name}.")
+                    if new_roles:
+                        new_names = ', '.join(role.name for role in new_roles)
+                        await bot.dm_sender.send(member.id, f"Thank you for subscribing! You've been assigned the {new_names} role in {guild.name}.")
+                else:
+                    missing.append(guild.name)
             else:
-                print(f"Member not found for user {user.name}")
-        else:
-            print(f"User or role not found for ID {discord_user_id}")
+                print(f"Role not found for ID {discord_user_id} in {guild.name}")
+        if missing:
+            # Often a subscriber who paid before joining, the inbox retries with backoff
+            raise RuntimeError(f"Member not found for user ID {discord_user_id} in {', '.join(missing)}")
+
+# Function to handle failed payments: the roles go when the grace period runs out
+async def handle_payment_failure(data, routes):
+    print("Handling payment failure...")
+    discord_user_id = routing.discord_user_id(data)
+    subscription_id = routing.subscription_id(data)
+
+    if subscription_id and await async_db.run_db(db_utils.load_subscription_status, subscription_id) == 'revoked':
+        print(f"Subscription {subscription_id} already lost its roles after an earlier grace period.")
+        return
+
+    if discord_user_id and subscription_id:
+        print(f"User ID: {discord_user_id}")
+        for guild, roles in resolve_routes(routes):
+            if roles:
+                started = await bot.grace_timers.schedule(subscription_id, guild.id, discord_user_id,
+                                                          [role.id for role in roles], GRACE_PERIOD_DAYS * 86400)
+                if started:
+                    role_names = ', '.join(role.name for role in roles)
+                    print(f"Payment failed, {role_names} will be removed from {discord_user_id} in {GRACE_PERIOD_DAYS:g} days.")
+                    await bot.dm_sender.send(int(discord_user_id), f"Your payment failed. Please update your payment method within {GRACE_PERIOD_DAYS:g} days to keep the {role_names} role in {guild.name}.")
+            else:
+                print(f"Role not found for ID {discord_user_id} in {guild.name}")
+
+
+async def revoke_after_grace_period(timer):
+    """Remove the roles of a subscriber whose payment didn't recover in time, called by the grace timers."""
+    guild = bot.get_guild(int(timer['discord_server_id']))
+    if guild is None:
+        print(f"Guild {timer['discord_server_id']} not found")
+        return
+    roles = [role for role in (guild.get_role(int(role_id)) for role_id in timer['role_ids'].split(',')) if role]
+    member = await bot.member_resolver.resolve(guild, int(timer['discord_user_id']))
+    if member and roles:
+        await bot.role_scheduler.submit(guild, member.id, remove=roles)
+        role_names = ', '.join(role.name for role in roles)
+        print(f"Grace period ended, removed role {role_names} from {member.name}.")
+        await bot.dm_sender.send(member.id, f"Your payment didn't go through in time, and the {role_names} role has been removed in {guild.name}.")
+    # Stripe still reports the subscription as past_due, a resync must not hand the roles back
+    await async_db.run_db(db_utils.mark_subscription_revoked, timer['stripe_subscription_id'])
+
 
 # Function to handle subscription cancellation and remove roles
-async def handle_subscription_cancellation(data):
+async def handle_subscription_cancellation(data, routes):
     print("Handling subscription cancellation...")
-    discord_user_id = data.get('client_reference_id')
+    discord_user_id = routing.discord_user_id(data)
+
+    # The roles go now, the grace period has nothing left to do
+    subscription_id = routing.subscription_id(data)
+    if subscription_id:
+        await bot.grace_timers.cancel(subscription_id)
 
     if discord_user_id:
         print(f"User ID: {discord_user_id}")
-        user = bot.get_user(int(discord_user_id))
-        guild = bot.get_guild(1239876742064246926)  # Replace with your guild ID
-        role = guild.get_role(1281580865935114292)  # Replace with your subscriber role ID
-        if user and role:
-            member = guild.get_member(user.id)
-            if member:
-                await member.remove_roles(role)
-                print(f"Removed role {role.name} from {user.name}.")
-                await user.send(f"Your subscription has been canceled, and the {role.name} role has been removed in {guild.name}.")
+        for guild, roles in resolve_routes(routes):
+            if roles:
+                # Fetched on demand, members are not chunked into the cache at startup
+                member = await bot.member_resolver.resolve(guild, int(discord_user_id))
+                if member:
+                    await bot.role_scheduler.submit(guild, member.id, remove=roles)
+                    role_names = ', '.join(role.name for role in roles)
+                    print(f"Removed role {role_names} from {member.name}.")
+                    await bot.dm_sender.send(member.id, f"Your subscription has been canceled, and the {role_names} role has been removed in {guild.name}.")
+                else:
+                    print(f"Member not found for user ID {discord_user_id} in {guild.name}")
             else:
-                print(f"Member not found for user {user.name}")
-        else:
-            print(f"User or role not found for ID {discord_user_id}")
+                print(f"Role not found for ID {discord_user_id} in {guild.name}")
 
 
 # Run both the Flask app and the Discord bot
 
-if __name__ == "__main__":
-    # Start Flask app in a separate thread
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.start()
+def main():
+    # Create the necessary database tables and load the event routing index
+    create_tables()
+    load_routing_index()
+
+    # Start Flask app in a separate thread (the aiohttp server is started by the bot instead). It
+    # has no shutdown hook, so it is a daemon thread that ends with the bot.
+    if HTTP_SERVER == 'flask':
+        flask_thread = threading.Thread(target=run_flask, daemon=True)
+        flask_thread.start()
 
     # Run the Discord bot (this runs on the main thread)
-    bot.run(os.getenv('DISCORD_TOKEN'))
+    try:
+        bot.run(os.getenv('DISCORD_TOKEN'))
+    finally:
+        # Let in-flight Stripe calls and database writes finish, then close the pooled connections
+        stripe_gateway.shutdown()
+        async_db.shutdown()
+        db_utils.close_connections()
+
+
+if __name__ == "__main__":
+    main()
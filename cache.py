@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """ A thread-safe, size-bounded LRU cache whose entries expire after a fixed time to live """
+
+    def __init__(self, name, max_size=10000, ttl=300.0, cache_none=True):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_none = cache_none  # False to look up a None from the loader again every time
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the cached value for key, or default if it is missing or expired """
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """ Store value under key, evicting the least recently used entry if the cache is full """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """ Return the cached value for key, calling loader() and caching its result on a miss """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.load(key, loader)
+        return value
+
+    def load(self, key, loader):
+        """ Call loader() and cache its result under key, without touching the hit/miss counters """
+        value = loader()
+        if value is not None or self.cache_none:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Hit/miss counters and current size, for logging and metrics """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
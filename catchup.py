@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import time
+
+import stripe
+
+import async_db
+import routing
+import stripe_gateway
+import webhook_inbox
+from db_utils import get_db_connection
+
+EVENT_PAGE_SIZE = 100
+# With no cursor yet (first start for an account), look this far back
+INITIAL_LOOKBACK = int(os.getenv('CATCHUP_INITIAL_LOOKBACK', '3600'))
+
+
+def load_cursor(stripe_account_id):
+    """(created, event id) of the newest event the catch-up has seen for an account, or None."""
+    row = get_db_connection().execute('''
+        SELECT last_event_created, last_event_id FROM event_cursors WHERE stripe_account_id = ?
+    ''', (stripe_account_id,)).fetchone()
+    return (row['last_event_created'], row['last_event_id']) if row else None
+
+
+def save_cursor(stripe_account_id, created, event_id):
+    connection = get_db_connection()
+    connection.execute('''
+        INSERT OR REPLACE INTO event_cursors (stripe_account_id, last_event_created, last_event_id, updated_at)
+        VALUES (?, ?, ?, ?)
+    ''', (stripe_account_id, created, event_id, time.time()))
+    connection.commit()
+
+
+def connected_accounts():
+    rows = get_db_connection().execute('SELECT stripe_account_id FROM servers').fetchall()
+    return [row['stripe_account_id'] for row in rows]
+
+
+class CatchUp:
+    """Pulls events missed while we were down from the Stripe Events API into the webhook inbox.
+
+    The cursor only moves when the catch-up itself has listed every event up to it. Live webhooks
+    arrive out of order, so advancing it from them could skip an event that was never delivered.
+    """
+
+    def __init__(self, event_types, on_enqueued=None, interval=600.0):
+        self.event_types = list(event_types)
+        self.on_enqueued = on_enqueued  # Called after new events were stored, e.g. to wake the inbox worker
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                # E.g. the database is busy, the next round tries again
+                print(f"Error catching up events: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """Catch up every connected account. Returns {account: number of new events stored}."""
+        results = {}
+        for stripe_account_id in await async_db.run_db(connected_accounts):
+            try:
+                results[stripe_account_id] = await self.catch_up_account(stripe_account_id)
+            except Exception as e:
+                # One account's failure (API or malformed event) must not stop the others
+                print(f"Error catching up events for {stripe_account_id}: {e}")
+        return results
+
+    async def catch_up_account(self, stripe_account_id):
+        cursor = await async_db.run_db(load_cursor, stripe_account_id)
+        # gte rather than gt: events sharing the cursor's second are re-listed and deduplicated by id
+        since = cursor[0] if cursor else int(time.time()) - INITIAL_LOOKBACK
+
+        newest = None
+        stored = 0
+        starting_after = None
+        while True:
+            params = {
+                'created': {'gte': since},
+                'types': self.event_types,
+                'limit': EVENT_PAGE_SIZE,
+                'stripe_account': stripe_account_id,
+            }
+            if starting_after:
+                params['starting_after'] = starting_after
+            # Events come newest first, each page goes straight into the inbox
+            page = await stripe_gateway.call(stripe.Event.list, **params)
+            if not page.data:
+                break
+
+            if newest is None:
+                newest = page.data[0]
+            rows = []
+            for event in page.data:
+                event['account'] = event.get('account') or stripe_account_id
+                rows.append((event.id, event.type, stripe_account_id, json.dumps(event), event.created,
+                             routing.discord_server_id(event.data.object)))
+            stored += await async_db.run_db(webhook_inbox.enqueue_events, rows)
+
+            if not page.has_more:
+                break
+            starting_after = page.data[-1].id
+
+        if stored and self.on_enqueued is not None:
+            self.on_enqueued()
+        if newest is not None:
+            await async_db.run_db(save_cursor, stripe_account_id, newest.created, newest.id)
+        elif cursor is None:
+            # Nothing in the lookback window, start from here next time
+            await async_db.run_db(save_cursor, stripe_account_id, since, None)
+
+        if stored:
+            print(f"Caught up {stored} missed events for {stripe_account_id}")
+        return stored
@@ -0,0 +1,112 @@
+"""Run the bot as webhook ingress processes plus sharded gateway workers on one machine.
+
+    python cluster.py ingress --processes 4 --port 5000
+    python cluster.py gateway --shards 0-3 --shard-count 8
+    python cluster.py gateway --shards 4-7 --shard-count 8
+
+Ingress processes verify Stripe webhooks and store them in the webhook inbox without importing
+discord.py (see ingress.py). Each gateway worker logs in with its range of shards and claims only
+the stored events of guilds on those shards. All processes share the SQLite database.
+"""
+import argparse
+import multiprocessing
+import os
+from collections import namedtuple
+
+
+def shard_id(guild_id, shard_count):
+    """The shard Discord delivers a guild's events on."""
+    return (int(guild_id) >> 22) % shard_count
+
+
+class Shards(namedtuple('Shards', ['ids', 'count'])):
+    """The shard ids one gateway worker runs, out of `count` shards in total."""
+
+    def owns(self, guild_id):
+        return shard_id(guild_id, self.count) in self.ids
+
+    @property
+    def primary(self):
+        # The worker running shard 0 also does the work that isn't tied to a guild
+        return 0 in self.ids
+
+
+def shard_filter(shards):
+    """SQL condition and parameters matching rows whose discord_server_id is on `shards`, to AND onto a WHERE."""
+    if shards is None:
+        return '', []
+    # Discord's own guild to shard formula
+    condition = f"(CAST(discord_server_id AS INTEGER) >> 22) % ? IN ({', '.join('?' * len(shards.ids))})"
+    if shards.primary:
+        # Rows we couldn't tie to a guild go to the worker running shard 0
+        condition = f"(discord_server_id IS NULL OR {condition})"
+    return 'AND ' + condition, [shards.count, *shards.ids]
+
+
+def parse_shard_ids(value):
+    """'0-3', '0,2,4' or '0-1,4' as a sorted list of shard ids."""
+    ids = set()
+    for part in value.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ids.update(range(int(first), int(last) + 1))
+        elif part:
+            ids.add(int(part))
+    return sorted(ids)
+
+
+def shards_from_env():
+    """The Shards set by SHARD_COUNT and SHARD_IDS, or None when one process runs every shard."""
+    count = os.getenv('SHARD_COUNT')
+    if not count:
+        return None
+    count = int(count)
+    ids = parse_shard_ids(os.getenv('SHARD_IDS', '')) or list(range(count))
+    if any(not 0 <= shard < count for shard in ids):
+        raise ValueError(f"SHARD_IDS must be between 0 and {count - 1}")
+    return Shards(ids, count)
+
+
+def run_ingress(host, port, reuse_port):
+    import ingress
+    ingress.serve(host, port, reuse_port=reuse_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    roles = parser.add_subparsers(dest='role', required=True)
+
+    ingress_parser = roles.add_parser('ingress', help="Receive and store Stripe webhooks")
+    ingress_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    ingress_parser.add_argument('--host', default=os.getenv('HTTP_HOST', '127.0.0.1'))
+    ingress_parser.add_argument('--port', type=int, default=int(os.getenv('HTTP_PORT', '5000')))
+
+    gateway_parser = roles.add_parser('gateway', help="Run a range of Discord shards and apply their events")
+    gateway_parser.add_argument('--shards', required=True, help="Shard ids to run, e.g. 0-3")
+    gateway_parser.add_argument('--shard-count', type=int, required=True)
+
+    args = parser.parse_args()
+
+    if args.role == 'ingress':
+        import db_utils
+        db_utils.create_tables()  # Once, before the processes start
+        # The processes share one listening port through SO_REUSEPORT, the kernel spreads connections
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=run_ingress, args=(args.host, args.port, args.processes > 1))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        os.environ['SHARD_IDS'] = args.shards
+        os.environ['SHARD_COUNT'] = str(args.shard_count)
+        # Webhooks go to the ingress processes, only serve the OAuth routes if asked to
+        os.environ.setdefault('HTTP_SERVER', 'none')
+        import bot
+        bot.main()
+
+
+if __name__ == '__main__':
+    main()
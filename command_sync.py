@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import discord
+
+import async_db
+from db_utils import get_db_connection
+
+# 'global' syncs the tree once as global commands, which can take up to an hour to show up
+# everywhere. 'guilds' syncs a copy to every guild the bot is in, which shows up immediately.
+COMMAND_SYNC_SCOPE = os.getenv('COMMAND_SYNC_SCOPE', 'global')
+COMMAND_SYNC_CONCURRENCY = int(os.getenv('COMMAND_SYNC_CONCURRENCY', '4'))
+GLOBAL_SCOPE = 'global'
+
+
+def load_hashes():
+    """The last synced hash for every scope, as {scope: hash}."""
+    rows = get_db_connection().execute('SELECT scope, hash FROM command_sync_hashes').fetchall()
+    return {row['scope']: row['hash'] for row in rows}
+
+
+def save_hash(scope, tree_hash):
+    connection = get_db_connection()
+    connection.execute('''
+        INSERT OR REPLACE INTO command_sync_hashes (scope, hash, synced_at) VALUES (?, ?, ?)
+    ''', (scope, tree_hash, time.time()))
+    connection.commit()
+
+
+def tree_hash(tree):
+    """Hash of the global commands exactly as they would be sent to Discord."""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class CommandSync:
+    """Syncs the slash command tree only to the scopes whose last synced hash differs."""
+
+    def __init__(self, bot, scope=COMMAND_SYNC_SCOPE, concurrency=COMMAND_SYNC_CONCURRENCY):
+        self.bot = bot
+        self.scope = scope
+        self.concurrency = concurrency
+        self._hash = None
+        self._hashes = None  # scope -> last synced hash, loaded once
+
+    async def sync(self, guilds=None):
+        """Sync wherever the tree changed. Returns how many syncs were sent to Discord."""
+        if self._hash is None:
+            self._hash = tree_hash(self.bot.tree)
+        if self._hashes is None:
+            self._hashes = await async_db.run_db(load_hashes)
+
+        if self.scope == 'guilds':
+            guilds = self.bot.guilds if guilds is None else guilds
+            scopes = [(str(guild.id), guild) for guild in guilds]
+        else:
+            scopes = [(GLOBAL_SCOPE, None)]
+
+        stale = [(scope, guild) for scope, guild in scopes if self._hashes.get(scope) != self._hash]
+        if not stale:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def sync_scope(scope, guild):
+            async with semaphore:
+                try:
+                    if guild is not None:
+                        self.bot.tree.copy_global_to(guild=guild)
+                    await self.bot.tree.sync(guild=guild)
+                except discord.HTTPException as e:
+                    print(f"Error syncing commands to {scope}: {e}")
+                    return False
+                finally:
+                    if guild is not None:
+                        self.bot.tree.clear_commands(guild=guild)  # The copy was only needed for the sync
+                await async_db.run_db(save_hash, scope, self._hash)
+                self._hashes[scope] = self._hash
+                return True
+
+        results = await asyncio.gather(*(sync_scope(scope, guild) for scope, guild in stale))
+        synced = sum(results)
+        if self.scope == 'guilds':
+            print(f"Slash commands synced to {synced}/{len(stale)} guilds, {len(scopes) - len(stale)} already up to date.")
+        elif synced:
+            print("Slash commands synced globally.")
+        return synced
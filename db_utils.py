@@ -1,94 +1,331 @@
-import sqlite3
-
-DB_PATH = 'subscriptions.db'  # Path to the SQLite database
-
-def get_db_connection():
-    """ Get a connection to the SQLite database """
-    connection = sqlite3.connect(DB_PATH)
-    connection.row_factory = sqlite3.Row  # Allows dictionary-like access to rows
-    return connection
-
-def create_tables():
-    """ Create the necessary tables if they don't exist """
-    connection = get_db_connection()
-    cursor = connection.cursor()
-
-    # Create table to store server ID and Stripe Account ID with UNIQUE constraint on discord_server_id
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS servers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            discord_server_id TEXT UNIQUE NOT NULL,
-            stripe_account_id TEXT NOT NULL
-        )
-    ''')
-
-    # Create table to store plans and price IDs
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            discord_server_id TEXT NOT NULL,
-            plan_name TEXT NOT NULL,
-            price_id TEXT NOT NULL
-        )
-    ''')
-    connection.commit()
-    connection.close()
-
-
-
-def save_stripe_account(discord_server_id, stripe_account_id):
-    """ Insert or update the Stripe account ID for a Discord server """
-    connection = get_db_connection()
-    cursor = connection.cursor()
-
-    # Use INSERT OR REPLACE to update if the discord_server_id already exists
-    cursor.execute('''
-        INSERT OR REPLACE INTO servers (discord_server_id, stripe_account_id)
-        VALUES (?, ?)
-    ''', (discord_server_id, stripe_account_id))
-
-    connection.commit()
-    connection.close()
-
-
-def get_stripe_account(discord_server_id):
-    """Retrieve the Stripe account ID for a given Discord server ID."""
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT stripe_account_id FROM servers WHERE discord_server_id = ?
-    ''', (discord_server_id,))
-    result = cursor.fetchone()
-    connection.close()
-
-    if result:
-        return result['stripe_account_id']
-    return None
-
-
-def save_plan(discord_server_id, plan_name, price_id):
-    """Save the plan name and corresponding price_id to the database."""
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute('''
-        INSERT INTO plans (discord_server_id, plan_name, price_id)
-        VALUES (?, ?, ?)
-    ''', (discord_server_id, plan_name, price_id))
-    connection.commit()
-    connection.close()
-
-
-
-def get_price_id(discord_server_id, plan_name):
-    """Retrieve the price_id for a given plan name and server."""
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT price_id FROM plans WHERE discord_server_id = ? AND plan_name = ?
-    ''', (discord_server_id, plan_name))
-    result = cursor.fetchone()
-    connection.close()
-
-    if result:
-        return result['price_id']
-    return None
\ No newline at end of file
+import functools
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import migrations
+from cache import TTLCache
+from routing import RoutingIndex, PlanNameIndex
+
+DB_PATH = 'subscriptions.db'  # Path to the SQLite database
+
+# Connection tuning (applied once per connection, connections live for the life of their thread)
+CACHED_STATEMENTS = 256  # Size of the per-connection prepared statement cache
+CACHE_SIZE_KB = 16384  # Page cache size per connection
+BUSY_TIMEOUT_MS = 5000  # Wait this long for a competing writer instead of failing with "database is locked"
+
+# Read-through caches for the per-command lookups. Entries are invalidated by the write
+# functions below, the TTL only bounds staleness from writes made by other processes. Misses
+# aren't cached, a server connected or a plan created through another process shows up at once.
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', '10000'))
+LOOKUP_CACHE_TTL = float(os.getenv('LOOKUP_CACHE_TTL', '300'))
+
+stripe_account_cache = TTLCache('stripe_account', LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL, cache_none=False)
+price_id_cache = TTLCache('price_id', LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL, cache_none=False)
+
+# Account/price -> guild/role index for webhook events, loaded by load_routing_index() at startup
+routing_index = RoutingIndex()
+# Plan names per guild for /subscribe autocomplete, loaded and updated alongside routing_index
+plan_name_index = PlanNameIndex()
+
+# Each thread's connection is owned by its _local, so it is closed when the thread exits (Flask's
+# dev server runs every request on a new thread). _connections only tracks the open ones for
+# close_connections(), which bumps _generation so other threads reopen instead of using a closed one.
+_local = threading.local()
+_connections = weakref.WeakSet()
+_connections_lock = threading.Lock()
+_generation = 0
+
+
+class PooledConnection(sqlite3.Connection):
+    """ A long-lived connection owned by one thread. close() hands it back instead of closing it. """
+
+    def close(self):
+        # Discard anything the caller forgot to commit so the next user starts clean
+        if self.in_transaction:
+            self.rollback()
+
+    def close_for_real(self):
+        super().close()
+
+
+class _ThreadConnection:
+    """ Holds a thread's connection in its _local and closes it when the thread exits """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __del__(self):
+        # The connection references itself through its statement cache, so without this it would
+        # stay open until the garbage collector finds the cycle
+        try:
+            self.connection.close_for_real()
+        except sqlite3.Error:
+            pass
+
+
+def _open_connection():
+    """ Open and tune a new connection for the current thread """
+    connection = sqlite3.connect(
+        DB_PATH,
+        factory=PooledConnection,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,  # Only the owning thread uses it, but close_connections() may run elsewhere
+    )
+    connection.row_factory = sqlite3.Row  # Allows dictionary-like access to rows
+
+    # WAL lets the Flask thread read while the bot thread writes, and NORMAL sync is durable under WAL
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    connection.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    connection.execute('PRAGMA temp_store=MEMORY')
+
+    with _connections_lock:
+        _connections.add(connection)
+    return connection
+
+
+def get_db_connection():
+    """ Get this thread's persistent connection to the SQLite database """
+    owner = getattr(_local, 'owner', None)
+
+    # Reopen if this thread has no connection yet, DB_PATH was pointed somewhere else or
+    # close_connections() closed it. Replacing the owner closes the old connection.
+    if owner is None or _local.db_path != DB_PATH or _local.generation != _generation:
+        owner = _ThreadConnection(_open_connection())
+        _local.owner = owner
+        _local.db_path = DB_PATH
+        _local.generation = _generation
+        _local.batch_depth = 0
+        _local.after_commit = []
+    return owner.connection
+
+
+def close_connections():
+    """ Close every pooled connection (call on shutdown), threads that use the database again reopen """
+    global _generation
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+
+    for connection in connections:
+        try:
+            connection.close_for_real()
+        except sqlite3.Error:
+            pass
+
+    _local.__dict__.clear()
+
+
+def _commit(connection):
+    """ Commit now, unless we are inside a batch() in which case the batch commits once at the end """
+    if getattr(_local, 'batch_depth', 0) == 0:
+        connection.commit()
+
+
+def _after_commit(callback):
+    """ Run callback once the current write is committed (at the end of the batch, if any) """
+    if getattr(_local, 'batch_depth', 0) > 0:
+        _local.after_commit.append(callback)
+    else:
+        callback()
+
+
+def _run_after_commit(committed):
+    callbacks = _local.after_commit
+    _local.after_commit = []
+    if committed:
+        for callback in callbacks:
+            callback()
+
+
+def _invalidate(cache, key):
+    """ Drop a cached lookup after the write that changed it """
+    cache.invalidate(key)
+
+    # Inside a batch the write is not committed yet and another thread may re-cache the old row,
+    # so drop it again once the batch commits
+    if getattr(_local, 'batch_depth', 0) > 0:
+        _after_commit(functools.partial(cache.invalidate, key))
+
+
+def cache_stats():
+    """ Hit/miss counters for the lookup caches """
+    return [stripe_account_cache.stats(), price_id_cache.stats()]
+
+
+@contextmanager
+def batch():
+    """ Group a burst of writes on this thread into a single transaction and a single fsync """
+    connection = get_db_connection()
+    _local.batch_depth += 1
+    try:
+        yield connection
+    except BaseException:
+        _local.batch_depth -= 1
+        if _local.batch_depth == 0:
+            connection.rollback()
+            _run_after_commit(False)
+        raise
+    else:
+        _local.batch_depth -= 1
+        if _local.batch_depth == 0:
+            connection.commit()
+            _run_after_commit(True)
+
+
+def create_tables():
+    """ Create the tables, or bring an existing database up to the latest schema version """
+    return migrations.migrate(get_db_connection())
+
+
+def load_routing_index():
+    """ Build the routing index from the servers and plans tables """
+    connection = get_db_connection()
+    servers = connection.execute('SELECT discord_server_id, stripe_account_id FROM servers').fetchall()
+    plans = connection.execute('SELECT discord_server_id, plan_name, price_id, role_id FROM plans ORDER BY id').fetchall()
+    routing_index.rebuild(servers, plans)
+    plan_name_index.rebuild((row['discord_server_id'], row['plan_name']) for row in plans)
+
+
+def save_stripe_account(discord_server_id, stripe_account_id):
+    """ Insert or update the Stripe account ID for a Discord server """
+    connection = get_db_connection()
+
+    # Use INSERT OR REPLACE to update if the discord_server_id already exists
+    connection.execute('''
+        INSERT OR REPLACE INTO servers (discord_server_id, stripe_account_id)
+        VALUES (?, ?)
+    ''', (discord_server_id, stripe_account_id))
+
+    _commit(connection)
+    _invalidate(stripe_account_cache, discord_server_id)
+    _after_commit(functools.partial(routing_index.set_account, discord_server_id, stripe_account_id))
+
+
+def get_stripe_account(discord_server_id):
+    """Retrieve the Stripe account ID for a given Discord server ID."""
+    return stripe_account_cache.get_or_load(discord_server_id, lambda: load_stripe_account(discord_server_id))
+
+
+def load_stripe_account(discord_server_id):
+    """Read the Stripe account ID for a Discord server straight from the database."""
+    connection = get_db_connection()
+    result = connection.execute('''
+        SELECT stripe_account_id FROM servers WHERE discord_server_id = ?
+    ''', (discord_server_id,)).fetchone()
+
+    if result:
+        return result['stripe_account_id']
+    return None
+
+
+def save_plan(discord_server_id, plan_name, price_id, role_id=None):
+    """Save the plan name, its price_id and the role it grants to the database."""
+    connection = get_db_connection()
+    connection.execute('''
+        INSERT INTO plans (discord_server_id, plan_name, price_id, role_id)
+        VALUES (?, ?, ?, ?)
+    ''', (discord_server_id, plan_name, price_id, role_id))
+    _commit(connection)
+    _invalidate(price_id_cache, (discord_server_id, plan_name))
+    _after_commit(functools.partial(routing_index.add_plan, discord_server_id, plan_name, price_id, role_id))
+    _after_commit(functools.partial(plan_name_index.add, discord_server_id, plan_name))
+
+
+
+def save_plans(discord_server_id, plans):
+    """Save several (plan_name, price_id, role_id) plans in one transaction, all or nothing."""
+    with batch():
+        for plan_name, price_id, role_id in plans:
+            save_plan(discord_server_id, plan_name, price_id, role_id)
+
+
+def get_price_id(discord_server_id, plan_name):
+    """Retrieve the price_id for a given plan name and server."""
+    key = (discord_server_id, plan_name)
+    return price_id_cache.get_or_load(key, lambda: load_price_id(discord_server_id, plan_name))
+
+
+def load_price_id(discord_server_id, plan_name):
+    """Read the price_id for a plan straight from the database."""
+    connection = get_db_connection()
+    result = connection.execute('''
+        SELECT price_id FROM plans WHERE discord_server_id = ? AND plan_name = ?
+    ''', (discord_server_id, plan_name)).fetchone()
+
+    if result:
+        return result['price_id']
+    return None
+
+
+def save_subscription(stripe_subscription_id, discord_server_id, status, stripe_customer_id=None,
+                      stripe_account_id=None, discord_user_id=None, price_id=None, event_created=None):
+    """Record the latest known state of a Stripe subscription, keeping fields the event didn't carry.
+
+    Returns False without changing anything if a newer event was already recorded, Stripe does
+    not deliver events in order.
+    """
+    # Stripe keeps retrying the payment after the grace period took the roles. Those failures
+    # leave the subscription revoked, only a successful payment makes it active again.
+    connection = get_db_connection()
+    cursor = connection.execute('''
+        INSERT INTO subscriptions
+            (stripe_subscription_id, stripe_customer_id, stripe_account_id, discord_server_id,
+             discord_user_id, price_id, status, updated_at, last_event_created)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (stripe_subscription_id) DO UPDATE SET
+            stripe_customer_id = COALESCE(excluded.stripe_customer_id, stripe_customer_id),
+            stripe_account_id = COALESCE(excluded.stripe_account_id, stripe_account_id),
+            discord_user_id = COALESCE(excluded.discord_user_id, discord_user_id),
+            price_id = COALESCE(excluded.price_id, price_id),
+            status = CASE WHEN status = 'revoked' AND excluded.status = 'past_due' THEN status ELSE excluded.status END,
+            updated_at = excluded.updated_at,
+            last_event_created = COALESCE(excluded.last_event_created, last_event_created)
+        WHERE excluded.last_event_created IS NULL OR last_event_created IS NULL
+            OR excluded.last_event_created >= last_event_created
+    ''', (stripe_subscription_id, stripe_customer_id, stripe_account_id, discord_server_id,
+          discord_user_id, price_id, status, time.time(), event_created))
+    _commit(connection)
+    return cursor.rowcount == 1
+
+
+def mark_subscription_revoked(stripe_subscription_id):
+    """Record that the grace period of a past_due subscription ended and its roles were taken."""
+    connection = get_db_connection()
+    connection.execute('''
+        UPDATE subscriptions SET status = 'revoked', updated_at = ? WHERE stripe_subscription_id = ? AND status = 'past_due'
+    ''', (time.time(), stripe_subscription_id))
+    _commit(connection)
+
+
+def load_subscription_status(stripe_subscription_id):
+    row = get_db_connection().execute('''
+        SELECT status FROM subscriptions WHERE stripe_subscription_id = ?
+    ''', (stripe_subscription_id,)).fetchone()
+    return row['status'] if row else None
+
+
+def get_member_subscriptions(discord_server_id, discord_user_id):
+    """A member's subscriptions in a guild, as rows of the subscriptions table.
+
+    The reconciler checks these before revoking a role, idx_subscriptions_member serves the lookup.
+    """
+    connection = get_db_connection()
+    return connection.execute('''
+        SELECT * FROM subscriptions WHERE discord_server_id = ? AND discord_user_id = ?
+    ''', (discord_server_id, discord_user_id)).fetchall()
+
+
+def remove_stripe_account(discord_server_id):
+    """Remove the Stripe account connected to a Discord server."""
+    connection = get_db_connection()
+    connection.execute('DELETE FROM servers WHERE discord_server_id = ?', (discord_server_id,))
+    _commit(connection)
+    _invalidate(stripe_account_cache, discord_server_id)
+    _after_commit(functools.partial(routing_index.remove_account, discord_server_id))
@@ -0,0 +1,211 @@
+import asyncio
+import heapq
+import os
+import time
+
+import async_db
+import cluster
+from db_utils import get_db_connection
+
+# How long a subscriber keeps their roles after a failed payment (days). A successful payment
+# within that time cancels the revocation.
+GRACE_PERIOD_DAYS = float(os.getenv('GRACE_PERIOD_DAYS', '3'))
+
+# Timers due within LOOKAHEAD seconds are held in a heap in memory, at most MAX_LOADED of them.
+# The rest stay in the table until the heap runs out, so pending timers cost no memory or polling.
+LOOKAHEAD = 3600.0
+MAX_LOADED = 10000
+RETRY_DELAY = 60.0  # Seconds before a timer whose action failed runs again
+
+
+def save_timer(subscription_id, discord_server_id, discord_user_id, role_ids, due_at):
+    """Start a grace period unless the subscription already has one running in the guild.
+
+    Stripe retries a failed payment several times, the first failure's deadline is kept.
+    Returns True if a timer was started.
+    """
+    connection = get_db_connection()
+    cursor = connection.execute('''
+        INSERT OR IGNORE INTO grace_timers
+            (stripe_subscription_id, discord_server_id, discord_user_id, role_ids, due_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (subscription_id, str(discord_server_id), str(discord_user_id),
+          ','.join(str(role_id) for role_id in role_ids), due_at, time.time()))
+    connection.commit()
+    return cursor.rowcount == 1
+
+
+def cancel_timers(subscription_id):
+    """Drop the subscription's timers in every guild. Returns how many there were."""
+    connection = get_db_connection()
+    cursor = connection.execute('DELETE FROM grace_timers WHERE stripe_subscription_id = ?', (subscription_id,))
+    connection.commit()
+    return cursor.rowcount
+
+
+def load_due(until, limit, shards=None):
+    """Keys and deadlines of up to `limit` timers due by `until`, earliest first."""
+    shard_filter, shard_params = cluster.shard_filter(shards)
+    return get_db_connection().execute(f'''
+        SELECT stripe_subscription_id, discord_server_id, due_at FROM grace_timers
+        WHERE due_at <= ? {shard_filter}
+        ORDER BY due_at
+        LIMIT ?
+    ''', (until, *shard_params, limit)).fetchall()
+
+
+def load_timer(subscription_id, discord_server_id):
+    return get_db_connection().execute('''
+        SELECT * FROM grace_timers WHERE stripe_subscription_id = ? AND discord_server_id = ?
+    ''', (subscription_id, discord_server_id)).fetchone()
+
+
+def finish_timer(subscription_id, discord_server_id, due_at):
+    """Delete a timer that ran, unless it was replaced by a new one in the meantime."""
+    connection = get_db_connection()
+    connection.execute('''
+        DELETE FROM grace_timers WHERE stripe_subscription_id = ? AND discord_server_id = ? AND due_at = ?
+    ''', (subscription_id, discord_server_id, due_at))
+    connection.commit()
+
+
+def postpone_timer(subscription_id, discord_server_id, due_at, new_due_at):
+    connection = get_db_connection()
+    connection.execute('''
+        UPDATE grace_timers SET due_at = ? WHERE stripe_subscription_id = ? AND discord_server_id = ? AND due_at = ?
+    ''', (new_due_at, subscription_id, discord_server_id, due_at))
+    connection.commit()
+
+
+def pending_subscriptions(discord_server_id, subscription_ids):
+    """The ones among subscription_ids with a grace period still running in the guild."""
+    if not subscription_ids:
+        return set()
+    placeholders = ','.join('?' * len(subscription_ids))
+    rows = get_db_connection().execute(f'''
+        SELECT stripe_subscription_id FROM grace_timers
+        WHERE discord_server_id = ? AND stripe_subscription_id IN ({placeholders})
+    ''', (str(discord_server_id), *subscription_ids)).fetchall()
+    return {row['stripe_subscription_id'] for row in rows}
+
+
+def count_timers():
+    return get_db_connection().execute('SELECT COUNT(*) FROM grace_timers').fetchone()[0]
+
+
+class GraceTimers:
+    """Runs `on_due` for each grace period timer when it comes due, on the bot's loop.
+
+    The table is the source of truth, so timers survive restarts and fire late rather than never.
+    Only the next LOOKAHEAD seconds are loaded into a min-heap, then the loop sleeps until the
+    earliest deadline. Cancelling deletes the row by its key; the heap entry is left behind and
+    skipped when it comes up, since its row is gone.
+    """
+
+    def __init__(self, on_due, shards=None, concurrency=8, lookahead=LOOKAHEAD, max_loaded=MAX_LOADED):
+        self.on_due = on_due  # async function taking the timer's row
+        self.shards = shards  # cluster.Shards whose guilds' timers this process runs, None for all
+        self.concurrency = concurrency
+        self.lookahead = lookahead
+        self.max_loaded = max_loaded
+        self._heap = []  # (due_at, subscription id, guild id)
+        self._loaded_until = 0.0  # Every timer due before this is in the heap
+        self._loading = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def schedule(self, subscription_id, discord_server_id, discord_user_id, role_ids, delay):
+        """Revoke role_ids from the user in `delay` seconds unless cancelled. Returns False if one was already running."""
+        due_at = time.time() + delay
+        started = await async_db.run_db(save_timer, subscription_id, discord_server_id, discord_user_id, role_ids, due_at)
+        if started and (due_at < self._loaded_until or self._loading):
+            self._push(due_at, subscription_id, str(discord_server_id))
+        return started
+
+    async def cancel(self, subscription_id):
+        """Stop the subscription's grace periods, e.g. because a payment went through."""
+        return await async_db.run_db(cancel_timers, subscription_id)
+
+    def _push(self, due_at, subscription_id, discord_server_id):
+        heapq.heappush(self._heap, (due_at, subscription_id, discord_server_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                if time.time() >= self._loaded_until:
+                    await self._load()
+                await self._fire_due()
+            except Exception as e:
+                print(f"Error running grace period timers: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            next_at = min(self._heap[0][0], self._loaded_until) if self._heap else self._loaded_until
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, next_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _load(self):
+        """Refill the heap with the timers due within the lookahead."""
+        until = time.time() + self.lookahead
+        self._loading = True
+        try:
+            rows = await async_db.run_db(load_due, until, self.max_loaded, self.shards)
+        finally:
+            self._loading = False
+        # Keep what was scheduled while the query ran, a duplicate entry only costs a lookup
+        entries = [(row['due_at'], row['stripe_subscription_id'], row['discord_server_id']) for row in rows]
+        self._heap = entries + [entry for entry in self._heap if entry[0] < until]
+        heapq.heapify(self._heap)
+        # If the limit cut the window short, load again once the heap gets there. Timers that ran
+        # have been deleted by then, so the next load starts where this one stopped.
+        self._loaded_until = rows[-1]['due_at'] if len(rows) == self.max_loaded else until
+
+    async def _fire_due(self):
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        if not due:
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fire(subscription_id, discord_server_id):
+            async with semaphore:
+                timer = await async_db.run_db(load_timer, subscription_id, discord_server_id)
+                if timer is None or timer['due_at'] > now:
+                    return  # Cancelled, or cancelled and started again with a later deadline
+                try:
+                    await self.on_due(timer)
+                except Exception as e:
+                    print(f"Error revoking roles after the grace period of {subscription_id} in {discord_server_id}: {e}")
+                    retry_at = time.time() + RETRY_DELAY
+                    await async_db.run_db(postpone_timer, subscription_id, discord_server_id, timer['due_at'], retry_at)
+                    if retry_at < self._loaded_until:
+                        self._push(retry_at, subscription_id, discord_server_id)
+                    return
+                await async_db.run_db(finish_timer, subscription_id, discord_server_id, timer['due_at'])
+
+        # The same timer can be in the heap twice, run it once
+        keys = dict.fromkeys((subscription_id, discord_server_id) for _, subscription_id, discord_server_id in due)
+        await asyncio.gather(*(fire(*key) for key in keys))
+
+    def stats(self):
+        return {'loaded': len(self._heap), 'loaded_until': self._loaded_until}
@@ -0,0 +1,137 @@
+"""Stateless webhook ingress: verifies Stripe webhooks and stores them in the webhook inbox.
+
+It imports nothing from discord.py, so it starts quickly and can run as several processes in front
+of the sharded gateway workers (see cluster.py), which claim the stored events from the shared
+database. Run one process with `python ingress.py`.
+"""
+import asyncio
+import json
+import os
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+import async_db
+import db_utils
+import metrics
+import routing
+from admission import AdmissionBuffer, BufferFullError, throttled_reply
+from webhook_verifier import WebhookVerifier, SignatureVerificationError
+
+# Stripe event types the bot acts on, anything else is acknowledged and dropped
+HANDLED_EVENT_TYPES = ('invoice.payment_succeeded', 'invoice.payment_failed', 'customer.subscription.deleted')
+
+# Events that only close a cached checkout session. The gateway worker that created the session
+# holds it in memory, so the ingress stores these for that worker like any other event.
+CHECKOUT_SESSION_EVENT_TYPES = ('checkout.session.completed', 'checkout.session.expired')
+
+
+def verifier_from_env():
+    # Comma-separated secrets in STRIPE_WEBHOOK_SECRET are all accepted during rotation
+    return WebhookVerifier.from_env_value(os.getenv('STRIPE_WEBHOOK_SECRET'), int(os.getenv('STRIPE_WEBHOOK_TOLERANCE', '300')))
+
+
+def parse_webhook(verifier, payload, sig_header):
+    """Verify and decode a raw webhook body. Returns (event, None) or (None, (body, status))."""
+    try:
+        # Verify the signature over the raw bytes so forged or replayed requests are never parsed
+        verifier.verify(payload, sig_header)
+    except SignatureVerificationError as e:
+        print(f"Rejected webhook: {e}")
+        metrics.WEBHOOK_EVENTS.labels('unknown', 'rejected').inc()
+        return None, ("Invalid signature", 400)
+
+    try:
+        event = json.loads(payload)
+        # Signed but not an event (a test body, an API change), Stripe would retry a 500 forever
+        if not isinstance(event['id'], str) or not isinstance(event['type'], str) \
+                or not isinstance(event['data']['object'], dict):
+            raise ValueError("Not a Stripe event")
+        print(f"Received event: {event['type']}")
+    except (ValueError, KeyError, TypeError):
+        metrics.WEBHOOK_EVENTS.labels('unknown', 'rejected').inc()
+        return None, ("Invalid payload", 400)
+
+    return event, None
+
+
+async def store_event(buffer, event, payload):
+    """Store an accepted event in the inbox through the admission buffer.
+
+    Returns False if it was a duplicate delivery, raises BufferFullError if the buffer is full.
+    """
+    stored = await buffer.store(event['id'], event['type'], event.get('account'),
+                                payload.decode(), routing.discord_server_id(event['data']['object']))
+    metrics.WEBHOOK_EVENTS.labels(event['type'], 'queued' if stored else 'duplicate').inc()
+    return stored
+
+
+@metrics.timed(metrics.WEBHOOK_REQUEST_SECONDS.labels('ingress'))
+async def handle_webhook(request):
+    payload = await request.read()
+    event, reply = parse_webhook(request.app['verifier'], payload, request.headers.get('Stripe-Signature'))
+    if event is None:
+        return web.Response(text=reply[0], status=reply[1])
+
+    if event['type'] not in HANDLED_EVENT_TYPES + CHECKOUT_SESSION_EVENT_TYPES:
+        metrics.WEBHOOK_EVENTS.labels(event['type'], 'ignored').inc()
+        return web.Response(text="Success")
+
+    # Acknowledged once committed, the gateway workers pick it up on their next poll
+    try:
+        await store_event(request.app['buffer'], event, payload)
+    except BufferFullError as e:
+        body, status, headers = throttled_reply(event, e)
+        return web.Response(text=body, status=status, headers=headers)
+    return web.Response(text="Success")
+
+
+async def handle_metrics(request):
+    body = await async_db.run_db(metrics.render)
+    return web.Response(body=body.encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def create_app(verifier=None, buffer=None):
+    web_app = web.Application()
+    web_app['verifier'] = verifier or verifier_from_env()
+    web_app['buffer'] = buffer or AdmissionBuffer()
+    if not web_app['verifier'].configured:
+        print("Warning: STRIPE_WEBHOOK_SECRET is not set, all webhooks will be rejected.")
+    web_app.add_routes([
+        web.post('/stripe/webhook', handle_webhook),
+        web.get('/metrics', handle_metrics),
+    ])
+    return web_app
+
+
+async def start(host, port, verifier=None, reuse_port=False, buffer=None):
+    """Serve the ingress on the running loop and return its runner for cleanup."""
+    runner = web.AppRunner(create_app(verifier, buffer), access_log=None, keepalive_timeout=75)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, backlog=1024, reuse_port=reuse_port)
+    await site.start()
+    return runner
+
+
+def serve(host, port, reuse_port=False):
+    """Run the ingress until interrupted. With reuse_port, several processes can share the port."""
+    load_dotenv()
+
+    async def run():
+        runner = await start(host, port, reuse_port=reuse_port)
+        print(f"Webhook ingress {os.getpid()} listening on {host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    db_utils.create_tables()
+    serve(os.getenv('HTTP_HOST', '127.0.0.1'), int(os.getenv('HTTP_PORT', '5000')))
@@ -0,0 +1,29 @@
+import json
+
+import ingress
+from webhook_verifier import WebhookVerifier, generate_signature_header
+
+SECRET = 'whsec_test'
+
+
+def parse(body):
+    payload = body.encode()
+    return ingress.parse_webhook(WebhookVerifier([SECRET]), payload, generate_signature_header(payload, SECRET))
+
+
+def test_accepts_signed_event():
+    event = {'id': 'evt_1', 'type': 'invoice.payment_succeeded', 'data': {'object': {'object': 'invoice'}}}
+    assert parse(json.dumps(event)) == (event, None)
+
+
+def test_rejects_signed_body_that_is_not_an_event():
+    for body in ('not json', '[]', '"text"', '{}', '{"id": "evt_1", "type": "invoice.paid"}',
+                 '{"id": "evt_1", "type": "invoice.paid", "data": []}',
+                 '{"id": "evt_1", "type": 5, "data": {"object": {}}}'):
+        assert parse(body) == (None, ("Invalid payload", 400)), body
+
+
+def test_rejects_bad_signature():
+    payload = b'{}'
+    header = generate_signature_header(payload, 'whsec_other')
+    assert ingress.parse_webhook(WebhookVerifier([SECRET]), payload, header) == (None, ("Invalid signature", 400))
@@ -0,0 +1,109 @@
+import asyncio
+import os
+
+import discord
+
+import metrics
+from cache import TTLCache
+
+MEMBER_CACHE_SIZE = int(os.getenv('MEMBER_CACHE_SIZE', '10000'))
+MEMBER_CACHE_TTL = float(os.getenv('MEMBER_CACHE_TTL', '300'))
+ABSENT_MEMBER_TTL = float(os.getenv('ABSENT_MEMBER_TTL', '60'))  # How long "not in this guild" is remembered
+BATCH_WINDOW = 0.05  # Seconds to wait for more lookups in the same guild before querying
+MAX_BATCH_SIZE = 100  # Discord's limit on user ids per member query
+
+
+class MemberResolver:
+    """Looks members up on demand instead of chunking every guild's member list at login.
+
+    Hits come from a bounded LRU. Lookups that arrive together for the same guild are sent as one
+    gateway member query, and users who are not in the guild are remembered for a short while so
+    repeated events for them don't each cost a request.
+    """
+
+    def __init__(self):
+        self.members = TTLCache('members', MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL)
+        self.absent = TTLCache('absent_members', MEMBER_CACHE_SIZE, ABSENT_MEMBER_TTL)
+        self._pending = {}  # guild id -> {user id: [futures]}
+        self.queries = 0
+        self.fetches = 0
+
+    async def resolve(self, guild, user_id):
+        """Return the guild's Member for user_id, or None if they are not in the guild."""
+        key = (guild.id, user_id)
+        member = self.members.get(key)
+        if member is not None:
+            return member
+        if self.absent.get(key):
+            return None
+
+        # Cached by the library (e.g. from an event), no request needed
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.members.set(key, member)
+            return member
+
+        future = asyncio.get_running_loop().create_future()
+        waiting = self._pending.get(guild.id)
+        if waiting is None:
+            waiting = self._pending[guild.id] = {}
+            asyncio.get_running_loop().call_later(BATCH_WINDOW, self._flush, guild)
+        waiting.setdefault(user_id, []).append(future)
+        if len(waiting) >= MAX_BATCH_SIZE:
+            self._flush(guild)
+        return await future
+
+    def remember(self, member):
+        """Store a Member we got back from Discord anyway, e.g. after editing it."""
+        self.members.set((member.guild.id, member.id), member)
+        self.absent.invalidate((member.guild.id, member.id))
+
+    def forget(self, guild_id, user_id):
+        """Drop a member, e.g. because they left the guild."""
+        self.members.invalidate((guild_id, user_id))
+
+    def _flush(self, guild):
+        waiting = self._pending.pop(guild.id, None)
+        if waiting:
+            asyncio.get_running_loop().create_task(self._lookup(guild, waiting))
+
+    async def _lookup(self, guild, waiting):
+        user_ids = list(waiting)
+        try:
+            if len(user_ids) == 1:
+                # A single id is cheaper over HTTP than a gateway query
+                self.fetches += 1
+                try:
+                    with metrics.DISCORD_REQUEST_SECONDS.labels('fetch_member').time():
+                        found = [await guild.fetch_member(user_ids[0])]
+                except discord.NotFound:
+                    found = []
+            else:
+                self.queries += 1
+                with metrics.DISCORD_REQUEST_SECONDS.labels('query_members').time():
+                    found = await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=False)
+        except Exception as e:
+            for futures in waiting.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        by_id = {member.id: member for member in found}
+        for user_id, futures in waiting.items():
+            member = by_id.get(user_id)
+            if member is None:
+                self.absent.set((guild.id, user_id), True)
+            else:
+                self.members.set((guild.id, user_id), member)
+            for future in futures:
+                if not future.done():
+                    future.set_result(member)
+
+    def stats(self):
+        return {
+            'members': self.members.stats(),
+            'absent': self.absent.stats(),
+            'queries': self.queries,
+            'fetches': self.fetches,
+        }
@@ -0,0 +1,223 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition, kept in-process so the hot paths pay for a dict lookup, a bisect and
+# a short lock per observation. Gauges are computed by callbacks when /metrics is scraped.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # label values -> child
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, *values):
+        """The child for one combination of label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """A monotonically increasing count, e.g. events received by type and outcome."""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+                for values, child in list(self._children.items())]
+
+
+class _HistogramChild:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Per bucket, the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(_Metric):
+    """Durations in seconds, bucketed so Prometheus can compute quantiles across instances."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        lines = []
+        for values, child in list(self._children.items()):
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}')
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read at scrape time from `collect`, which returns a number or {label values: number}."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def _samples(self):
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in values.items()]
+
+
+def timed(histogram):
+    """Decorator that observes each call's duration, for plain and async functions."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Every registered metric in Prometheus text format.
+
+    Gauges may query the database, so call this on a thread that may block (the Flask thread or
+    the database thread), not on the event loop.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# -- The bot's hot-path metrics, observed by the modules that do the work --
+
+WEBHOOK_REQUEST_SECONDS = Histogram(
+    'webhook_request_seconds', 'Time to verify, store and acknowledge a Stripe webhook.', ['server'])
+WEBHOOK_EVENTS = Counter(
+    'webhook_events_total', 'Stripe events by type and outcome (queued, duplicate, ignored, rejected, throttled, processed, failed, deferred, dead).',
+    ['type', 'outcome'])
+WEBHOOK_PROCESSING_SECONDS = Histogram(
+    'webhook_processing_seconds', 'Time for the inbox worker to apply one stored event.', ['type'],
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0))
+STRIPE_REQUEST_SECONDS = Histogram(
+    'stripe_request_seconds', 'Stripe API call latency by SDK method.', ['method'])
+STRIPE_ACCOUNT_REQUESTS = Counter(
+    'stripe_account_requests_total', 'Stripe HTTP request attempts, retries included, by connected account and outcome.',
+    ['account', 'outcome'])
+DB_CALL_SECONDS = Histogram(
+    'db_call_seconds', 'Time spent in a database function on the database thread.', ['function'])
+DISCORD_REQUEST_SECONDS = Histogram(
+    'discord_request_seconds', 'Discord API call latency for role changes, member lookups and DMs.', ['call'])
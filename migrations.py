@@ -0,0 +1,304 @@
+import time
+
+# Schema migrations, applied in order by migrate(). The version a database is at lives in
+# PRAGMA user_version, so each migration runs exactly once per database. Append new migrations
+# to MIGRATIONS, never edit one that has shipped.
+
+
+def _create_baseline(cursor):
+    """Tables as created by create_tables() before versioning (idempotent for existing databases)."""
+    # Create table to store server ID and Stripe Account ID with UNIQUE constraint on discord_server_id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS servers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_server_id TEXT UNIQUE NOT NULL,
+            stripe_account_id TEXT NOT NULL
+        )
+    ''')
+
+    # Create table to store plans, price IDs and the role each plan grants
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_server_id TEXT NOT NULL,
+            plan_name TEXT NOT NULL,
+            price_id TEXT NOT NULL,
+            role_id TEXT
+        )
+    ''')
+    _add_column_if_missing(cursor, 'plans', 'role_id', 'TEXT')
+
+    # Create table to persist incoming Stripe webhook events until the bot has processed them
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            stripe_account_id TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            received_at REAL NOT NULL,
+            processed_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_webhook_events_due ON webhook_events (status, next_attempt_at)
+    ''')
+
+    # Create tables that let an interrupted reconciliation run resume where it stopped
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_checkpoints (
+            discord_server_id TEXT PRIMARY KEY,
+            phase TEXT NOT NULL,
+            cursor TEXT,
+            started_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_expected (
+            discord_server_id TEXT NOT NULL,
+            discord_user_id TEXT NOT NULL,
+            role_id TEXT NOT NULL,
+            PRIMARY KEY (discord_server_id, discord_user_id, role_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Create table to remember how far the Stripe Events API catch-up got for each connected account
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_cursors (
+            stripe_account_id TEXT PRIMARY KEY,
+            last_event_created INTEGER NOT NULL,
+            last_event_id TEXT,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+    # Create tables for outgoing DM notifications and the users whose DMs are closed
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dm_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_dm_outbox_due ON dm_outbox (status, next_attempt_at)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dm_blocked (
+            discord_user_id TEXT PRIMARY KEY,
+            blocked_at REAL NOT NULL
+        )
+    ''')
+
+
+def _add_unique_keys(cursor):
+    """Unique keys for the servers and plans lookups, which were full scans or allowed duplicates."""
+    # db_setup.py used to create servers without the UNIQUE constraint, so an old database may
+    # hold several rows per guild. Keep the newest one, which is what INSERT OR REPLACE intended.
+    if not _has_unique_index(cursor, 'servers', ['discord_server_id']):
+        cursor.execute('''
+            CREATE TABLE servers_unique (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                discord_server_id TEXT UNIQUE NOT NULL,
+                stripe_account_id TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO servers_unique (id, discord_server_id, stripe_account_id)
+            SELECT id, discord_server_id, stripe_account_id FROM servers
+            WHERE id IN (SELECT MAX(id) FROM servers GROUP BY discord_server_id)
+        ''')
+        cursor.execute('DROP TABLE servers')
+        cursor.execute('ALTER TABLE servers_unique RENAME TO servers')
+
+    # Plan names were never unique per guild. /subscribe has always sold the oldest row (a full
+    # scan returns it first), so that one keeps the name and later duplicates get their id
+    # appended. Their prices stay routed, existing subscribers keep their roles.
+    renamed = cursor.execute('''
+        UPDATE plans SET plan_name = plan_name || ' (' || id || ')'
+        WHERE id NOT IN (SELECT MIN(id) FROM plans GROUP BY discord_server_id, plan_name)
+    ''').rowcount
+    if renamed:
+        print(f"Renamed {renamed} duplicate plan names while adding the unique index on plans.")
+
+    # get_price_id, and plan names in a guild in name order
+    cursor.execute('''
+        CREATE UNIQUE INDEX idx_plans_server_name ON plans (discord_server_id, plan_name)
+    ''')
+
+
+def _create_subscriptions(cursor):
+    """Latest known state of every Stripe subscription we route, keyed by its Stripe id."""
+    cursor.execute('''
+        CREATE TABLE subscriptions (
+            stripe_subscription_id TEXT PRIMARY KEY,
+            stripe_customer_id TEXT,
+            stripe_account_id TEXT,
+            discord_server_id TEXT NOT NULL,
+            discord_user_id TEXT,
+            price_id TEXT,
+            status TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX idx_subscriptions_customer ON subscriptions (stripe_customer_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX idx_subscriptions_member ON subscriptions (discord_server_id, discord_user_id, status)
+    ''')
+
+
+def _create_command_sync_hashes(cursor):
+    """Hash of the slash command tree last synced to each scope (a guild id, or 'global')."""
+    cursor.execute('''
+        CREATE TABLE command_sync_hashes (
+            scope TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            synced_at REAL NOT NULL
+        )
+    ''')
+
+
+def _add_event_guilds(cursor):
+    """The guild each stored webhook event belongs to, so sharded gateway workers claim only their own."""
+    cursor.execute('ALTER TABLE webhook_events ADD COLUMN discord_server_id TEXT')
+    # Every insert into the inbox looks the guild up by the event's connected account
+    cursor.execute('''
+        CREATE INDEX idx_servers_account ON servers (stripe_account_id)
+    ''')
+    cursor.execute('''
+        UPDATE webhook_events SET discord_server_id = (
+            SELECT discord_server_id FROM servers WHERE servers.stripe_account_id = webhook_events.stripe_account_id
+        )
+        WHERE status IN ('pending', 'processing')
+    ''')
+
+
+def _create_grace_timers(cursor):
+    """Pending role revocations after a failed payment, one per subscription and guild."""
+    cursor.execute('''
+        CREATE TABLE grace_timers (
+            stripe_subscription_id TEXT NOT NULL,
+            discord_server_id TEXT NOT NULL,
+            discord_user_id TEXT NOT NULL,
+            role_ids TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (stripe_subscription_id, discord_server_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX idx_grace_timers_due ON grace_timers (due_at)
+    ''')
+
+
+def _add_queue_positions(cursor):
+    """Claim order for the webhook inbox that takes turns between connected accounts."""
+    cursor.execute('ALTER TABLE webhook_events ADD COLUMN queue_position REAL')
+    # Events already waiting keep the order they had
+    cursor.execute('''
+        UPDATE webhook_events SET queue_position = next_attempt_at WHERE status IN ('pending', 'processing')
+    ''')
+    # claim_batch, and the queue's head for new events
+    cursor.execute('''
+        CREATE INDEX idx_webhook_events_queue ON webhook_events (status, queue_position)
+    ''')
+    # The tail of an account's queue for new events
+    cursor.execute('''
+        CREATE INDEX idx_webhook_events_account_queue ON webhook_events (status, stripe_account_id, queue_position)
+    ''')
+
+
+def _add_subscription_event_times(cursor):
+    """Stripe's created time of the newest event applied to each subscription, to skip older ones."""
+    cursor.execute('ALTER TABLE subscriptions ADD COLUMN last_event_created INTEGER')
+
+
+def _add_retention_indexes(cursor):
+    """Indexes for the sweep that trims processed webhook events."""
+    # Only processed events that still have their payload, so emptied ones aren't scanned again
+    cursor.execute('''
+        CREATE INDEX idx_webhook_events_payloads ON webhook_events (processed_at) WHERE status = 'done' AND payload != ''
+    ''')
+    cursor.execute('''
+        CREATE INDEX idx_webhook_events_processed ON webhook_events (status, processed_at)
+    ''')
+
+
+# (version, description, function) in the order they are applied
+MIGRATIONS = [
+    (1, 'baseline schema', _create_baseline),
+    (2, 'unique servers and plans', _add_unique_keys),
+    (3, 'subscriptions table', _create_subscriptions),
+    (4, 'command sync hashes', _create_command_sync_hashes),
+    (5, 'webhook event guilds', _add_event_guilds),
+    (6, 'grace period timers', _create_grace_timers),
+    (7, 'webhook queue positions', _add_queue_positions),
+    (8, 'subscription event times', _add_subscription_event_times),
+    (9, 'webhook retention indexes', _add_retention_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _add_column_if_missing(cursor, table, column, definition):
+    """ Add a column to a table created by an older version of create_tables() """
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _has_unique_index(cursor, table, columns):
+    for index in cursor.execute(f'PRAGMA index_list({table})').fetchall():
+        name, unique = index[1], index[2]
+        if unique and [row[2] for row in cursor.execute(f'PRAGMA index_info({name})')] == columns:
+            return True
+    return False
+
+
+def schema_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(connection, target=LATEST_VERSION):
+    """Apply every migration above the database's version up to `target`. Returns the new version.
+
+    Each migration commits together with its version bump, so a failure leaves the database at the
+    last complete version. Processes starting at the same time serialize on BEGIN IMMEDIATE.
+    """
+    if connection.in_transaction:
+        connection.commit()
+
+    current = schema_version(connection)
+    for version, description, apply in MIGRATIONS:
+        if version > target:
+            break
+        if version <= current:
+            continue  # Up to date, no need for the write lock
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Re-read under the write lock, another process may have just applied it
+            if schema_version(connection) >= version:
+                connection.rollback()
+                continue
+            started = time.perf_counter()
+            apply(connection.cursor())
+            connection.execute(f'PRAGMA user_version = {version}')
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        print(f"Applied schema migration {version} ({description}) in {time.perf_counter() - started:.2f}s")
+
+    return schema_version(connection)
@@ -0,0 +1,87 @@
+import sqlite3
+
+import pytest
+
+import migrations
+
+
+def baseline_database(path):
+    """A database as the unversioned db_setup.py and create_tables() left it, with some data."""
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_user_id TEXT NOT NULL,
+            stripe_customer_id TEXT,
+            subscription_status TEXT,
+            role_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE servers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_server_id TEXT NOT NULL,
+            stripe_account_id TEXT NOT NULL
+        );
+        CREATE TABLE plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            discord_server_id TEXT NOT NULL,
+            plan_name TEXT NOT NULL,
+            price_id TEXT NOT NULL
+        );
+        INSERT INTO users (discord_user_id, stripe_customer_id) VALUES ('42', 'cus_1');
+        INSERT INTO servers (discord_server_id, stripe_account_id) VALUES ('1', 'acct_old'), ('1', 'acct_new'), ('2', 'acct_2');
+        INSERT INTO plans (discord_server_id, plan_name, price_id) VALUES ('1', 'Gold', 'price_a'), ('1', 'Gold', 'price_b');
+    ''')
+    connection.commit()
+    return connection
+
+
+def schema(connection):
+    return connection.execute('SELECT type, name, sql FROM sqlite_master ORDER BY type, name').fetchall()
+
+
+@pytest.fixture
+def connection(tmp_path):
+    connection = baseline_database(str(tmp_path / 'baseline.db'))
+    yield connection
+    connection.close()
+
+
+def test_migrates_baseline_to_latest(connection):
+    assert migrations.schema_version(connection) == 0
+    assert migrations.migrate(connection) == migrations.LATEST_VERSION
+    assert migrations.schema_version(connection) == migrations.LATEST_VERSION
+
+    # The old users table is left alone
+    assert connection.execute('SELECT discord_user_id, stripe_customer_id FROM users').fetchall() == [('42', 'cus_1')]
+    # Duplicate servers rows keep the newest, duplicate plan names keep the oldest
+    assert connection.execute('SELECT discord_server_id, stripe_account_id FROM servers ORDER BY discord_server_id').fetchall() \
+        == [('1', 'acct_new'), ('2', 'acct_2')]
+    assert connection.execute('SELECT plan_name, price_id, role_id FROM plans ORDER BY id').fetchall() \
+        == [('Gold', 'price_a', None), ('Gold (2)', 'price_b', None)]
+    with pytest.raises(sqlite3.IntegrityError):
+        connection.execute("INSERT INTO servers (discord_server_id, stripe_account_id) VALUES ('2', 'acct_x')")
+
+    tables = {row[1] for row in schema(connection) if row[0] == 'table'}
+    assert {'webhook_events', 'subscriptions', 'grace_timers', 'dm_outbox', 'reconcile_checkpoints'} <= tables
+
+
+def test_migrates_step_by_step(connection):
+    for version, _, _ in migrations.MIGRATIONS:
+        assert migrations.migrate(connection, target=version) == version
+
+
+def test_rerunning_is_a_no_op(connection, capsys):
+    migrations.migrate(connection)
+    before = schema(connection)
+    capsys.readouterr()
+
+    assert migrations.migrate(connection) == migrations.LATEST_VERSION
+    assert schema(connection) == before
+    assert capsys.readouterr().out == ''
+
+
+def test_fresh_database(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / 'fresh.db'))
+    assert migrations.migrate(connection) == migrations.LATEST_VERSION
+    connection.close()
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import random
+import time
+
+import discord
+
+import async_db
+import metrics
+from cache import TTLCache
+from db_utils import get_db_connection, batch
+from role_scheduler import TokenBucket
+
+# Message states: pending -> sent, back to pending with a backoff after an error until
+# MAX_ATTEMPTS, dead after that, or skipped when the user does not accept DMs from us.
+MAX_ATTEMPTS = int(os.getenv('DM_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = 5.0
+RETRY_MAX_DELAY = 900.0
+
+# Discord limits messages per channel and overall, so each DM channel gets its own bucket and
+# all of them share a global one
+DM_CHANNEL_RATE = 1.0
+DM_CHANNEL_BURST = 5
+DM_GLOBAL_RATE = float(os.getenv('DM_GLOBAL_RATE', '20'))
+DM_GLOBAL_BURST = 20
+
+
+def enqueue_dm(discord_user_id, message):
+    """Queue a DM unless the user is known to have DMs closed. Returns False if it was skipped."""
+    now = time.time()
+    connection = get_db_connection()
+    cursor = connection.execute('''
+        INSERT INTO dm_outbox (discord_user_id, message, next_attempt_at, created_at)
+        SELECT ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM dm_blocked WHERE discord_user_id = ?)
+    ''', (str(discord_user_id), message, now, now, str(discord_user_id)))
+    connection.commit()
+    return cursor.rowcount == 1
+
+
+def claim_batch(limit):
+    """Mark up to `limit` due messages as sending and return them, oldest first."""
+    connection = get_db_connection()
+    rows = connection.execute('''
+        UPDATE dm_outbox
+        SET status = 'sending', attempts = attempts + 1
+        WHERE id IN (
+            SELECT id FROM dm_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        )
+        RETURNING id, discord_user_id, message, attempts
+    ''', (time.time(), limit)).fetchall()
+    connection.commit()
+    return sorted(rows, key=lambda row: row['id'])
+
+
+def retry_delay(attempts):
+    """Exponential backoff with full jitter for the given number of failed attempts."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def record_results(sent_ids, blocked, failures):
+    """Write a batch's outcomes in one transaction.
+
+    blocked is a list of (message id, user id) for users with DMs closed, failures a list of
+    (message id, attempts, error).
+    """
+    now = time.time()
+    with batch() as connection:
+        connection.executemany('''
+            UPDATE dm_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?
+        ''', [(now, message_id) for message_id in sent_ids])
+
+        connection.executemany('''
+            UPDATE dm_outbox SET status = 'skipped', last_error = 'DMs closed' WHERE id = ?
+        ''', [(message_id,) for message_id, _ in blocked])
+        connection.executemany('''
+            INSERT OR IGNORE INTO dm_blocked (discord_user_id, blocked_at) VALUES (?, ?)
+        ''', [(user_id, now) for _, user_id in blocked])
+        # Nothing else queued for them will get through either
+        connection.executemany('''
+            UPDATE dm_outbox SET status = 'skipped', last_error = 'DMs closed'
+            WHERE discord_user_id = ? AND status = 'pending'
+        ''', [(user_id,) for _, user_id in blocked])
+
+        for message_id, attempts, error in failures:
+            if attempts >= MAX_ATTEMPTS:
+                connection.execute('''
+                    UPDATE dm_outbox SET status = 'dead', last_error = ? WHERE id = ?
+                ''', (error, message_id))
+            else:
+                connection.execute('''
+                    UPDATE dm_outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?
+                ''', (now + retry_delay(attempts), error, message_id))
+
+
+def requeue_interrupted():
+    """Return messages left in sending by a crash or restart to the pending state."""
+    connection = get_db_connection()
+    cursor = connection.execute('''
+        UPDATE dm_outbox SET status = 'pending', next_attempt_at = ? WHERE status = 'sending'
+    ''', (time.time(),))
+    connection.commit()
+    return cursor.rowcount
+
+
+def unblock_user(discord_user_id):
+    """Allow DMs to a user again, e.g. after they tell us they reopened them. False if they weren't blocked."""
+    connection = get_db_connection()
+    cursor = connection.execute('DELETE FROM dm_blocked WHERE discord_user_id = ?', (str(discord_user_id),))
+    connection.commit()
+    return cursor.rowcount == 1
+
+
+def purge_finished(before, limit):
+    """Delete up to `limit` sent or skipped messages last attempted before `before`. Returns the number deleted."""
+    connection = get_db_connection()
+    cursor = connection.execute('''
+        DELETE FROM dm_outbox WHERE id IN (
+            SELECT id FROM dm_outbox WHERE status IN ('sent', 'skipped') AND next_attempt_at < ? LIMIT ?
+        )
+    ''', (before, limit))
+    connection.commit()
+    return cursor.rowcount
+
+
+def count_by_status():
+    """Number of outbox messages in each state."""
+    connection = get_db_connection()
+    rows = connection.execute('SELECT status, COUNT(*) AS total FROM dm_outbox GROUP BY status').fetchall()
+    return {row['status']: row['total'] for row in rows}
+
+
+class DMSender:
+    """Sends queued DMs from the outbox on the bot's loop, independently of role changes."""
+
+    def __init__(self, client, concurrency=8, batch_size=50, poll_interval=2.0):
+        self.client = client
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._global_bucket = TokenBucket(DM_GLOBAL_RATE, DM_GLOBAL_BURST)
+        self._channel_buckets = TTLCache('dm_channel_buckets', 10000, 60)  # user id -> TokenBucket
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """Wake the sender because a message was queued. Must be called on the sender's loop."""
+        self._wakeup.set()
+
+    async def send(self, discord_user_id, message):
+        """Queue a DM and wake the sender. Cheap enough to call from any event handler."""
+        if await async_db.run_db(enqueue_dm, discord_user_id, message):
+            self.notify()
+
+    async def _run(self):
+        await async_db.run_db(requeue_interrupted)
+
+        while True:
+            try:
+                messages = await async_db.run_db(claim_batch, self.batch_size)
+            except Exception as e:
+                print(f"Error claiming DMs: {e}")
+                messages = []
+
+            if not messages:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._send_batch(messages)
+
+    async def _send_batch(self, messages):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sent_ids = []
+        blocked = []
+        failures = []
+
+        async def deliver(row):
+            async with semaphore:
+                user_id = row['discord_user_id']
+                bucket = self._channel_buckets.get_or_load(user_id, lambda: TokenBucket(DM_CHANNEL_RATE, DM_CHANNEL_BURST))
+                await bucket.acquire()
+                await self._global_bucket.acquire()
+                try:
+                    user = self.client.get_user(int(user_id))
+                    if user is None:
+                        with metrics.DISCORD_REQUEST_SECONDS.labels('fetch_user').time():
+                            user = await self.client.fetch_user(int(user_id))
+                    with metrics.DISCORD_REQUEST_SECONDS.labels('send_dm').time():
+                        await user.send(row['message'])
+                    sent_ids.append(row['id'])
+                except discord.Forbidden:
+                    # DMs closed or no shared server, retrying will never work
+                    blocked.append((row['id'], user_id))
+                except discord.NotFound:
+                    blocked.append((row['id'], user_id))
+                except Exception as e:
+                    print(f"Error sending DM {row['id']} to {user_id} (attempt {row['attempts']}): {e}")
+                    failures.append((row['id'], row['attempts'], repr(e)))
+
+        await asyncio.gather(*(deliver(row) for row in messages))
+        await async_db.run_db(record_results, sent_ids, blocked, failures)
+        self.sent += len(sent_ids)
+        self.skipped += len(blocked)
+        self.failed += len(failures)
+
+    def stats(self):
+        return {'sent': self.sent, 'skipped': self.skipped, 'failed': self.failed}
@@ -3,6 +3,7 @@ import os
 from flask import Flask, request, redirect, session, url_for
 from dotenv import load_dotenv
 import sqlite3
+import stripe_gateway
 
 load_dotenv()
 
@@ -11,6 +12,7 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY')  # Generate a secret key for your
 
 # Stripe keys
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+stripe_gateway.configure()  # Pooled keep-alive connections and retries for every Stripe call
 
 # OAuth Client ID from Stripe Dashboard
 CLIENT_ID = os.getenv('STRIPE_CLIENT_ID')
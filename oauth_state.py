@@ -0,0 +1,66 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+from cache import TTLCache
+
+# The OAuth `state` carries the guild and user that asked to connect Stripe, as
+# "<guild id>.<user id>.<expires at>.<nonce>.<signature>" with an HMAC-SHA256 signature over the
+# rest. Any HTTP worker holding the secret can check it, no shared memory or database lookup.
+STATE_TTL = 900  # Seconds a /connect_stripe link stays usable
+MAX_STATE_LENGTH = 200
+
+
+class InvalidStateError(ValueError):
+    """The state is malformed, forged, expired or was already used."""
+
+
+class OAuthStateSigner:
+    """Issues and checks signed, expiring OAuth state tokens for one secret."""
+
+    def __init__(self, secret, ttl=STATE_TTL, max_used_nonces=100000):
+        self._key = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+        self.ttl = ttl
+        # Nonces of states already redeemed, kept until the state would have expired anyway. Per
+        # process; Stripe's codes are single use too, so a replay elsewhere fails at the exchange.
+        self._used_nonces = TTLCache('oauth_state_nonces', max_used_nonces, ttl)
+        self._consume_lock = threading.Lock()
+
+    def _sign(self, message):
+        mac = self._key.copy()
+        mac.update(message.encode())
+        return base64.urlsafe_b64encode(mac.digest()).rstrip(b'=').decode()
+
+    def issue(self, discord_server_id, discord_user_id, now=None):
+        """A state for one guild and user, valid for `ttl` seconds."""
+        expires_at = int((time.time() if now is None else now) + self.ttl)
+        message = f'{discord_server_id}.{discord_user_id}.{expires_at}.{secrets.token_urlsafe(12)}'
+        return f'{message}.{self._sign(message)}'
+
+    def verify(self, state, now=None):
+        """Check a state's signature and expiry. Returns (discord_server_id, discord_user_id, nonce)."""
+        if not state or len(state) > MAX_STATE_LENGTH:
+            raise InvalidStateError("Missing or oversized state")
+        message, _, signature = state.rpartition('.')
+        parts = message.split('.')
+        if len(parts) != 4:
+            raise InvalidStateError("Malformed state")
+        if not hmac.compare_digest(self._sign(message).encode(), signature.encode()):
+            raise InvalidStateError("Bad state signature")
+
+        discord_server_id, discord_user_id, expires_at, nonce = parts
+        if int(expires_at) < (time.time() if now is None else now):
+            raise InvalidStateError("The link has expired, run /connect_stripe again")
+        return discord_server_id, discord_user_id, nonce
+
+    def consume(self, state, now=None):
+        """verify() the state and mark it used, so it can't be redeemed again."""
+        discord_server_id, discord_user_id, nonce = self.verify(state, now)
+        with self._consume_lock:
+            if self._used_nonces.get(nonce) is not None:
+                raise InvalidStateError("The link was already used, run /connect_stripe again")
+            self._used_nonces.set(nonce, True)
+        return discord_server_id, discord_user_id
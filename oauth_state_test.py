@@ -0,0 +1,63 @@
+import pytest
+
+from oauth_state import InvalidStateError, OAuthStateSigner
+
+NOW = 1700000000
+
+
+def test_round_trip():
+    signer = OAuthStateSigner('secret', ttl=900)
+    state = signer.issue('123', '456', now=NOW)
+    discord_server_id, discord_user_id, nonce = signer.verify(state, now=NOW + 899)
+    assert (discord_server_id, discord_user_id) == ('123', '456')
+    assert nonce
+    assert signer.issue('123', '456', now=NOW) != state
+
+
+def test_verified_by_another_signer_with_the_same_secret():
+    state = OAuthStateSigner('secret').issue('123', '456', now=NOW)
+    assert OAuthStateSigner('secret').consume(state, now=NOW) == ('123', '456')
+
+
+def test_expired():
+    signer = OAuthStateSigner('secret', ttl=900)
+    state = signer.issue('123', '456', now=NOW)
+    with pytest.raises(InvalidStateError, match='expired'):
+        signer.verify(state, now=NOW + 901)
+
+
+def test_tampered_signature():
+    signer = OAuthStateSigner('secret')
+    state = signer.issue('123', '456', now=NOW)
+    message, _, signature = state.rpartition('.')
+    with pytest.raises(InvalidStateError, match='signature'):
+        signer.verify(f"{message}.{signature[:-1]}{'A' if signature[-1] != 'A' else 'B'}", now=NOW)
+
+
+def test_tampered_guild():
+    signer = OAuthStateSigner('secret')
+    state = signer.issue('123', '456', now=NOW)
+    with pytest.raises(InvalidStateError, match='signature'):
+        signer.verify('999' + state[len('123'):], now=NOW)
+
+
+def test_other_secret():
+    state = OAuthStateSigner('secret').issue('123', '456', now=NOW)
+    with pytest.raises(InvalidStateError):
+        OAuthStateSigner('other secret').verify(state, now=NOW)
+
+
+@pytest.mark.parametrize('state', [None, '', 'abc', 'a.b.c', 'x' * 201])
+def test_malformed(state):
+    with pytest.raises(InvalidStateError):
+        OAuthStateSigner('secret').verify(state, now=NOW)
+
+
+def test_single_use():
+    signer = OAuthStateSigner('secret')
+    state = signer.issue('123', '456', now=NOW)
+    assert signer.consume(state, now=NOW) == ('123', '456')
+    with pytest.raises(InvalidStateError, match='already used'):
+        signer.consume(state, now=NOW)
+    # Other states of the same guild and user are unaffected
+    assert signer.consume(signer.issue('123', '456', now=NOW), now=NOW) == ('123', '456')
@@ -2,6 +2,7 @@ import stripe
 from flask import Flask, request, redirect, url_for, session
 import os
 from db_utils import save_stripe_account
+import stripe_gateway
 
 # Load environment variables from .env (ensure you have Flask, stripe, and python-dotenv installed)
 from dotenv import load_dotenv
@@ -16,6 +17,7 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY', 'supersecretkey')  # Replace 'sup
 
 # Stripe API keys
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+stripe_gateway.configure()  # Pooled keep-alive connections and retries for every Stripe call
 
 # Client ID for OAuth (from your Stripe Connect settings)
 CLIENT_ID = os.getenv('STRIPE_CLIENT_ID')
@@ -0,0 +1,215 @@
+"""Create many subscription plans at once from a CSV or JSON file.
+
+Each row needs plan_name, price and role_id, and may set currency (default usd) and interval
+(day, week, month or year, default month). CSV files need a header row, JSON files hold a list of objects
+with the same keys. Used by the /import_plans command, or from the command line:
+
+    python plan_import.py --guild 123456789012345678 plans.csv
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+import stripe
+from dotenv import load_dotenv
+
+import async_db
+import db_utils
+import stripe_gateway
+
+MAX_ROWS = 500
+INTERVALS = ('day', 'week', 'month', 'year')
+
+# Stripe amounts are in the currency's smallest unit, which isn't always a hundredth
+# (https://docs.stripe.com/currencies#zero-decimal)
+ZERO_DECIMAL_CURRENCIES = {'bif', 'clp', 'djf', 'gnf', 'jpy', 'kmf', 'krw', 'mga', 'pyg', 'rwf', 'ugx',
+                           'vnd', 'vuv', 'xaf', 'xof', 'xpf'}
+THREE_DECIMAL_CURRENCIES = {'bhd', 'jod', 'kwd', 'omr', 'tnd'}
+MAX_UNIT_AMOUNT = 99999999  # Stripe's limit on unit_amount
+
+PlanRow = namedtuple('PlanRow', ['line', 'plan_name', 'unit_amount', 'role_id', 'currency', 'interval'])
+# status is created, exists, invalid or failed; detail is the price id or what went wrong
+RowResult = namedtuple('RowResult', ['line', 'plan_name', 'status', 'detail'])
+
+
+def parse_rows(data, filename=''):
+    """Parse an import file into (rows, results for rows that were rejected)."""
+    text = data.decode('utf-8-sig')
+    if filename.lower().endswith('.json') or text.lstrip().startswith('['):
+        records = json.loads(text)
+        if not isinstance(records, list):
+            raise ValueError("JSON import must be a list of plans")
+        numbered = [(index + 1, record) for index, record in enumerate(records)]
+    else:
+        # Line numbers as seen in a spreadsheet, the header is line 1
+        numbered = [(index + 2, record) for index, record in enumerate(csv.DictReader(io.StringIO(text)))]
+
+    if len(numbered) > MAX_ROWS:
+        raise ValueError(f"At most {MAX_ROWS} plans can be imported at once")
+
+    rows, rejected = [], []
+    for line, record in numbered:
+        try:
+            rows.append(_parse_record(line, record))
+        except ValueError as e:
+            name = str(record.get('plan_name', '')) if isinstance(record, dict) else ''
+            rejected.append(RowResult(line, name, 'invalid', str(e)))
+    return rows, rejected
+
+
+def _parse_record(line, record):
+    if not isinstance(record, dict):
+        raise ValueError("not an object")
+    plan_name = str(record.get('plan_name') or '').strip()
+    if not plan_name:
+        raise ValueError("plan_name is missing")
+    currency = str(record.get('currency') or 'usd').strip().lower()
+    if len(currency) != 3 or not currency.isalpha():
+        raise ValueError("currency must be a three-letter ISO code")
+    try:
+        amount = Decimal(str(record.get('price', '')).strip())
+    except InvalidOperation:
+        raise ValueError("price is not a number")
+    unit_amount = to_unit_amount(amount, currency)
+    role_id = str(record.get('role_id') or '').strip()
+    if not role_id.isdigit():
+        raise ValueError("role_id must be a Discord role id")
+    interval = str(record.get('interval') or 'month').strip().lower()
+    if interval not in INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(INTERVALS)}")
+    return PlanRow(line, plan_name, unit_amount, role_id, currency, interval)
+
+
+def to_unit_amount(amount, currency):
+    """A Decimal price in the currency's smallest unit, rejecting prices it can't represent exactly."""
+    if not amount.is_finite():
+        raise ValueError("price must be a finite number")
+    if amount <= 0:
+        raise ValueError("price must be positive")
+    if currency in ZERO_DECIMAL_CURRENCIES:
+        exponent = 0
+    elif currency in THREE_DECIMAL_CURRENCIES:
+        exponent = 3
+    else:
+        exponent = 2
+    # Decimal keeps e.g. 19.99 from becoming 1998 cents
+    unit_amount = amount.scaleb(exponent)
+    if unit_amount != unit_amount.to_integral_value():
+        raise ValueError(f"price has more decimal places than {currency.upper()} allows")
+    if exponent == 3 and unit_amount % 10:
+        raise ValueError(f"{currency.upper()} prices must end in 0 in the third decimal place")
+    if unit_amount > MAX_UNIT_AMOUNT:
+        raise ValueError("price is too large")
+    return int(unit_amount)
+
+
+def idempotency_key(discord_server_id, row):
+    """The same plan always maps to the same key, so re-running an import reuses its prices."""
+    identity = json.dumps([discord_server_id, row.plan_name, row.unit_amount, row.currency, row.interval])
+    return 'plan-import-' + hashlib.sha256(identity.encode()).hexdigest()
+
+
+async def import_plans(discord_server_id, stripe_account_id, rows, role_ids=None, concurrency=stripe_gateway.STRIPE_MAX_WORKERS):
+    """Create prices for rows concurrently and save the new plans in one transaction.
+
+    role_ids, if given, is the set of role ids that exist in the guild. Returns a RowResult per row.
+    """
+    results = {}
+    to_create = []
+    seen = set()
+    for row in rows:
+        if row.plan_name.casefold() in seen:
+            results[row.line] = RowResult(row.line, row.plan_name, 'invalid', "duplicate plan_name in the file")
+        elif db_utils.plan_name_index.has(discord_server_id, row.plan_name):
+            results[row.line] = RowResult(row.line, row.plan_name, 'exists', "a plan with this name already exists")
+        elif role_ids is not None and row.role_id not in role_ids:
+            results[row.line] = RowResult(row.line, row.plan_name, 'invalid', f"role {row.role_id} not found")
+        else:
+            to_create.append(row)
+        seen.add(row.plan_name.casefold())
+
+    semaphore = asyncio.Semaphore(concurrency)
+    prices = {}
+
+    async def create(row):
+        async with semaphore:
+            try:
+                price = await stripe_gateway.create_recurring_price(
+                    row.plan_name, row.unit_amount, stripe_account_id, row.currency, row.interval,
+                    idempotency_key=idempotency_key(discord_server_id, row))
+                prices[row.line] = price.id
+            except stripe.error.StripeError as e:
+                results[row.line] = RowResult(row.line, row.plan_name, 'failed', str(e.user_message or e))
+
+    await asyncio.gather(*(create(row) for row in to_create))
+
+    created = [row for row in to_create if row.line in prices]
+    try:
+        await async_db.run_db(db_utils.save_plans, discord_server_id,
+                              [(row.plan_name, prices[row.line], row.role_id) for row in created])
+    except Exception as e:
+        # Nothing was saved. The prices exist in Stripe, and re-running the import gets the same
+        # ones back through the idempotency keys instead of creating more.
+        for row in created:
+            results[row.line] = RowResult(row.line, row.plan_name, 'failed', f"not saved: {e}")
+    else:
+        for row in created:
+            results[row.line] = RowResult(row.line, row.plan_name, 'created', prices[row.line])
+
+    return [results[row.line] for row in rows]
+
+
+def format_results(results):
+    """One line per row, as a CSV report."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['line', 'plan_name', 'status', 'detail'])
+    writer.writerows(sorted(results))
+    return output.getvalue()
+
+
+def summarize(results):
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    return ', '.join(f"{count} {status}" for status, count in sorted(counts.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guild', required=True, help="Discord server id to import the plans into")
+    parser.add_argument('file', help="CSV or JSON file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+    stripe_gateway.configure()
+    db_utils.create_tables()
+    db_utils.load_routing_index()
+
+    stripe_account_id = db_utils.get_stripe_account(args.guild)
+    if stripe_account_id is None:
+        raise SystemExit(f"No Stripe account connected for server {args.guild}")
+
+    with open(args.file, 'rb') as f:
+        rows, rejected = parse_rows(f.read(), args.file)
+
+    async def run():
+        try:
+            return await import_plans(args.guild, stripe_account_id, rows)
+        finally:
+            stripe_gateway.shutdown()
+
+    results = rejected + asyncio.run(run())
+    print(format_results(results), end='')
+    print(summarize(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import sqlite3
+import types
+
+import pytest
+
+import db_utils
+import plan_import
+import stripe_gateway
+
+GUILD = '111'
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_utils, 'DB_PATH', str(tmp_path / 'test.db'))
+    db_utils.close_connections()  # Connections opened on the old path are reopened on the new one
+    db_utils.create_tables()
+    db_utils.load_routing_index()
+    yield
+    db_utils.close_connections()
+
+
+@pytest.fixture
+def prices(monkeypatch):
+    created = []
+
+    async def create_recurring_price(plan_name, unit_amount, stripe_account_id, currency, interval, idempotency_key):
+        created.append((plan_name, unit_amount, currency, interval))
+        return types.SimpleNamespace(id=f'price_{plan_name}')
+
+    monkeypatch.setattr(stripe_gateway, 'create_recurring_price', create_recurring_price)
+    return created
+
+
+def parse_json(records):
+    return plan_import.parse_rows(json.dumps(records).encode(), 'plans.json')
+
+
+def test_parses_csv():
+    data = b'plan_name,price,role_id,currency,interval\nGold,19.99,100,,\nYen,1000,200,JPY,year\n'
+    rows, rejected = plan_import.parse_rows(data, 'plans.csv')
+    assert rejected == []
+    assert rows == [plan_import.PlanRow(2, 'Gold', 1999, '100', 'usd', 'month'),
+                    plan_import.PlanRow(3, 'Yen', 1000, '200', 'jpy', 'year')]
+
+
+@pytest.mark.parametrize('price, currency, unit_amount', [
+    ('19.99', 'usd', 1999), ('5', 'eur', 500), ('1000', 'jpy', 1000), ('1.250', 'kwd', 1250),
+])
+def test_unit_amount_per_currency(price, currency, unit_amount):
+    rows, rejected = parse_json([{'plan_name': 'Gold', 'price': price, 'role_id': '100', 'currency': currency}])
+    assert rejected == []
+    assert rows[0].unit_amount == unit_amount
+
+
+@pytest.mark.parametrize('record', [
+    {'price': 'NaN'}, {'price': 'sNaN'}, {'price': 'Infinity'}, {'price': 'abc'}, {'price': ''},
+    {'price': '0'}, {'price': '-5'}, {'price': '19.999'}, {'price': '1000000'},
+    {'price': '10.5', 'currency': 'jpy'}, {'price': '1.005', 'currency': 'kwd'},
+    {'currency': 'us'}, {'currency': '12a'}, {'role_id': 'admin'}, {'interval': 'fortnight'}, {'plan_name': ' '},
+])
+def test_rejects_invalid_rows(record):
+    rows, rejected = parse_json([{'plan_name': 'Gold', 'price': '5', 'role_id': '100', **record}])
+    assert rows == []
+    assert [result.status for result in rejected] == ['invalid']
+
+
+def test_rejects_non_finite_json_numbers():
+    rows, rejected = plan_import.parse_rows(b'[{"plan_name": "Gold", "price": NaN, "role_id": "100"}]', 'plans.json')
+    assert rows == [] and rejected[0].status == 'invalid'
+
+
+def test_too_many_rows():
+    with pytest.raises(ValueError):
+        parse_json([{'plan_name': f'plan{index}', 'price': '5', 'role_id': '1'}
+                    for index in range(plan_import.MAX_ROWS + 1)])
+
+
+def test_import_skips_duplicate_existing_and_unknown_roles(database, prices):
+    db_utils.save_plan(GUILD, 'Existing', 'price_existing', '100')
+    rows, _ = parse_json([
+        {'plan_name': 'Gold', 'price': '5', 'role_id': '100'},
+        {'plan_name': 'gold', 'price': '6', 'role_id': '100'},
+        {'plan_name': 'Existing', 'price': '5', 'role_id': '100'},
+        {'plan_name': 'Silver', 'price': '5', 'role_id': '999'},
+    ])
+    results = asyncio.run(plan_import.import_plans(GUILD, 'acct_1', rows, role_ids={'100'}))
+    assert [(result.plan_name, result.status) for result in results] == [
+        ('Gold', 'created'), ('gold', 'invalid'), ('Existing', 'exists'), ('Silver', 'invalid')]
+    assert [plan_name for plan_name, *_ in prices] == ['Gold']
+    assert db_utils.load_price_id(GUILD, 'Gold') == 'price_Gold'
+
+
+def test_save_plans_is_all_or_nothing(database):
+    db_utils.save_plan(GUILD, 'Gold', 'price_gold', '100')
+    with pytest.raises(sqlite3.IntegrityError):
+        db_utils.save_plans(GUILD, [('Silver', 'price_silver', '200'), ('Gold', 'price_gold_2', '100')])
+    assert db_utils.load_price_id(GUILD, 'Silver') is None
+    assert db_utils.load_price_id(GUILD, 'Gold') == 'price_gold'
+    assert not db_utils.plan_name_index.has(GUILD, 'Silver')
+
+
+def test_import_reports_every_plan_failed_when_saving_fails(database, prices, monkeypatch):
+    def save_plans(discord_server_id, plans):
+        with db_utils.batch():
+            db_utils.save_plan(discord_server_id, *plans[0])
+            raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(db_utils, 'save_plans', save_plans)
+    rows, _ = parse_json([{'plan_name': 'Gold', 'price': '5', 'role_id': '100'},
+                          {'plan_name': 'Silver', 'price': '5', 'role_id': '100'}])
+    results = asyncio.run(plan_import.import_plans(GUILD, 'acct_1', rows))
+    assert [result.status for result in results] == ['failed', 'failed']
+    assert db_utils.load_price_id(GUILD, 'Gold') is None
@@ -0,0 +1,261 @@
+import asyncio
+import os
+import time
+
+import discord
+import stripe
+
+import async_db
+import grace_timers
+import routing
+import stripe_gateway
+from db_utils import get_db_connection, get_member_subscriptions, batch, routing_index
+
+# Subscription states that still entitle the subscriber to the plan's role. Stripe keeps a
+# subscription past_due through all its payment retries, it only counts while the grace period
+# started by the failed payment is still running.
+ENTITLED_STATUSES = ('active', 'trialing')
+GRACE_STATUSES = ('past_due',)
+SUBSCRIPTION_PAGE_SIZE = 100
+MEMBER_CHUNK_SIZE = 1000
+# An interrupted run older than this starts over, its snapshot of Stripe is too stale to act on
+CHECKPOINT_MAX_AGE = int(os.getenv('RECONCILE_CHECKPOINT_MAX_AGE', '3600'))  # Seconds
+
+# A run goes through these phases, the checkpoint records the phase and the last id handled in it
+PHASE_SUBSCRIPTIONS = 'subscriptions'
+PHASE_MEMBERS = 'members'
+
+
+# -- Checkpoint storage (runs on the database thread) --
+
+def load_checkpoint(discord_server_id):
+    """Return (phase, cursor, started_at) of an interrupted run for the guild, or None."""
+    row = get_db_connection().execute('''
+        SELECT phase, cursor, started_at FROM reconcile_checkpoints WHERE discord_server_id = ?
+    ''', (discord_server_id,)).fetchone()
+    return (row['phase'], row['cursor'], row['started_at']) if row else None
+
+
+def start_checkpoint(discord_server_id, started_at):
+    """Begin a fresh run for the guild, discarding anything left from an older one."""
+    with batch() as connection:
+        connection.execute('DELETE FROM reconcile_expected WHERE discord_server_id = ?', (discord_server_id,))
+        connection.execute('''
+            INSERT OR REPLACE INTO reconcile_checkpoints (discord_server_id, phase, cursor, started_at, updated_at)
+            VALUES (?, ?, NULL, ?, ?)
+        ''', (discord_server_id, PHASE_SUBSCRIPTIONS, started_at, started_at))
+
+
+def save_subscription_page(discord_server_id, expected, cursor):
+    """Record a page of expected (user id, role id) pairs and advance the checkpoint past it."""
+    with batch() as connection:
+        connection.executemany('''
+            INSERT OR IGNORE INTO reconcile_expected (discord_server_id, discord_user_id, role_id)
+            VALUES (?, ?, ?)
+        ''', [(discord_server_id, user_id, role_id) for user_id, role_id in expected])
+        connection.execute('''
+            UPDATE reconcile_checkpoints SET cursor = ?, updated_at = ? WHERE discord_server_id = ?
+        ''', (cursor, time.time(), discord_server_id))
+
+
+def advance_checkpoint(discord_server_id, phase, cursor):
+    connection = get_db_connection()
+    connection.execute('''
+        UPDATE reconcile_checkpoints SET phase = ?, cursor = ?, updated_at = ? WHERE discord_server_id = ?
+    ''', (phase, cursor, time.time(), discord_server_id))
+    connection.commit()
+
+
+def expected_roles(discord_server_id, user_ids):
+    """Expected role ids for a chunk of members, as {user id: set of role ids}."""
+    placeholders = ','.join('?' * len(user_ids))
+    rows = get_db_connection().execute(f'''
+        SELECT discord_user_id, role_id FROM reconcile_expected
+        WHERE discord_server_id = ? AND discord_user_id IN ({placeholders})
+    ''', (discord_server_id, *user_ids)).fetchall()
+
+    expected = {}
+    for row in rows:
+        expected.setdefault(row['discord_user_id'], set()).add(row['role_id'])
+    return expected
+
+
+def entitled_since(discord_server_id, user_ids, since):
+    """Role ids members became entitled to after `since`, as {user id: set of role ids}.
+
+    Webhooks keep the subscriptions table current while a run is going, this catches
+    subscriptions that started or recovered after the run listed them from Stripe.
+    """
+    entitled = {}
+    for user_id in user_ids:
+        rows = [row for row in get_member_subscriptions(discord_server_id, user_id) if row['updated_at'] >= since]
+        in_grace = grace_timers.pending_subscriptions(
+            discord_server_id, [row['stripe_subscription_id'] for row in rows if row['status'] in GRACE_STATUSES])
+        price_ids = [row['price_id'] for row in rows
+                     if row['status'] in ENTITLED_STATUSES or row['stripe_subscription_id'] in in_grace]
+        role_ids = routing_index.role_ids_for_prices(discord_server_id, price_ids)
+        if role_ids:
+            entitled[user_id] = role_ids
+    return entitled
+
+
+def finish_checkpoint(discord_server_id):
+    with batch() as connection:
+        connection.execute('DELETE FROM reconcile_expected WHERE discord_server_id = ?', (discord_server_id,))
+        connection.execute('DELETE FROM reconcile_checkpoints WHERE discord_server_id = ?', (discord_server_id,))
+
+
+def interrupted_guilds():
+    """Guilds whose last run did not finish."""
+    rows = get_db_connection().execute('SELECT discord_server_id FROM reconcile_checkpoints').fetchall()
+    return [row['discord_server_id'] for row in rows]
+
+
+def connected_servers():
+    rows = get_db_connection().execute('SELECT discord_server_id, stripe_account_id FROM servers').fetchall()
+    return [(row['discord_server_id'], row['stripe_account_id']) for row in rows]
+
+
+class Reconciler:
+    """Compares Stripe subscriptions with guild roles and queues only the differences.
+
+    Subscriptions are streamed a page at a time into the reconcile_expected table and guild
+    members are streamed in chunks, so memory stays bounded by one page however big the guild is.
+    """
+
+    def __init__(self, bot, role_scheduler, shards=None):
+        self.bot = bot
+        self.role_scheduler = role_scheduler
+        self.shards = shards  # cluster.Shards this worker runs, other workers reconcile the other guilds
+        self._running = set()  # Guild ids with a run in progress
+
+    async def reconcile_all(self, resume_only=False):
+        """Reconcile every connected guild, or only finish runs that were interrupted."""
+        if resume_only:
+            guild_ids = await async_db.run_db(interrupted_guilds)
+            servers = [server for server in await async_db.run_db(connected_servers) if server[0] in guild_ids]
+        else:
+            servers = await async_db.run_db(connected_servers)
+        if self.shards is not None:
+            servers = [server for server in servers if self.shards.owns(server[0])]
+
+        results = {}
+        for discord_server_id, stripe_account_id in servers:
+            try:
+                results[discord_server_id] = await self.reconcile_guild(discord_server_id, stripe_account_id)
+            except Exception as e:
+                print(f"Error reconciling guild {discord_server_id}: {e}")
+        return results
+
+    async def reconcile_guild(self, discord_server_id, stripe_account_id):
+        """Reconcile one guild, resuming from its checkpoint if a previous run was interrupted."""
+        if discord_server_id in self._running:
+            raise RuntimeError("A resync is already running for this server")
+
+        guild = self.bot.get_guild(int(discord_server_id))
+        if guild is None:
+            raise RuntimeError(f"Guild {discord_server_id} not found")
+
+        self._running.add(discord_server_id)
+        try:
+            checkpoint = await async_db.run_db(load_checkpoint, discord_server_id)
+            if checkpoint is not None and time.time() - checkpoint[2] > CHECKPOINT_MAX_AGE:
+                print(f"Discarding reconciliation of guild {discord_server_id} started "
+                      f"{time.time() - checkpoint[2]:.0f} s ago")
+                checkpoint = None
+            if checkpoint is None:
+                started_at = time.time()
+                await async_db.run_db(start_checkpoint, discord_server_id, started_at)
+                checkpoint = (PHASE_SUBSCRIPTIONS, None, started_at)
+            else:
+                print(f"Resuming reconciliation of guild {discord_server_id} at {checkpoint[:2]}")
+
+            phase, cursor, started_at = checkpoint
+            stats = {'subscriptions': 0, 'members': 0, 'granted': 0, 'revoked': 0}
+
+            if phase == PHASE_SUBSCRIPTIONS:
+                await self._stream_subscriptions(discord_server_id, stripe_account_id, cursor, stats)
+                await async_db.run_db(advance_checkpoint, discord_server_id, PHASE_MEMBERS, None)
+                cursor = None
+
+            await self._diff_members(guild, discord_server_id, cursor, started_at, stats)
+            await async_db.run_db(finish_checkpoint, discord_server_id)
+            print(f"Reconciled guild {discord_server_id}: {stats}")
+            return stats
+        finally:
+            self._running.discard(discord_server_id)
+
+    async def _stream_subscriptions(self, discord_server_id, stripe_account_id, cursor, stats):
+        # Page with starting_after ourselves (what auto_paging_iter does internally) so each
+        # page's last id can be checkpointed and every request runs on the Stripe pool
+        while True:
+            params = {'limit': SUBSCRIPTION_PAGE_SIZE, 'stripe_account': stripe_account_id}
+            if cursor:
+                params['starting_after'] = cursor
+            page = await stripe_gateway.call(stripe.Subscription.list, **params)
+
+            in_grace = await async_db.run_db(
+                grace_timers.pending_subscriptions, discord_server_id,
+                [subscription.id for subscription in page.data if subscription.get('status') in GRACE_STATUSES])
+
+            expected = []
+            for subscription in page.data:
+                stats['subscriptions'] += 1
+                if subscription.get('status') not in ENTITLED_STATUSES and subscription.id not in in_grace:
+                    continue
+                user_id = routing.discord_user_id(subscription)
+                if not user_id:
+                    continue
+                role_ids = routing_index.role_ids_for_prices(discord_server_id, routing.price_ids(subscription))
+                expected.extend((user_id, role_id) for role_id in role_ids)
+
+            if not page.data:
+                break
+            cursor = page.data[-1].id
+            await async_db.run_db(save_subscription_page, discord_server_id, expected, cursor)
+            if not page.has_more:
+                break
+
+    async def _diff_members(self, guild, discord_server_id, cursor, started_at, stats):
+        managed_role_ids = routing_index.role_ids_for_guild(discord_server_id)
+        after = discord.Object(id=int(cursor)) if cursor else None
+
+        chunk = []
+        async for member in guild.fetch_members(limit=None, after=after):
+            chunk.append(member)
+            if len(chunk) >= MEMBER_CHUNK_SIZE:
+                await self._apply_chunk(guild, discord_server_id, chunk, managed_role_ids, started_at, stats)
+                chunk = []
+        if chunk:
+            await self._apply_chunk(guild, discord_server_id, chunk, managed_role_ids, started_at, stats)
+
+    async def _apply_chunk(self, guild, discord_server_id, members, managed_role_ids, started_at, stats):
+        expected = await async_db.run_db(expected_roles, discord_server_id, [str(member.id) for member in members])
+
+        # The snapshot is as old as the run, check revocations against what webhooks recorded since
+        revoking = [str(member.id) for member in members
+                    if ({str(role.id) for role in member.roles} & managed_role_ids) - expected.get(str(member.id), set())]
+        entitled = {}
+        if revoking:
+            entitled = await async_db.run_db(entitled_since, discord_server_id, revoking, started_at)
+
+        futures = []
+        for member in members:
+            have = {str(role.id) for role in member.roles} & managed_role_ids
+            want = expected.get(str(member.id), set())
+            add = [guild.get_role(int(role_id)) for role_id in want - have]
+            remove = [guild.get_role(int(role_id)) for role_id in have - want - entitled.get(str(member.id), set())]
+            add = [role for role in add if role is not None]
+            remove = [role for role in remove if role is not None]
+            if add or remove:
+                stats['granted'] += len(add)
+                stats['revoked'] += len(remove)
+                futures.append(self.role_scheduler.submit(guild, member.id, add=add, remove=remove))
+
+        stats['members'] += len(members)
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f"Error applying reconciled roles in guild {discord_server_id}: {result}")
+
+        # Members come back in id order, so the last one is where a resumed run picks up
+        await async_db.run_db(advance_checkpoint, discord_server_id, PHASE_MEMBERS, str(members[-1].id))
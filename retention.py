@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+
+import async_db
+import catchup
+import notifications
+import webhook_inbox
+
+# Processed webhook events keep their payload for WEBHOOK_PAYLOAD_RETENTION, to look into what an
+# event did. Their id stays for WEBHOOK_DEDUPE_WINDOW so a redelivery is still recognized as a
+# duplicate: Stripe retries a webhook for up to three days, and the catch-up lists events again
+# from its cursor, or INITIAL_LOOKBACK back on an account's first run.
+PAYLOAD_RETENTION = float(os.getenv('WEBHOOK_PAYLOAD_RETENTION', str(86400)))
+DEDUPE_WINDOW = max(float(os.getenv('WEBHOOK_DEDUPE_WINDOW', str(7 * 86400))), catchup.INITIAL_LOOKBACK)
+DM_RETENTION = float(os.getenv('DM_RETENTION', str(7 * 86400)))  # Sent and skipped DMs
+SWEEP_INTERVAL = 3600.0
+SWEEP_BATCH_SIZE = 1000  # Rows per transaction, so webhook writes get the database thread in between
+
+
+class RetentionSweeper:
+    """Trims finished rows from the webhook inbox and the DM outbox, which otherwise grow forever."""
+
+    def __init__(self, interval=SWEEP_INTERVAL, batch_size=SWEEP_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Error purging old webhook events and DMs: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, now=None):
+        """Purge everything past its retention. Returns {'emptied': ..., 'deleted': ..., 'dms': ...}."""
+        now = time.time() if now is None else now
+        totals = {'emptied': 0, 'deleted': 0, 'dms': 0}
+        while True:
+            emptied, deleted = await async_db.run_db(webhook_inbox.purge_processed, now - PAYLOAD_RETENTION,
+                                                     now - DEDUPE_WINDOW, self.batch_size)
+            totals['emptied'] += emptied
+            totals['deleted'] += deleted
+            if emptied < self.batch_size and deleted < self.batch_size:
+                break
+        while True:
+            deleted = await async_db.run_db(notifications.purge_finished, now - DM_RETENTION, self.batch_size)
+            totals['dms'] += deleted
+            if deleted < self.batch_size:
+                break
+
+        if any(totals.values()):
+            print(f"Purged old rows: {totals['emptied']} webhook payloads emptied, {totals['deleted']} webhook events "
+                  f"and {totals['dms']} DMs deleted")
+        return totals
@@ -0,0 +1,245 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+import discord
+
+import metrics
+
+# Discord rate-limits member edits per guild. Each guild gets a token bucket that refills at
+# ROLE_EDIT_RATE requests per second and can burst up to ROLE_EDIT_BURST requests.
+ROLE_EDIT_RATE = float(os.getenv('ROLE_EDIT_RATE', '1'))
+ROLE_EDIT_BURST = int(os.getenv('ROLE_EDIT_BURST', '5'))
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+class TokenBucket:
+    """Paces requests to `rate` per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Empty the bucket so the next request waits at least `seconds` (after a 429)."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class PendingChange:
+    """Everything queued for one member: role id -> True to add / False to remove, last write wins."""
+
+    def __init__(self):
+        self.roles = {}
+        self.futures = []
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def is_revocation(self):
+        return not all(self.roles.values())
+
+
+class GuildQueue:
+    def __init__(self, guild):
+        self.guild = guild
+        # Members with a pending removal are served before members that only gain roles
+        self.revocations = OrderedDict()
+        self.grants = OrderedDict()
+        self.bucket = TokenBucket(ROLE_EDIT_RATE, ROLE_EDIT_BURST)
+        self.task = None
+
+    def __len__(self):
+        return len(self.revocations) + len(self.grants)
+
+    def pop(self, member_id):
+        return self.revocations.pop(member_id, None) or self.grants.pop(member_id, None)
+
+    def put(self, member_id, change):
+        # Re-file the member under the right priority each time its change is updated
+        if change.is_revocation:
+            self.grants.pop(member_id, None)
+            self.revocations[member_id] = change
+        else:
+            self.revocations.pop(member_id, None)
+            self.grants[member_id] = change
+
+    def next(self):
+        queue = self.revocations or self.grants
+        return queue.popitem(last=False)
+
+
+class RoleScheduler:
+    """Per-guild, rate-paced queue of role changes, coalesced into one member edit per member."""
+
+    def __init__(self, member_resolver=None):
+        self.member_resolver = member_resolver  # Resolves members not in discord.py's cache
+        self._queues = {}  # guild id -> GuildQueue
+        self.submitted = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.total_drain_time = 0.0
+        self.max_drain_time = 0.0
+
+    def submit(self, guild, member_id, add=(), remove=()):
+        """Queue roles to add to / remove from a member. Returns a future set once the edit is applied."""
+        queue = self._queues.get(guild.id)
+        if queue is None:
+            queue = self._queues[guild.id] = GuildQueue(guild)
+        queue.guild = guild
+
+        change = queue.pop(member_id)
+        if change is None:
+            change = PendingChange()
+        else:
+            self.coalesced += 1
+
+        for role in add:
+            change.roles[role.id] = True
+        for role in remove:
+            change.roles[role.id] = False
+
+        future = asyncio.get_running_loop().create_future()
+        change.futures.append(future)
+        queue.put(member_id, change)
+        self.submitted += 1
+
+        if queue.task is None:
+            queue.task = asyncio.get_running_loop().create_task(self._drain(queue))
+        return future
+
+    async def _drain(self, queue):
+        try:
+            while queue:
+                await queue.bucket.acquire()
+                if not queue:
+                    break
+                member_id, change = queue.next()
+                await self._apply(queue, member_id, change)
+        finally:
+            queue.task = None
+            if not queue:
+                self._queues.pop(queue.guild.id, None)
+
+    async def _apply(self, queue, member_id, change):
+        guild = queue.guild
+        try:
+            if len(change.roles) == 1:
+                # One role goes through Discord's per-role endpoint, which doesn't depend on the
+                # member's current roles, so a cached member is good enough
+                member = await self._resolve(guild, member_id)
+                (role_id, add), = change.roles.items()
+                role = guild.get_role(role_id)
+                if role is not None:
+                    with metrics.DISCORD_REQUEST_SECONDS.labels('add_roles' if add else 'remove_roles').time():
+                        await (member.add_roles(role) if add else member.remove_roles(role))
+                    # The per-role endpoint doesn't update the Member, look it up afresh next time
+                    if self.member_resolver is not None:
+                        self.member_resolver.forget(guild.id, member_id)
+            else:
+                # member.edit replaces the whole role list, so start from the member's live roles
+                with metrics.DISCORD_REQUEST_SECONDS.labels('fetch_member').time():
+                    member = await guild.fetch_member(member_id)
+                current = {role.id: role for role in member.roles if not role.is_default()}
+                roles = dict(current)
+                for role_id, add in change.roles.items():
+                    if add:
+                        role = guild.get_role(role_id)
+                        if role is not None:
+                            roles[role_id] = role
+                    else:
+                        roles.pop(role_id, None)
+
+                # Skip the request entirely if the member already has exactly these roles
+                if set(roles) != set(current):
+                    with metrics.DISCORD_REQUEST_SECONDS.labels('edit_member').time():
+                        member = await member.edit(roles=list(roles.values())) or member
+                if self.member_resolver is not None:
+                    self.member_resolver.remember(member)
+
+        except discord.HTTPException as e:
+            if e.status == 429 and change.attempts < MAX_RATE_LIMIT_RETRIES:
+                # Slow this guild down and put the member back at the front of its queue
+                self.rate_limited += 1
+                change.attempts += 1
+                retry_after = float(e.response.headers.get('Retry-After', 1)) if e.response is not None else 1.0
+                queue.bucket.pause(retry_after)
+                self._requeue_front(queue, member_id, change)
+                return
+            self._finish(change, e)
+            return
+        except Exception as e:
+            self._finish(change, e)
+            return
+
+        self._finish(change)
+
+    async def _resolve(self, guild, member_id):
+        if self.member_resolver is not None:
+            member = await self.member_resolver.resolve(guild, member_id)
+            if member is None:
+                raise LookupError(f"Member {member_id} is not in guild {guild.id}")
+            return member
+        return guild.get_member(member_id) or await guild.fetch_member(member_id)
+
+    def _requeue_front(self, queue, member_id, change):
+        newer = queue.pop(member_id)
+        if newer is not None:
+            # Changes submitted while this one was in flight win over it
+            change.roles.update(newer.roles)
+            change.futures.extend(newer.futures)
+        queue.put(member_id, change)
+        target = queue.revocations if change.is_revocation else queue.grants
+        target.move_to_end(member_id, last=False)
+
+    def _finish(self, change, error=None):
+        drain_time = time.monotonic() - change.queued_at
+        if error is None:
+            self.applied += 1
+            self.total_drain_time += drain_time
+            self.max_drain_time = max(self.max_drain_time, drain_time)
+        else:
+            self.failed += 1
+
+        for future in change.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def queue_depth(self):
+        """Number of members with pending changes, per guild id."""
+        return {guild_id: len(queue) for guild_id, queue in self._queues.items()}
+
+    def stats(self):
+        """Counters and drain-time figures for logging and metrics."""
+        return {
+            'queued': sum(len(queue) for queue in list(self._queues.values())),  # May be read off the loop by /metrics
+            'guilds': len(self._queues),
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'applied': self.applied,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited,
+            'avg_drain_time': self.total_drain_time / self.applied if self.applied else 0.0,
+            'max_drain_time': self.max_drain_time,
+        }
@@ -0,0 +1,199 @@
+import bisect
+import threading
+from collections import namedtuple
+
+# One role grant: the guild a plan belongs to and the role its subscribers get
+Route = namedtuple('Route', ['guild_id', 'role_id', 'plan_name'])
+
+
+class RoutingIndex:
+    """In-memory index from a Stripe event's connected account and price ids to guild roles.
+
+    Built from the servers and plans tables and updated by db_utils on every write, so routing an
+    event is a couple of dict lookups per line item no matter how many guilds and plans we host.
+    """
+
+    def __init__(self):
+        self._guild_by_account = {}  # stripe_account_id -> discord_server_id
+        self._route_by_price = {}  # price_id -> Route (price ids are unique across Stripe)
+        self._lock = threading.Lock()  # Serializes writers, readers rely on atomic dict lookups
+
+    def rebuild(self, servers, plans):
+        """Replace the index with (discord_server_id, stripe_account_id) and plan rows."""
+        guild_by_account = {stripe_account_id: discord_server_id for discord_server_id, stripe_account_id in servers}
+        route_by_price = {
+            price_id: Route(discord_server_id, role_id, plan_name)
+            for discord_server_id, plan_name, price_id, role_id in plans
+        }
+        with self._lock:
+            self._guild_by_account = guild_by_account
+            self._route_by_price = route_by_price
+
+    def set_account(self, discord_server_id, stripe_account_id):
+        with self._lock:
+            # A guild has one account, drop whatever account it was connected to before
+            for account, guild_id in list(self._guild_by_account.items()):
+                if guild_id == discord_server_id:
+                    del self._guild_by_account[account]
+            self._guild_by_account[stripe_account_id] = discord_server_id
+
+    def remove_account(self, discord_server_id):
+        with self._lock:
+            for account, guild_id in list(self._guild_by_account.items()):
+                if guild_id == discord_server_id:
+                    del self._guild_by_account[account]
+
+    def add_plan(self, discord_server_id, plan_name, price_id, role_id):
+        with self._lock:
+            self._route_by_price[price_id] = Route(discord_server_id, role_id, plan_name)
+
+    def guild_for_account(self, stripe_account_id):
+        return self._guild_by_account.get(stripe_account_id)
+
+    def role_ids_for_guild(self, guild_id):
+        """Every role granted by one of the guild's plans (a scan, meant for reconciliation)."""
+        return {route.role_id for route in list(self._route_by_price.values())
+                if route.guild_id == guild_id and route.role_id is not None}
+
+    def role_ids_for_prices(self, guild_id, prices):
+        """Roles granted in a guild by a set of price ids, e.g. a subscription's items."""
+        role_ids = set()
+        for price_id in prices:
+            route = self._route_by_price.get(price_id)
+            if route is not None and route.guild_id == guild_id and route.role_id is not None:
+                role_ids.add(route.role_id)
+        return role_ids
+
+    def route(self, event):
+        """Return the Routes a Stripe event applies to, one per matching plan that grants a role."""
+        obj = event['data']['object']
+        account = event.get('account')
+        guild_id = self._guild_by_account.get(account) if account else None
+        if account and guild_id is None:
+            return []  # The account was disconnected, nothing of ours to change
+
+        routes = []
+        for price_id in price_ids(obj):
+            route = self._route_by_price.get(price_id)
+            if route is None or route.role_id is None:
+                continue
+            # The price must belong to the guild of the account that sent the event
+            if guild_id is not None and route.guild_id != guild_id:
+                continue
+            if route not in routes:
+                routes.append(route)
+        return routes
+
+    def __len__(self):
+        return len(self._route_by_price)
+
+
+class PlanNameIndex:
+    """Sorted plan names per guild for prefix lookups, e.g. slash command autocomplete.
+
+    Each guild's names are kept as a sorted list of (casefolded name, name), so a prefix is found
+    with two binary searches. Writers replace a guild's list rather than changing it in place, so
+    readers on the event loop never see it half updated.
+    """
+
+    def __init__(self):
+        self._names_by_guild = {}  # discord_server_id -> sorted [(casefolded name, name)]
+        self._lock = threading.Lock()
+
+    def rebuild(self, plans):
+        """Replace the index with (discord_server_id, plan_name) rows."""
+        names_by_guild = {}
+        for discord_server_id, plan_name in plans:
+            names_by_guild.setdefault(discord_server_id, []).append((plan_name.casefold(), plan_name))
+        for names in names_by_guild.values():
+            names.sort()
+        with self._lock:
+            self._names_by_guild = names_by_guild
+
+    def add(self, discord_server_id, plan_name):
+        with self._lock:
+            names = list(self._names_by_guild.get(discord_server_id, ()))
+            entry = (plan_name.casefold(), plan_name)
+            index = bisect.bisect_left(names, entry)
+            if index == len(names) or names[index] != entry:
+                names.insert(index, entry)
+                self._names_by_guild[discord_server_id] = names
+
+    def has(self, discord_server_id, plan_name):
+        names = self._names_by_guild.get(discord_server_id, ())
+        entry = (plan_name.casefold(), plan_name)
+        index = bisect.bisect_left(names, entry)
+        return index < len(names) and names[index] == entry
+
+    def complete(self, discord_server_id, prefix, limit=25):
+        """Up to `limit` of the guild's plan names starting with prefix, ignoring case, in order."""
+        names = self._names_by_guild.get(discord_server_id, ())
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(names, (prefix,))
+        matches = []
+        for folded, plan_name in names[start:start + limit]:
+            if not folded.startswith(prefix):
+                break
+            matches.append(plan_name)
+        return matches
+
+    def __len__(self):
+        return sum(len(names) for names in list(self._names_by_guild.values()))
+
+
+def price_ids(obj):
+    """Price ids on an invoice's line items or a subscription's items."""
+    if obj.get('object') == 'subscription':
+        items = (obj.get('items') or {}).get('data', [])
+    else:
+        items = (obj.get('lines') or {}).get('data', [])
+
+    found = []
+    for item in items:
+        price = item.get('price')
+        if isinstance(price, dict):
+            found.append(price.get('id'))
+        elif isinstance(price, str):
+            found.append(price)
+        else:
+            # Newer API versions nest the price under pricing.price_details
+            details = (item.get('pricing') or {}).get('price_details') or {}
+            found.append(details.get('price'))
+    return [price_id for price_id in found if price_id]
+
+
+def subscription_id(obj):
+    """The id of the subscription a subscription or invoice object belongs to, if any."""
+    if obj.get('object') == 'subscription':
+        return obj.get('id')
+
+    subscription = obj.get('subscription')
+    if subscription is None:
+        # Newer API versions moved it under parent.subscription_details
+        details = (obj.get('parent') or {}).get('subscription_details') or {}
+        subscription = details.get('subscription')
+    if isinstance(subscription, dict):
+        subscription = subscription.get('id')
+    return subscription
+
+
+def discord_user_id(obj):
+    """The subscriber's Discord user id on a checkout session, invoice or subscription, if recorded."""
+    if obj.get('client_reference_id'):
+        return obj['client_reference_id']
+    return _metadata_value(obj, 'discord_user_id')
+
+
+def discord_server_id(obj):
+    """The guild a checkout session, invoice or subscription was created for, if recorded."""
+    return _metadata_value(obj, 'discord_server_id')
+
+
+def _metadata_value(obj, key):
+    # Checkout copies subscription_data.metadata onto the subscription, and invoices carry it along
+    metadata = obj.get('metadata') or {}
+    if metadata.get(key):
+        return metadata[key]
+
+    details = obj.get('subscription_details') or {}
+    return (details.get('metadata') or {}).get(key)
@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+
+import metrics
+from cache import TTLCache
+
+# The stripe SDK is blocking, so every call the bot makes runs on this bounded pool instead of
+# the event loop. The bound keeps a burst of commands from opening unlimited Stripe requests.
+STRIPE_MAX_WORKERS = int(os.getenv('STRIPE_MAX_WORKERS', '8'))
+
+_executor = ThreadPoolExecutor(max_workers=STRIPE_MAX_WORKERS, thread_name_prefix='stripe')
+
+# Retries of connection errors, 409s, 429s and 5xx, with backoff. The SDK gives every POST an
+# Idempotency-Key before the first attempt, so a retried create never makes a second object.
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', '2'))
+STRIPE_TIMEOUT = int(os.getenv('STRIPE_TIMEOUT', '30'))
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+# Open Checkout Sessions by (guild id, user id, price id), reused until shortly before they expire
+# so repeated /subscribe clicks don't each create a session. Dropped when Stripe reports the
+# session completed or expired.
+CHECKOUT_REUSE_MARGIN = 300  # Seconds before expires_at after which a session is no longer handed out
+checkout_session_cache = TTLCache('checkout_sessions', int(os.getenv('CHECKOUT_SESSION_CACHE_SIZE', '10000')))
+_creating_sessions = {}  # key -> task, so simultaneous clicks share one Session.create
+
+
+class PooledHTTPClient(stripe.RequestsClient):
+    """The SDK's requests client with one keep-alive connection pool shared by every thread.
+
+    The stock client opens a session per thread, so threads that come and go (Flask's request
+    threads, asyncio's default executor) each pay for a new TLS connection. Every request
+    attempt, retries included, is counted by connected account and outcome.
+    """
+
+    def __init__(self, pool_size=STRIPE_MAX_WORKERS, timeout=STRIPE_TIMEOUT, **kwargs):
+        session = requests.Session()
+        # api.stripe.com and connect.stripe.com, each with up to pool_size idle connections kept
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        super().__init__(timeout=timeout, session=session, **kwargs)
+
+    def request(self, method, url, headers, post_data=None):
+        account = (headers or {}).get('Stripe-Account', 'platform')
+        try:
+            content, status, response_headers = super().request(method, url, headers, post_data)
+        except stripe.error.APIConnectionError:
+            metrics.STRIPE_ACCOUNT_REQUESTS.labels(account, 'connection_error').inc()
+            raise
+        metrics.STRIPE_ACCOUNT_REQUESTS.labels(account, '429' if status == 429 else f'{status // 100}xx').inc()
+        return content, status, response_headers
+
+    def close(self):
+        self._session.close()
+
+
+def http_client():
+    """The process-wide PooledHTTPClient, created on first use."""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = PooledHTTPClient()
+    return _http_client
+
+
+def configure():
+    """Send every stripe SDK call in this process through the shared client, with retries."""
+    stripe.default_http_client = http_client()
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+
+
+async def call(func, *args, **kwargs):
+    """ Run a blocking stripe SDK function on the Stripe pool and await its result """
+    loop = asyncio.get_running_loop()
+    histogram = metrics.STRIPE_REQUEST_SECONDS.labels(getattr(func, '__qualname__', 'unknown'))
+    return await loop.run_in_executor(_executor, _timed, histogram, functools.partial(func, *args, **kwargs))
+
+
+def _timed(histogram, request):
+    # Timed on the pool thread, so only the request itself is measured and not the wait for a worker
+    started = time.perf_counter()
+    try:
+        return request()
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+async def create_recurring_price(plan_name, unit_amount, stripe_account_id, currency='usd', interval='month',
+                                 idempotency_key=None):
+    """Create a product and its recurring price on a connected account in one request."""
+    # product_data creates the product inline, saving the separate Product.create round-trip
+    return await call(
+        stripe.Price.create,
+        unit_amount=unit_amount,
+        currency=currency,
+        recurring={"interval": interval},
+        product_data={"name": plan_name},
+        stripe_account=stripe_account_id,
+        idempotency_key=idempotency_key
+    )
+
+
+async def create_checkout_session(price_id, discord_user_id, discord_server_id, stripe_account_id):
+    """Create a subscription checkout session for a Discord user on a connected account."""
+    return await call(
+        stripe.checkout.Session.create,
+        payment_method_types=['card'],
+        line_items=[{
+            'price': price_id,
+            'quantity': 1,
+        }],
+        mode='subscription',
+        success_url='https://yourdomain.com/success',
+        cancel_url='https://yourdomain.com/cancel',
+        client_reference_id=str(discord_user_id),  # Save the Discord user ID as a reference
+        # Lets the checkout.session.* webhooks find the cached session again
+        metadata={
+            'discord_user_id': str(discord_user_id),
+            'discord_server_id': str(discord_server_id),
+            'price_id': price_id,
+        },
+        # Copied onto the subscription and its invoices, which don't carry client_reference_id
+        subscription_data={'metadata': {
+            'discord_user_id': str(discord_user_id),
+            'discord_server_id': str(discord_server_id),
+        }},
+        stripe_account=stripe_account_id
+    )
+
+
+def _checkout_session_key(discord_server_id, discord_user_id, price_id):
+    return str(discord_server_id), str(discord_user_id), price_id
+
+
+async def get_or_create_checkout_session(price_id, discord_user_id, discord_server_id, stripe_account_id):
+    """Return the user's open checkout session for this price, creating one only if there is none."""
+    key = _checkout_session_key(discord_server_id, discord_user_id, price_id)
+    session = checkout_session_cache.get(key)
+    if session is not None:
+        return session
+
+    task = _creating_sessions.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_create_and_cache_session(key, price_id, discord_user_id, discord_server_id, stripe_account_id))
+        _creating_sessions[key] = task
+        task.add_done_callback(lambda _: _creating_sessions.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _create_and_cache_session(key, price_id, discord_user_id, discord_server_id, stripe_account_id):
+    session = await create_checkout_session(price_id, discord_user_id, discord_server_id, stripe_account_id)
+    ttl = session.expires_at - time.time() - CHECKOUT_REUSE_MARGIN
+    if ttl > 0:
+        checkout_session_cache.set(key, session, ttl=ttl)
+    return session
+
+
+def forget_checkout_session(session):
+    """Drop a cached session once Stripe reports it completed or expired (takes the webhook's object)."""
+    metadata = session.get('metadata') or {}
+    server_id, user_id, price_id = (metadata.get(name) for name in ('discord_server_id', 'discord_user_id', 'price_id'))
+    if not (server_id and user_id and price_id):
+        return  # Not a session this bot created
+    key = _checkout_session_key(server_id, user_id, price_id)
+    cached = checkout_session_cache.get(key)
+    # A newer session may already have replaced the one this event is about
+    if cached is not None and cached.id == session.get('id'):
+        checkout_session_cache.invalidate(key)
+
+
+async def exchange_oauth_code(code):
+    """Exchange a Stripe Connect authorization code for the connected account's credentials."""
+    return await call(
+        stripe.OAuth.token,
+        grant_type='authorization_code',
+        code=code
+    )
+
+
+def shutdown():
+    """ Stop the Stripe pool, letting in-flight requests finish """
+    _executor.shutdown(wait=True)
+    if _http_client is not None:
+        _http_client.close()
@@ -0,0 +1,347 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import async_db
+import cluster
+import metrics
+import routing
+from db_utils import get_db_connection, batch
+
+# Event states: pending -> processing -> done, or back to pending with a backoff until
+# MAX_ATTEMPTS is reached, at which point the event is parked as dead for manual inspection.
+PENDING = 'pending'
+PROCESSING = 'processing'
+DONE = 'done'
+DEAD = 'dead'
+
+MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '8'))
+RETRY_BASE_DELAY = 2.0  # Seconds before the first retry, doubled on every further attempt
+RETRY_MAX_DELAY = 3600.0
+
+# Events of one connected account processed at the same time, so a tenant with a burst of events
+# can't take every slot. A batch claims at most ACCOUNT_BATCH_SHARE of its size from one account.
+ACCOUNT_CONCURRENCY = int(os.getenv('WEBHOOK_ACCOUNT_CONCURRENCY', '2'))
+ACCOUNT_BATCH_SHARE = 0.25
+
+# The guild of an event's connected account, falling back to the one it was stored with
+_EVENT_GUILD = 'COALESCE((SELECT discord_server_id FROM servers WHERE stripe_account_id = ?), ?)'
+
+# Events are claimed in queue_position order. A new event goes one past the later of the queue's
+# head and its account's last waiting event, so accounts take turns: a backlog from one account
+# only delays that account, the next event of any other account lands near the front.
+_QUEUE_POSITION = '''MAX(
+    COALESCE((SELECT MIN(queue_position) FROM webhook_events WHERE status = 'pending'), 0),
+    COALESCE((SELECT MAX(queue_position) FROM webhook_events WHERE status = 'pending' AND stripe_account_id IS ?), 0)
+) + 1'''
+
+
+class NotOwnedError(Exception):
+    """Raised by a handler for an event of a guild on another worker's shards."""
+
+    def __init__(self, discord_server_id):
+        super().__init__(f"Guild {discord_server_id} is run by another worker")
+        self.discord_server_id = discord_server_id
+
+
+def enqueue_event(event_id, event_type, stripe_account_id, payload, discord_server_id=None):
+    """Persist a webhook event. Returns False if the event id was already received.
+
+    The event is stored with the guild of its connected account, or with `discord_server_id` (e.g.
+    from the object's metadata) for events that don't come from a connected account.
+    """
+    return enqueue_received([(event_id, event_type, stripe_account_id, payload, discord_server_id)])[0]
+
+
+def enqueue_received(events):
+    """enqueue_event() for several (event_id, event_type, stripe_account_id, payload, discord_server_id)
+    rows in one transaction. Returns whether each one was new.
+    """
+    now = time.time()
+    with batch() as connection:
+        return [connection.execute(f'''
+            INSERT OR IGNORE INTO webhook_events
+                (event_id, event_type, stripe_account_id, discord_server_id, payload, next_attempt_at, received_at,
+                 queue_position)
+            VALUES (?, ?, ?, {_EVENT_GUILD}, ?, ?, ?, {_QUEUE_POSITION})
+        ''', (event_id, event_type, stripe_account_id, stripe_account_id, discord_server_id, payload, now, now,
+              stripe_account_id)).rowcount == 1
+            for event_id, event_type, stripe_account_id, payload, discord_server_id in events]
+
+
+def enqueue_events(events):
+    """Persist (event_id, event_type, stripe_account_id, payload, created, discord_server_id) rows in one transaction.
+
+    Used for events fetched after the fact, so they are stamped with their Stripe creation time
+    and get claimed in the order they happened, ahead of anything received live since.
+    Returns how many were new.
+    """
+    with batch() as connection:
+        before = connection.total_changes
+        # Just ahead of the queue's head, in the order they were created
+        head = connection.execute(
+            "SELECT COALESCE(MIN(queue_position), 0) FROM webhook_events WHERE status = 'pending'").fetchone()[0]
+        events = sorted(events, key=lambda event: event[4])
+        connection.executemany(f'''
+            INSERT OR IGNORE INTO webhook_events
+                (event_id, event_type, stripe_account_id, discord_server_id, payload, next_attempt_at, received_at,
+                 queue_position)
+            VALUES (?, ?, ?, {_EVENT_GUILD}, ?, ?, ?, ?)
+        ''', [(event_id, event_type, stripe_account_id, stripe_account_id, discord_server_id, payload, created, created,
+               head - 1 + index / len(events))
+              for index, (event_id, event_type, stripe_account_id, payload, created, discord_server_id) in enumerate(events)])
+        return connection.total_changes - before
+
+
+def claim_batch(limit, shards=None, per_account=None):
+    """Mark up to `limit` due events as processing and return them, oldest first.
+
+    Events are taken in queue order (see _QUEUE_POSITION). With `shards`, only events of guilds on
+    those shards are claimed. With `per_account`, at most that many of one connected account, so a
+    batch of a lone account's backlog stays short and whoever comes next doesn't wait long.
+    """
+    shard_filter, shard_params = cluster.shard_filter(shards)
+    per_account = per_account or limit
+    connection = get_db_connection()
+    # Walks idx_webhook_events_queue in order, skipping retries that aren't due yet. The + keeps
+    # SQLite from sorting the due events by queue_position instead.
+    rows = connection.execute(f'''
+        UPDATE webhook_events
+        SET status = 'processing', attempts = attempts + 1
+        WHERE event_id IN (
+            SELECT event_id FROM (
+                SELECT event_id,
+                       ROW_NUMBER() OVER (PARTITION BY stripe_account_id ORDER BY queue_position) AS turn
+                FROM (
+                    SELECT event_id, stripe_account_id, queue_position FROM webhook_events
+                    WHERE status = 'pending' AND +next_attempt_at <= ? {shard_filter}
+                    ORDER BY queue_position
+                    LIMIT ?
+                )
+            )
+            WHERE turn <= ?
+        )
+        RETURNING event_id, event_type, stripe_account_id, payload, attempts, received_at
+    ''', (time.time(), *shard_params, limit, per_account)).fetchall()
+    connection.commit()
+    return sorted(rows, key=lambda row: row['received_at'])
+
+
+def retry_delay(attempts):
+    """Exponential backoff with full jitter for the given number of failed attempts."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def record_results(done_ids, failures, deferred=(), rerouted=()):
+    """Write a batch's outcomes in one transaction.
+
+    failures is a list of (event_id, attempts, error, next_attempt_at), deferred a list of
+    (event_id, next_attempt_at) for events put back unprocessed, which doesn't use up an attempt.
+    rerouted is a list of (event_id, discord_server_id) for events put back unprocessed for the
+    worker running that guild.
+    """
+    now = time.time()
+    with batch() as connection:
+        connection.executemany('''
+            UPDATE webhook_events SET status = 'done', processed_at = ?, last_error = NULL
+            WHERE event_id = ?
+        ''', [(now, event_id) for event_id in done_ids])
+
+        for event_id, attempts, error, next_attempt_at in failures:
+            if attempts >= MAX_ATTEMPTS:
+                connection.execute('''
+                    UPDATE webhook_events SET status = 'dead', last_error = ? WHERE event_id = ?
+                ''', (error, event_id))
+            else:
+                connection.execute('''
+                    UPDATE webhook_events SET status = 'pending', next_attempt_at = ?, last_error = ?
+                    WHERE event_id = ?
+                ''', (next_attempt_at, error, event_id))
+
+        connection.executemany('''
+            UPDATE webhook_events SET status = 'pending', attempts = attempts - 1, next_attempt_at = ?
+            WHERE event_id = ?
+        ''', [(next_attempt_at, event_id) for event_id, next_attempt_at in deferred])
+
+        connection.executemany('''
+            UPDATE webhook_events SET status = 'pending', attempts = attempts - 1, discord_server_id = ?,
+                next_attempt_at = ?
+            WHERE event_id = ?
+        ''', [(discord_server_id, now, event_id) for event_id, discord_server_id in rerouted])
+
+
+def requeue_interrupted(shards=None):
+    """Return events left in processing by a crash or restart to the pending state.
+
+    With `shards`, only events of guilds on those shards, the other workers' events are still in flight.
+    """
+    shard_filter, shard_params = cluster.shard_filter(shards)
+    connection = get_db_connection()
+    cursor = connection.execute(f'''
+        UPDATE webhook_events SET status = 'pending', next_attempt_at = ? WHERE status = 'processing' {shard_filter}
+    ''', (time.time(), *shard_params))
+    connection.commit()
+    return cursor.rowcount
+
+
+def purge_processed(payload_before, delete_before, limit):
+    """Empty the payloads of events processed before payload_before and delete those processed
+    before delete_before, at most `limit` of each. Returns (emptied, deleted).
+
+    The id of a deleted event is forgotten, a redelivery after that is stored and applied again.
+    """
+    with batch() as connection:
+        # The partial index only holds payloads still to empty, left to itself the planner takes the full one
+        emptied = connection.execute('''
+            UPDATE webhook_events SET payload = ''
+            WHERE rowid IN (
+                SELECT rowid FROM webhook_events INDEXED BY idx_webhook_events_payloads
+                WHERE status = 'done' AND payload != '' AND processed_at < ?
+                LIMIT ?
+            )
+        ''', (payload_before, limit)).rowcount
+        deleted = connection.execute('''
+            DELETE FROM webhook_events
+            WHERE rowid IN (
+                SELECT rowid FROM webhook_events WHERE status = 'done' AND processed_at < ? LIMIT ?
+            )
+        ''', (delete_before, limit)).rowcount
+    return emptied, deleted
+
+
+def count_by_status():
+    """Number of inbox events in each state."""
+    connection = get_db_connection()
+    rows = connection.execute('SELECT status, COUNT(*) AS total FROM webhook_events GROUP BY status').fetchall()
+    return {row['status']: row['total'] for row in rows}
+
+
+class InboxWorker:
+    """Drains the webhook inbox on the bot's event loop, handing each event to `handler`.
+
+    Events of one subscription are applied one at a time, in the order they were received. When one
+    fails, the subscription's later events wait for its retry instead of overtaking it.
+    """
+
+    def __init__(self, handler, concurrency=4, batch_size=50, poll_interval=1.0, shards=None,
+                 account_concurrency=ACCOUNT_CONCURRENCY):
+        self.handler = handler  # async function taking the decoded Stripe event
+        self.shards = shards  # cluster.Shards whose guilds' events this worker claims, None for all
+        self.concurrency = concurrency
+        self.account_concurrency = account_concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._held = {}  # Ordering key -> (id of its failed event, when that is retried)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """Wake the worker because a new event was stored. Must be called on the worker's loop."""
+        self._wakeup.set()
+
+    async def _run(self):
+        requeued = await async_db.run_db(requeue_interrupted, self.shards)
+        if requeued:
+            print(f"Requeued {requeued} interrupted webhook events.")
+
+        per_account = max(1, int(self.batch_size * ACCOUNT_BATCH_SHARE))
+        while True:
+            try:
+                events = await async_db.run_db(claim_batch, self.batch_size, self.shards, per_account)
+            except Exception as e:
+                print(f"Error claiming webhook events: {e}")
+                events = []
+
+            if not events:
+                # Sleep until the webhook endpoint notifies us or the poll interval picks up retries
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process_batch(events)
+
+    async def _process_batch(self, events):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        account_semaphores = {}
+        done_ids = []
+        failures = []
+        deferred = []
+        rerouted = []
+
+        async def process(row, event):
+            """Apply one event. Returns when it will be retried if it failed, else None."""
+            account = account_semaphores.setdefault(row['stripe_account_id'], asyncio.Semaphore(self.account_concurrency))
+            # The account's slot first, so events waiting on a busy account don't hold shared slots
+            async with account, semaphore:
+                event_type = row['event_type']
+                started = time.perf_counter()
+                retry_at = None
+                try:
+                    if event is None:
+                        raise ValueError("The stored payload is not valid JSON")
+                    await self.handler(event)
+                    done_ids.append(row['event_id'])
+                    outcome = 'processed'
+                except NotOwnedError as e:
+                    # Stored without a guild, e.g. not from a connected account, and claimed by the primary worker
+                    rerouted.append((row['event_id'], str(e.discord_server_id)))
+                    outcome = 'rerouted'
+                except Exception as e:
+                    print(f"Error processing webhook event {row['event_id']} (attempt {row['attempts']}): {e}")
+                    if row['attempts'] < MAX_ATTEMPTS:
+                        retry_at = time.time() + retry_delay(row['attempts'])
+                    failures.append((row['event_id'], row['attempts'], repr(e), retry_at))
+                    outcome = 'failed' if retry_at else 'dead'
+                metrics.WEBHOOK_PROCESSING_SECONDS.labels(event_type).observe(time.perf_counter() - started)
+                metrics.WEBHOOK_EVENTS.labels(event_type, outcome).inc()
+                return retry_at
+
+        async def process_in_order(key, group):
+            for index, (row, event) in enumerate(group):
+                held = self._held.get(key)
+                # A hold whose event hasn't come back long after its retry time is stale, e.g. the
+                # event was moved by hand
+                if held is not None and held[0] != row['event_id'] and time.time() - held[1] < RETRY_MAX_DELAY:
+                    # Put the rest back just behind the failed event, still in order
+                    for later, _ in group[index:]:
+                        deferred.append((later['event_id'], held[1] + 0.001))
+                        metrics.WEBHOOK_EVENTS.labels(later['event_type'], 'deferred').inc()
+                    return
+                retry_at = await process(row, event)
+                if retry_at is None:
+                    self._held.pop(key, None)
+                else:
+                    self._held[key] = (row['event_id'], retry_at)
+
+        # Group by subscription, events without one are independent
+        groups = {}
+        for row in events:
+            event = None
+            try:
+                event = json.loads(row['payload'])
+                key = routing.subscription_id(event['data']['object']) or row['event_id']
+            except (ValueError, KeyError, TypeError, AttributeError):
+                key = row['event_id']
+            groups.setdefault(key, []).append((row, event))
+
+        await asyncio.gather(*(process_in_order(key, group) for key, group in groups.items()))
+        await async_db.run_db(record_results, done_ids, failures, deferred, rerouted)
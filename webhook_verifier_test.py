@@ -0,0 +1,65 @@
+import pytest
+
+from webhook_verifier import SignatureVerificationError, WebhookVerifier, generate_signature_header
+
+SECRET = 'whsec_current'
+OLD_SECRET = 'whsec_old'
+PAYLOAD = b'{"id": "evt_1", "type": "invoice.payment_succeeded"}'
+NOW = 1700000000
+
+
+def test_valid_signature():
+    WebhookVerifier([SECRET]).verify(PAYLOAD, generate_signature_header(PAYLOAD, SECRET, NOW), now=NOW)
+
+
+def test_tampered_body():
+    header = generate_signature_header(PAYLOAD, SECRET, NOW)
+    with pytest.raises(SignatureVerificationError):
+        WebhookVerifier([SECRET]).verify(PAYLOAD.replace(b'evt_1', b'evt_2'), header, now=NOW)
+
+
+def test_wrong_secret():
+    with pytest.raises(SignatureVerificationError):
+        WebhookVerifier([SECRET]).verify(PAYLOAD, generate_signature_header(PAYLOAD, 'whsec_other', NOW), now=NOW)
+
+
+@pytest.mark.parametrize('offset', [-301, 301])
+def test_stale_or_future_timestamp(offset):
+    header = generate_signature_header(PAYLOAD, SECRET, NOW + offset)
+    with pytest.raises(SignatureVerificationError, match='tolerance'):
+        WebhookVerifier([SECRET], tolerance=300).verify(PAYLOAD, header, now=NOW)
+
+
+def test_timestamp_at_the_tolerance_is_accepted():
+    header = generate_signature_header(PAYLOAD, SECRET, NOW - 300)
+    WebhookVerifier([SECRET], tolerance=300).verify(PAYLOAD, header, now=NOW)
+
+
+def test_rotated_secret():
+    # Both secrets are accepted while Stripe signs with either during the rotation
+    verifier = WebhookVerifier.from_env_value(f'{SECRET},{OLD_SECRET}')
+    verifier.verify(PAYLOAD, generate_signature_header(PAYLOAD, OLD_SECRET, NOW), now=NOW)
+    verifier.verify(PAYLOAD, generate_signature_header(PAYLOAD, SECRET, NOW), now=NOW)
+    # Once the old secret is dropped, its signatures are rejected
+    with pytest.raises(SignatureVerificationError):
+        WebhookVerifier.from_env_value(SECRET).verify(
+            PAYLOAD, generate_signature_header(PAYLOAD, OLD_SECRET, NOW), now=NOW)
+
+
+def test_header_with_several_signatures():
+    old = generate_signature_header(PAYLOAD, OLD_SECRET, NOW).split(',')[1]
+    header = generate_signature_header(PAYLOAD, SECRET, NOW) + ',' + old
+    WebhookVerifier([OLD_SECRET]).verify(PAYLOAD, header, now=NOW)
+
+
+@pytest.mark.parametrize('header', [None, '', 'v1=abc', f't={NOW}', f't=soon,v1=abc'])
+def test_malformed_header(header):
+    with pytest.raises(SignatureVerificationError):
+        WebhookVerifier([SECRET]).verify(PAYLOAD, header, now=NOW)
+
+
+def test_no_secret_configured():
+    verifier = WebhookVerifier.from_env_value(None)
+    assert not verifier.configured
+    with pytest.raises(SignatureVerificationError):
+        verifier.verify(PAYLOAD, generate_signature_header(PAYLOAD, SECRET, NOW), now=NOW)